@@ -152,6 +152,8 @@ def _run_cleanup(args) -> bool:
         v = getattr(args, k, None)
         if v:
             json.setdefault("retention", {})[k] = v
+    if args.verify:
+        json["verify"] = True
     return _run_op("cleanup", args, json=json)
 
 
@@ -187,6 +189,9 @@ def create_client_parsers(parser, subparsers):
     p_cleanup.add_argument(
         "--keep-days", type=int, help="Number of days to keep backups (does not override minimum/maximum-backups)"
     )
+    p_cleanup.add_argument(
+        "--verify", action="store_true", help="Find unused data by scanning all backups, instead of using reference counts"
+    )
 
     p_cleanup.set_defaults(func=_run_cleanup)
 
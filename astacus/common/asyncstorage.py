@@ -7,6 +7,7 @@ See LICENSE for details
 
 from astacus.common.storage import HexDigestStorage, JsonStorage
 from starlette.concurrency import run_in_threadpool
+from typing import List
 
 
 class AsyncHexDigestStorage:
@@ -23,9 +24,27 @@ class AsyncHexDigestStorage:
     async def delete_hexdigest(self, hexdigest: str):
         return await run_in_threadpool(self.storage.delete_hexdigest, hexdigest)
 
+    async def delete_hexdigests(self, hexdigests: List[str]):
+        return await run_in_threadpool(self.storage.delete_hexdigests, hexdigests)
+
+    async def download_hexdigest_bytes(self, hexdigest: str):
+        return await run_in_threadpool(self.storage.download_hexdigest_bytes, hexdigest)
+
     async def list_hexdigests(self):
         return await run_in_threadpool(self.storage.list_hexdigests)
 
+    async def list_unsharded_hexdigests(self):
+        return await run_in_threadpool(self.storage.list_unsharded_hexdigests)
+
+    async def migrate_hexdigest(self, hexdigest: str):
+        return await run_in_threadpool(self.storage.migrate_hexdigest, hexdigest)
+
+    async def migrate_hexdigests(self, hexdigests: List[str]):
+        return await run_in_threadpool(self.storage.migrate_hexdigests, hexdigests)
+
+    async def upload_hexdigest_bytes(self, hexdigest: str, data: bytes):
+        return await run_in_threadpool(self.storage.upload_hexdigest_bytes, hexdigest, data)
+
 
 class AsyncJsonStorage:
     """Subset of the JsonStorage API proxied async -> sync via starlette threadpool
@@ -46,4 +46,7 @@ class TransientException(AstacusException):
     pass
 
 
-# TBD: Wrap the e.g. rohmu retryable exceptions around TransientException
+# rohmu has given us exception that is likely to go away if retried
+# (e.g. timeout, connection reset, throttling or 5xx response)
+class TransientRohmuException(TransientException):
+    pass
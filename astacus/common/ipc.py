@@ -12,7 +12,7 @@ from datetime import datetime
 from enum import Enum
 from pathlib import Path
 from pydantic import Field, root_validator
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 import functools
 import socket
@@ -49,6 +49,9 @@ class NodeResult(AstacusModel):
     az: str = ""
     progress: Progress = Field(default_factory=Progress)
 
+    # Time spent waiting for the node I/O limiter (summed over threads)
+    throttled_seconds: float = 0
+
 
 # node.snapshot
 
@@ -61,6 +64,10 @@ class SnapshotFile(AstacusModel):
     hexdigest: str = ''
     content_b64: Optional[str]
 
+    # If set, the file content is concatenation of these
+    # (content-defined) chunks, and hexdigest is empty
+    chunks: List["SnapshotHash"] = []
+
     def __lt__(self, o):
         # In our use case, paths uniquely identify files we care about
         return self.relative_path < o.relative_path
@@ -81,6 +88,11 @@ class SnapshotRequest(NodeRequest):
     # list of globs, e.g. ["**/*.dat"] we want to back up from root
     root_globs: List[str]
 
+    # If set, the snapshot state is stored as a shard object in this
+    # (sub)object storage, and the result refers to it instead of
+    # containing the files
+    storage: str = ""
+
 
 class SnapshotHash(AstacusModel):
     """
@@ -100,6 +112,28 @@ class SnapshotHash(AstacusModel):
         return hash(self.hexdigest)
 
 
+SnapshotFile.update_forward_refs()
+
+
+class SnapshotPackEntry(AstacusModel):
+    hexdigest: str
+    offset: int
+    size: int
+
+
+class SnapshotPack(AstacusModel):
+    """
+    Pack object, which stores content of small hexdigests (entries)
+    concatenated, instead of each of them being separate object.
+
+    The pack itself is stored like any other hexdigest, and the hexdigest
+    and size here are of the whole pack.
+    """
+    hexdigest: str
+    size: int
+    entries: List[SnapshotPackEntry]
+
+
 class SnapshotUploadRequest(NodeRequest):
     # list of hashes to be uploaded
     hashes: List[SnapshotHash]
@@ -112,6 +146,20 @@ class SnapshotUploadResult(NodeResult):
     total_size: int = 0
     total_stored_size: int = 0
 
+    # How much was read from disk in order to upload total_size
+    total_read_size: int = 0
+
+    # How many times uploads were retried due to transient errors
+    retries: int = 0
+
+    # How much data was stored uncompressed as it was not compressible,
+    # and the estimated CPU time that saved
+    compression_skipped_size: int = 0
+    compression_skipped_seconds: float = 0
+
+    # Packs uploaded (instead of uploading their entries separately)
+    packs: List[SnapshotPack] = []
+
 
 class SnapshotResult(NodeResult):
     # when was the operation started ( / done )
@@ -128,6 +176,23 @@ class SnapshotResult(NodeResult):
     # populated only if state is available
     hashes: Optional[List[SnapshotHash]]
 
+    # If set, state.files are stored in the (hexdigest) shard object with
+    # this name instead (see astacus.common.manifest)
+    shard: str = ""
+
+    # If set, state.files and hashes are omitted (summary result), and
+    # they have to be fetched separately as SnapshotResultPages
+    paged: bool = False
+
+
+class SnapshotResultPage(AstacusModel):
+    # Either files or hashes of the SnapshotResult, depending on what was asked
+    files: List[SnapshotFile] = []
+    hashes: List[SnapshotHash] = []
+
+    # Cursor for the next page; None if this was the last one
+    next_cursor: Optional[int]
+
 
 class SnapshotDownloadRequest(NodeRequest):
     # which (sub)object storage entry should be used
@@ -144,6 +209,13 @@ class SnapshotDownloadRequest(NodeRequest):
     # retrieved via backup manifest.
     root_globs: List[str]
 
+    # If the snapshot state is stored as a shard, its name; the backup
+    # manifest is then not downloaded
+    shard: str = ""
+    # The packs needed to restore the snapshot (as they are now, which
+    # may differ from the ones in the backup manifest due to repacking)
+    packs: List[SnapshotPack] = []
+
 
 class SnapshotClearRequest(NodeRequest):
     # Files not matching this are not deleted
@@ -208,10 +280,37 @@ class BackupManifest(AstacusModel):
     # Plugin-specific data about the backup
     plugin_data: dict = {}
 
+    # Packs which contained (some of) the hexdigests of the backup when
+    # it was made. Manifests are never modified, so after cleanup has
+    # repacked them, the hexdigests are found using the pack indexes.
+    packs: List[SnapshotPack] = []
+
     # Semi-redundant but simplifies handling; automatically set on download
     filename: str = ""
 
 
+class BackupCheckpoint(AstacusModel):
+    """Progress of a backup which has not (yet) finished
+
+    It is stored after the hexdigests have been listed, and after each
+    batch of uploads, and removed when the backup manifest is stored.
+    Subsequent backup attempts (or operations) take a new snapshot, but
+    do not upload the confirmed hexdigests again.
+    """
+
+    # When was the checkpointed backup started
+    start: datetime
+
+    # Which plugin is making the backup
+    plugin: Plugin
+
+    # Results of the upload batches that have been completed
+    upload_results: List[SnapshotUploadResult] = []
+
+    # Hexdigests (of the snapshot results) which are confirmed to be in the storage
+    hexdigests: List[str] = []
+
+
 # coordinator.list
 
 
@@ -233,6 +332,12 @@ class ListSingleBackup(AstacusModel):
     upload_stored_size: int
 
 
+class BackupListIndex(AstacusModel):
+    # Summaries of the backups in the storage, by backup manifest name;
+    # kept up to date by listing (see astacus.coordinator.list)
+    backups: Dict[str, ListSingleBackup] = {}
+
+
 class ListForStorage(AstacusModel):
     storage_name: str
     backups: List[ListSingleBackup]
@@ -249,3 +354,12 @@ class CleanupRequest(AstacusModel):
     storage: str = ""
     retention: Optional[Retention] = None
     explicit_delete: List[str] = []
+    # Verify (and rebuild) the reference counts of the hexdigests with full scan of the storage
+    verify: bool = False
+
+
+# coordinator.migrate
+
+
+class MigrateRequest(AstacusModel):
+    storage: str = ""
@@ -0,0 +1,93 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Crash-safe persistent str -> JSON-encodable value mapping.
+
+Changes are appended to the journal file as JSON lines, so persisting
+small incremental changes to a large mapping is cheap. When the
+journal has grown large enough compared to the live data, it is
+rewritten (atomically, via temporary file + rename).
+
+If the process dies mid-append, the partially written trailing line
+is ignored (and the file compacted) on the next load.
+
+"""
+
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Rewrite the journal once it contains this many times more records than
+# there are live keys (plus COMPACT_MINIMUM, to avoid rewriting small
+# journals all the time)
+COMPACT_RATIO = 2
+COMPACT_MINIMUM = 1000
+
+
+class JsonJournal:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.records = 0
+
+    def load(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {}
+        self.records = 0
+        torn = False
+        try:
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        torn = True
+                        break
+                    self.records += 1
+                    if len(record) == 1:
+                        data.pop(record[0], None)
+                    else:
+                        data[record[0]] = record[1]
+        except FileNotFoundError:
+            return data
+        if torn:
+            # Appending after the torn line would corrupt the next record too
+            logger.info("Ignoring torn record at the end of %s", self.path)
+            self.rewrite(data)
+        return data
+
+    def append(self, changes: Mapping[str, Optional[Any]]):
+        """ Append changes to the journal; value of None deletes the key """
+        if not changes:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            for key, value in changes.items():
+                record = [key] if value is None else [key, value]
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.records += len(changes)
+
+    def rewrite(self, data: Mapping[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with temp_path.open("w", encoding="utf-8") as f:
+            for key, value in data.items():
+                f.write(json.dumps([key, value], separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.path)
+        self.records = len(data)
+
+    def compact_if_needed(self, live: int) -> bool:
+        if self.records <= COMPACT_RATIO * live + COMPACT_MINIMUM:
+            return False
+        logger.debug("Compacting %s: %d records, %d live", self.path, self.records, live)
+        self.rewrite(self.load())
+        return True
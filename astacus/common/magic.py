@@ -9,6 +9,15 @@ ASTACUS_DEFAULT_HOST = "127.0.0.1"  # localhost-only, for testing
 ASTACUS_DEFAULT_PORT = 5515  # random port not assigned by IANA
 ASTACUS_TMPDIR = ".astacus"
 
+# Persistent snapshot index of the node, stored within ASTACUS_TMPDIR of root_link
+SNAPSHOT_INDEX_FILENAME = "snapshot-index.jsonl"
+
+# Coordinator's local hexdigest inventories, within object_storage_cache
+INVENTORY_DIRNAME = ".inventory"
+
+# Coordinator's local hexdigest reference counts, within object_storage_cache
+REFCOUNTS_DIRNAME = ".refcounts"
+
 # Hexdigest is 32 bytes, so something orders of magnitude more at least
 EMBEDDED_FILE_SIZE = 100
 
@@ -26,3 +35,15 @@ class ErrorCode(str, Enum):
 
 # In storage, json files with this prefix are backup manifests
 JSON_BACKUP_PREFIX = "backup-"
+
+# Progress of the backup (if checkpointing is enabled); see ipc.BackupCheckpoint
+JSON_BACKUP_CHECKPOINT = "checkpoint-backup"
+
+# Index of pack object (see ipc.SnapshotPack) with this prefix + pack hexdigest
+JSON_PACK_PREFIX = "pack-"
+
+# Summary of backup manifest (see ipc.ListSingleBackup) with this prefix + backup manifest name
+JSON_BACKUP_SUMMARY_PREFIX = "summary-"
+
+# Summaries of all backups in the storage (see ipc.BackupListIndex)
+JSON_BACKUP_LIST_INDEX = "list-index"
@@ -0,0 +1,329 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Backup manifest encoding.
+
+Plain json manifests contain every file (and hash) of every node as
+separate json objects, which makes them large and slow to parse. In
+compact manifests the files and hashes of snapshot results are stored
+in columnar form instead:
+
+- paths are front coded (only the part differing from the previous
+  path is stored),
+
+- each hexdigest is stored once, in binary if possible, and files,
+  chunks and hashes refer to it by index, and
+
+- numbers are stored as fixed width integer arrays, which are cheap to
+  decode and compress well.
+
+The columns and the rest of the manifest (as json) are compressed, and
+stored base64 encoded inside a small json document, so that they can
+be stored in json storage like everything else.
+
+Snapshot states of single nodes can be also stored in the same
+columnar form as separate objects (per-node manifest shards), which
+are written by the nodes themselves, and only referred to from the
+manifest.
+
+parse_backup_manifest reads both formats.
+
+"""
+
+from astacus.common import exceptions, ipc
+from pathlib import Path
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+import array
+import base64
+import contextlib
+import gc
+import json
+import struct
+import sys
+import zlib
+
+# Key of the format version in (the json document of) compact manifests
+COMPACT_MANIFEST_KEY = "compact_manifest"
+COMPACT_MANIFEST_VERSION = 1
+
+_INT32 = "i"
+_INT64 = "q"
+_LENGTH = struct.Struct("<Q")
+_SEPARATOR = "\0"  # cannot occur in paths (or hexdigests)
+
+
+def _to_bytes(typecode: str, values) -> bytes:
+    a = array.array(typecode, values)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes) -> array.array:
+    a = array.array(typecode)
+    a.frombytes(data)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
+
+
+def _join(strings: List[str]) -> bytes:
+    return _SEPARATOR.join(strings).encode()
+
+
+def _split(data: bytes, count: int) -> List[str]:
+    return data.decode().split(_SEPARATOR) if count else []
+
+
+def _encode_digests(digests: List[str]) -> Tuple[int, bytes]:
+    """ Return (width, data); width is the length of binary digests, or 0 if they are stored as strings """
+    width = len(digests[0]) if digests else 0
+    if width and width % 2 == 0 and all(len(digest) == width for digest in digests):
+        joined = "".join(digests)
+        try:
+            data = bytes.fromhex(joined)
+        except ValueError:
+            pass
+        else:
+            # fromhex accepts also e.g. uppercase, which would not round-trip
+            if data.hex() == joined:
+                return width // 2, data
+    return 0, _join(digests)
+
+
+def _decode_digests(width: int, data: bytes, count: int) -> List[str]:
+    if not width:
+        return _split(data, count)
+    joined = data.hex()
+    step = 2 * width
+    return [joined[i:i + step] for i in range(0, len(joined), step)]
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    # Binary search, as slice comparisons are much faster than comparing characters one by one
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class _DigestTable:
+    def __init__(self):
+        self.digests: List[str] = []
+        self.indexes: dict = {}
+
+    def ref(self, hexdigest: str) -> int:
+        index = self.indexes.get(hexdigest)
+        if index is None:
+            index = self.indexes[hexdigest] = len(self.digests)
+            self.digests.append(hexdigest)
+        return index
+
+
+def _encode_result_columns(result: ipc.SnapshotResult) -> List[bytes]:
+    files = result.state.files if result.state is not None else []
+    return _encode_columns(result.hashes or [], files)
+
+
+def _encode_columns(hashes: Sequence[ipc.SnapshotHash], files: Iterable[ipc.SnapshotFile]) -> List[bytes]:
+    # files is iterated only once, so it can be produced lazily
+    table = _DigestTable()
+    hash_refs = [table.ref(sshash.hexdigest) for sshash in hashes]
+    prefix_lengths = []
+    suffixes = []
+    file_sizes = []
+    mtimes = []
+    digest_refs = []
+    content_lengths = []
+    contents = []
+    chunk_counts = []
+    chunk_refs = []
+    chunk_sizes = []
+    previous = ""
+    for ssfile in files:
+        path = str(ssfile.relative_path)
+        prefix_length = _common_prefix_length(previous, path)
+        prefix_lengths.append(prefix_length)
+        suffixes.append(path[prefix_length:])
+        previous = path
+        file_sizes.append(ssfile.file_size)
+        mtimes.append(ssfile.mtime_ns)
+        digest_refs.append(table.ref(ssfile.hexdigest) if ssfile.hexdigest else -1)
+        if ssfile.content_b64 is None:
+            content_lengths.append(-1)
+        else:
+            content = ssfile.content_b64.encode()
+            content_lengths.append(len(content))
+            contents.append(content)
+        chunk_counts.append(len(ssfile.chunks))
+        for chunk in ssfile.chunks:
+            chunk_refs.append(table.ref(chunk.hexdigest))
+            chunk_sizes.append(chunk.size)
+    width, digests = _encode_digests(table.digests)
+    return [
+        _to_bytes(_INT32, [width, len(table.digests)]),
+        digests,
+        _to_bytes(_INT32, hash_refs),
+        _to_bytes(_INT64, [sshash.size for sshash in hashes]),
+        _to_bytes(_INT32, prefix_lengths),
+        _join(suffixes),
+        _to_bytes(_INT64, file_sizes),
+        _to_bytes(_INT64, mtimes),
+        _to_bytes(_INT32, digest_refs),
+        _to_bytes(_INT64, content_lengths),
+        b"".join(contents),
+        _to_bytes(_INT32, chunk_counts),
+        _to_bytes(_INT32, chunk_refs),
+        _to_bytes(_INT64, chunk_sizes),
+    ]
+
+
+def _decode_result_columns(result: ipc.SnapshotResult, columns: Iterator[bytes]):
+    # Data is produced by us, so the (slow) validation of the models is skipped
+    width, digest_count = _from_bytes(_INT32, next(columns))
+    digests = _decode_digests(width, next(columns), digest_count)
+    hash_refs = _from_bytes(_INT32, next(columns))
+    hash_sizes = _from_bytes(_INT64, next(columns))
+    if result.hashes is not None:
+        result.hashes = [
+            ipc.SnapshotHash.construct(hexdigest=digests[ref], size=size) for ref, size in zip(hash_refs, hash_sizes)
+        ]
+    prefix_lengths = _from_bytes(_INT32, next(columns))
+    suffixes = _split(next(columns), len(prefix_lengths))
+    file_sizes = _from_bytes(_INT64, next(columns))
+    mtimes = _from_bytes(_INT64, next(columns))
+    digest_refs = _from_bytes(_INT32, next(columns))
+    content_lengths = _from_bytes(_INT64, next(columns))
+    contents = next(columns)
+    chunk_counts = _from_bytes(_INT32, next(columns))
+    chunk_refs = _from_bytes(_INT32, next(columns))
+    chunk_sizes = _from_bytes(_INT64, next(columns))
+    if result.state is None:
+        return
+    files = []
+    path = ""
+    content_offset = 0
+    chunk_offset = 0
+    for i, prefix_length in enumerate(prefix_lengths):
+        path = path[:prefix_length] + suffixes[i]
+        content_b64 = None
+        if content_lengths[i] >= 0:
+            content_b64 = contents[content_offset:content_offset + content_lengths[i]].decode()
+            content_offset += content_lengths[i]
+        chunks = []
+        for j in range(chunk_offset, chunk_offset + chunk_counts[i]):
+            chunks.append(ipc.SnapshotHash.construct(hexdigest=digests[chunk_refs[j]], size=chunk_sizes[j]))
+        chunk_offset += chunk_counts[i]
+        files.append(
+            ipc.SnapshotFile.construct(
+                relative_path=Path(path),
+                file_size=file_sizes[i],
+                mtime_ns=mtimes[i],
+                hexdigest=digests[digest_refs[i]] if digest_refs[i] >= 0 else "",
+                content_b64=content_b64,
+                chunks=chunks
+            )
+        )
+    result.state.files = files
+
+
+def encode_compact_backup_manifest(manifest: ipc.BackupManifest) -> dict:
+    """ Encode the manifest to compact format; the result can be stored with upload_json """
+    # The files and hashes are stored as columns, and the rest as json
+    stripped = manifest.copy(
+        update={
+            "snapshot_results": [
+                result.copy(
+                    update={
+                        "state": result.state.copy(update={"files": []}) if result.state is not None else None,
+                        "hashes": [] if result.hashes is not None else None
+                    }
+                ) for result in manifest.snapshot_results
+            ]
+        }
+    )
+    columns = [stripped.json().encode()]
+    for result in manifest.snapshot_results:
+        columns.extend(_encode_result_columns(result))
+    data = zlib.compress(_join_columns(columns))
+    return {COMPACT_MANIFEST_KEY: COMPACT_MANIFEST_VERSION, "data": base64.b64encode(data).decode()}
+
+
+def encode_backup_manifest(manifest: ipc.BackupManifest, *, compact: bool):
+    """ Return what should be stored (with upload_json) for the manifest """
+    return encode_compact_backup_manifest(manifest) if compact else manifest
+
+
+def encode_snapshot_state(state: ipc.SnapshotState) -> bytes:
+    """ Encode the state in compact format, e.g. to be stored as a per-node manifest shard """
+    return encode_snapshot_files(root_globs=state.root_globs, files=state.files)
+
+
+def encode_snapshot_files(*, root_globs: List[str], files: Iterable[ipc.SnapshotFile]) -> bytes:
+    """ Same as encode_snapshot_state, but the files may be produced one at a time """
+    header = {COMPACT_MANIFEST_KEY: COMPACT_MANIFEST_VERSION, "root_globs": root_globs}
+    columns = [json.dumps(header).encode()] + _encode_columns([], files)
+    return zlib.compress(_join_columns(columns))
+
+
+def _join_columns(columns: List[bytes]) -> bytes:
+    return b"".join(_LENGTH.pack(len(column)) + column for column in columns)
+
+
+def _iter_columns(data: bytes) -> Iterator[bytes]:
+    offset = 0
+    while offset < len(data):
+        (length, ) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        yield data[offset:offset + length]
+        offset += length
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # Creating millions of (long-lived) objects would otherwise trigger
+    # many full garbage collections, which dominate the parsing time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _check_version(version):
+    if version != COMPACT_MANIFEST_VERSION:
+        raise exceptions.PermanentException(f"Unsupported compact manifest version {version!r}")
+
+
+def parse_backup_manifest(data: dict) -> ipc.BackupManifest:
+    """ Parse manifest (downloaded with download_json) in either plain json or compact format """
+    with _gc_paused():
+        if COMPACT_MANIFEST_KEY not in data:
+            return ipc.BackupManifest.parse_obj(data)
+        _check_version(data[COMPACT_MANIFEST_KEY])
+        columns = _iter_columns(zlib.decompress(base64.b64decode(data["data"])))
+        manifest = ipc.BackupManifest.parse_raw(next(columns))
+        for result in manifest.snapshot_results:
+            _decode_result_columns(result, columns)
+        return manifest
+
+
+def parse_snapshot_state(data: bytes) -> ipc.SnapshotState:
+    """ Parse state encoded with encode_snapshot_state """
+    with _gc_paused():
+        columns = _iter_columns(zlib.decompress(data))
+        header = json.loads(next(columns))
+        _check_version(header[COMPACT_MANIFEST_KEY])
+        result = ipc.SnapshotResult(state=ipc.SnapshotState(root_globs=header["root_globs"], files=[]))
+        _decode_result_columns(result, columns)
+        assert result.state is not None
+        return result.state
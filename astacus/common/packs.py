@@ -0,0 +1,57 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Pack objects.
+
+Storing every small file as an object of its own makes request
+overhead dominate both backup and restore. Instead, small hexdigests
+can be concatenated to pack objects. A pack is stored like any other
+hexdigest (named after the hash of its own content), and its index
+(ipc.SnapshotPack) is stored as json next to the backup manifests.
+Backup manifests list the packs that contained their hexdigests when
+they were made, but as cleanup may replace mostly unused packs with
+smaller ones (without touching the immutable manifests), the pack
+indexes are what is used to find the packed hexdigests.
+
+"""
+
+from astacus.common import ipc, magic
+from typing import Dict, Tuple
+
+import hashlib
+import io
+
+_hash = hashlib.blake2s
+
+
+def pack_json_name(pack_hexdigest: str) -> str:
+    return f"{magic.JSON_PACK_PREFIX}{pack_hexdigest}"
+
+
+class PackBuilder:
+    def __init__(self):
+        self._data = io.BytesIO()
+        self.entries = []
+
+    @property
+    def size(self) -> int:
+        return self._data.tell()
+
+    def add(self, hexdigest: str, data: bytes):
+        self.entries.append(ipc.SnapshotPackEntry(hexdigest=hexdigest, offset=self.size, size=len(data)))
+        self._data.write(data)
+
+    def build(self) -> Tuple[ipc.SnapshotPack, bytes]:
+        data = self._data.getvalue()
+        return ipc.SnapshotPack(hexdigest=_hash(data).hexdigest(), size=len(data), entries=self.entries), data
+
+
+def get_pack_entry_data(data: bytes, entry: ipc.SnapshotPackEntry) -> bytes:
+    return data[entry.offset:entry.offset + entry.size]
+
+
+def hexdigest_to_pack_entry(packs) -> Dict[str, Tuple[ipc.SnapshotPack, ipc.SnapshotPackEntry]]:
+    """ Map hexdigests to the packs (and entries within them) containing them """
+    return {entry.hexdigest: (pack, entry) for pack in packs for entry in pack.entries}
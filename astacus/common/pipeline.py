@@ -0,0 +1,87 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Staged processing of readable streams.
+
+Each stage reads its source stream in a thread of its own, and passes
+the chunks it read to the next stage through a bounded queue. Chained
+with streams that process data as it is read (e.g. rohmu's compression
+and encryption streams), this lets reading, compressing, encrypting
+and sending the data all run concurrently, while the amount of data
+in flight stays bounded.
+
+"""
+
+import queue
+import threading
+
+
+class StagedReader:
+    """Readable file wrapper which reads src in a separate thread
+
+    The thread reads at most queue_size chunks of chunk_size bytes
+    ahead of the consumer. Exceptions raised by src are re-raised in
+    the consumer.
+    """
+    def __init__(self, src, *, chunk_size: int = 2 ** 20, queue_size: int = 4, name: str = "stage"):
+        self._src = src
+        self._chunk_size = chunk_size
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._remainder = b""
+        self._eof = False
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                data = self._src.read(self._chunk_size)
+                if not self._put(data) or not data:
+                    return
+        except Exception as ex:  # pylint: disable=broad-except
+            self._put(ex)
+
+    def read(self, n=-1):
+        # Like regular files, short reads happen only at the end of
+        # the stream (e.g. s3 multipart upload parts depend on this)
+        chunks = [self._remainder]
+        size = len(self._remainder)
+        while not self._eof and (n is None or n < 0 or size < n):
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                break
+            chunks.append(item)
+            size += len(item)
+        data = b"".join(chunks)
+        if n is None or n < 0:
+            self._remainder = b""
+            return data
+        self._remainder = data[n:]
+        return data[:n]
+
+    def close(self):
+        """ Stop the reading thread (if it is still running) and wait for it """
+        self._closed.set()
+        self._thread.join()
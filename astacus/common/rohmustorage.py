@@ -7,25 +7,44 @@ Rohmu-specific actual object storage implementation
 
 """
 
-from .storage import MultiStorage, Storage, StorageUploadResult
+from .pipeline import StagedReader
+from .storage import hexdigest_shards, MultiStorage, Storage, StorageUploadResult
 from .utils import AstacusModel
-from astacus.common import exceptions
+from astacus.common import exceptions, utils
 from enum import Enum
 from pghoard import rohmu  # type: ignore
 from pghoard.rohmu import rohmufile  # type: ignore
 from pghoard.rohmu import errors
+from pghoard.rohmu.compressor import CompressionStream, zstd  # type: ignore
+from pghoard.rohmu.encryptor import Decryptor, EncryptorError, EncryptorStream  # type: ignore
+from pghoard.rohmu.filewrap import Sink  # type: ignore
+from pghoard.rohmu.object_storage.base import KEY_TYPE_PREFIX  # type: ignore
 from pydantic import DirectoryPath, Field
-from typing import Dict, Optional, Union
+from typing import Callable, Dict, Optional, Tuple, Union
 from typing_extensions import Literal
 
+import contextlib
 import io
+import itertools
 import json
 import logging
 import os
+import requests
+import shutil
+import socket
 import tempfile
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Most keys single S3 DeleteObjects request may contain
+S3_DELETE_BATCH_SIZE = 1000
+
+# Hexdigests (and therefore the object names under the hexdigest key)
+# consist of these characters
+HEXDIGEST_CHARS = "0123456789abcdef"
+
 
 class RohmuStorageType(str, Enum):
     """ Embodies what is detected in rohmu.get_class_for_transfer """
@@ -98,7 +117,18 @@ class RohmuCompressionType(Enum):
 class RohmuCompression(RohmuModel):
     algorithm: Optional[RohmuCompressionType] = None
     level: int = 0
-    # threads: int = 0
+    # If set, zstd compresses each object using this many worker
+    # threads (-1 = number of CPUs); the result is still single frame
+    threads: int = 0
+
+    # If set (and encryption is configured), samples of each object
+    # are compressed first, and if they do not compress to at most
+    # this fraction of their size, the object is stored uncompressed
+    incompressible_ratio: float = 0
+    # How many bytes are sampled (in total, from up to sample_count
+    # evenly spaced locations of the object)
+    sample_size: int = 2 ** 16
+    sample_count: int = 4
 
 
 class RohmuConfig(RohmuModel):
@@ -115,12 +145,181 @@ class RohmuConfig(RohmuModel):
     # Compression (optional)
     compression: RohmuCompression = RohmuCompression()
 
+    # If set, uploaded objects are compressed and encrypted on the fly
+    # while uploading them, instead of first writing them to a
+    # temporary file in temporary_directory
+    streaming_uploads: bool = False
+
+    # If set, new hexdigests are stored in a sharded key layout, with
+    # this many levels of hexdigest_shard_width character prefixes
+    # (e.g. with depth 2, data/ab/cd/abcd..), instead of flat
+    # data/abcd.. keys. Existing flat keys are still found, and they
+    # can be moved to the sharded layout with the coordinator migrate
+    # operation.
+    hexdigest_shard_depth: int = 0
+    hexdigest_shard_width: int = 2
+
+    # How many prefixes are listed in parallel. Object storages (i.e.
+    # everything but local) are listed by hexdigest prefixes of
+    # list_prefix_length characters, which works for both the flat and
+    # the sharded layout; local storage by its shard directories.
+    list_parallel: int = 8
+    list_prefix_length: int = 1
+
+    # If set, uploads of objects at least this large are pipelined:
+    # reading, compression and encryption each run in a thread of their
+    # own, connected by queues of at most pipeline_queue_size chunks of
+    # pipeline_chunk_size bytes, concurrently with the upload itself
+    pipeline_min_size: int = 0
+    pipeline_chunk_size: int = 2 ** 20
+    pipeline_queue_size: int = 4
+
 
 class RohmuMetadata(RohmuModel):
     encryption_key_id: Optional[str] = Field(None, alias="encryption-key-id")
     compression_algorithm: Optional[RohmuCompressionType] = Field(None, alias="compression-algorithm")
 
 
+class ThreadedCompressionStream(CompressionStream):
+    """CompressionStream which compresses zstd using multiple threads
+
+    (zstd is the zstandard module rohmu imported, if it is available)
+    """
+    def __init__(self, src_fp, algorithm, level=0, threads=0):
+        super().__init__(src_fp, algorithm, level)
+        # With use_enum_values, the configured algorithm is plain string
+        if RohmuCompressionType(algorithm) == RohmuCompressionType.zstd and threads:
+            self._compressor = zstd.ZstdCompressor(level=level, threads=threads).compressobj()
+
+
+class CountingReader:
+    """ Readable file wrapper which counts (and optionally reports) the bytes read through it """
+    def __init__(self, f, *, callback: Optional[Callable[[int], None]] = None):
+        self._f = f
+        self._callback = callback
+        self.size = 0
+
+    def read(self, n=-1):
+        data = self._f.read(n)
+        self.size += len(data)
+        if self._callback is not None:
+            self._callback(len(data))
+        return data
+
+
+class ReportingWriter:
+    """ Writable file wrapper which reports the bytes written through it """
+    def __init__(self, f, *, callback: Callable[[int], None]):
+        self._f = f
+        self._callback = callback
+
+    def write(self, data):
+        self._callback(len(data))
+        return self._f.write(data)
+
+
+class StreamingDecryptSink(Sink):
+    """Decrypting sink which, unlike rohmu DecryptSink, need not know the size of the object
+
+    The footer (MAC) is at the end of the data, so that many bytes are
+    held back until finish() is called after the last write.
+    """
+    def __init__(self, next_sink, key_data):
+        super().__init__(next_sink)
+        self.decryptor = Decryptor(key_data)
+        self.header = b""
+        self.pending = b""
+
+    def write(self, data):
+        written = len(data)
+        if self.decryptor.expected_header_bytes():
+            data = self.header + data
+            while self.decryptor.expected_header_bytes():
+                header_bytes = self.decryptor.expected_header_bytes()
+                if len(data) < header_bytes:
+                    self.header = data
+                    return written
+                self.decryptor.process_header(data[:header_bytes])
+                data = data[header_bytes:]
+            self.header = b""
+        data = self.pending + data
+        footer_size = self.decryptor.footer_size()
+        self.pending = data[-footer_size:]
+        data = data[:-footer_size]
+        if data:
+            self._write_to_next_sink(self.decryptor.process_data(data))
+        return written
+
+    def finish(self):
+        if self.decryptor.expected_header_bytes() or len(self.pending) != self.decryptor.footer_size():
+            raise EncryptorError("Encrypted object is truncated")
+        final_data = self.decryptor.finalize(self.pending)
+        if final_data:
+            self._write_to_next_sink(final_data)
+
+
+# Exception class names (of the optional object storage client
+# libraries, which are not necessarily installed) that indicate
+# network level problems
+_TRANSIENT_EXCEPTION_CLASS_NAMES = {
+    # botocore
+    "HTTPClientError",
+    "EndpointConnectionError",
+    "ConnectionClosedError",
+    "ReadTimeoutError",
+    "ConnectTimeoutError",
+    # azure-core
+    "ServiceRequestError",
+    "ServiceResponseError",
+}
+
+# Error codes (from e.g. S3) that indicate throttling or temporary unavailability
+_TRANSIENT_ERROR_CODES = {
+    "InternalError",
+    "RequestLimitExceeded",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
+
+
+def _get_status_code(ex) -> Optional[int]:
+    response = getattr(ex, "response", None)
+    if isinstance(response, dict):  # botocore
+        status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    elif response is not None:  # requests
+        status_code = getattr(response, "status_code", None)
+    elif getattr(ex, "resp", None) is not None:  # googleapiclient
+        status_code = getattr(ex.resp, "status", None)
+    else:  # azure
+        status_code = getattr(ex, "status_code", None)
+    try:
+        return int(status_code) if status_code is not None else None
+    except ValueError:
+        return None
+
+
+def is_transient_error(ex: Optional[BaseException]) -> bool:
+    """ Determine (on best effort basis) if the exception (or its cause) is likely to go away if retried """
+    seen = set()
+    while ex is not None and id(ex) not in seen:
+        seen.add(id(ex))
+        if isinstance(ex, (ConnectionError, TimeoutError, socket.timeout, requests.ConnectionError, requests.Timeout)):
+            return True
+        if _TRANSIENT_EXCEPTION_CLASS_NAMES.intersection(cls.__name__ for cls in type(ex).__mro__):
+            return True
+        status_code = _get_status_code(ex)
+        if status_code is not None and (status_code in (408, 429) or status_code >= 500):
+            return True
+        response = getattr(ex, "response", None)
+        if isinstance(response, dict) and response.get("Error", {}).get("Code") in _TRANSIENT_ERROR_CODES:
+            return True
+        ex = ex.__cause__ or ex.__context__
+    return False
+
+
 def rohmu_error_wrapper(fun):
     """ Wrap rohmu exceptions in astacus ones; to be seen what is complete set """
     def _f(*a, **kw):
@@ -129,6 +328,8 @@ def rohmu_error_wrapper(fun):
         except errors.FileNotFoundFromStorageError as ex:
             raise exceptions.NotFoundException from ex
         except Exception as ex:  # pylint: disable=broad-except
+            if is_transient_error(ex):
+                raise exceptions.TransientRohmuException from ex
             raise exceptions.RohmuException from ex
 
     return _f
@@ -148,28 +349,136 @@ class RohmuStorage(Storage):
 
     @rohmu_error_wrapper
     def _download_key_to_file(self, key, f) -> bool:
-        raw_metadata: dict = self.storage.get_metadata_for_key(key)
-        with tempfile.TemporaryFile(dir=self.config.temporary_directory) as temp_file:
-            self.storage.get_contents_to_fileobj(key, temp_file)
-            temp_file.seek(0)
-            rohmufile.read_file(
-                input_obj=temp_file,
-                output_obj=f,
-                metadata=raw_metadata,
-                key_lookup=self._private_key_lookup,
-                log_func=logger.debug
-            )
+        # The object is decrypted and decompressed as it is being
+        # downloaded, and written directly to f. Decryption does not
+        # need the object size (which would take another request).
+        metadata = dict(self.storage.get_metadata_for_key(key))
+        key_id = metadata.pop("encryption-key-id", None)
+        sink = rohmufile.create_sink_pipeline(output=f, metadata=metadata, throttle_time=0)
+        decrypt_sink = None
+        if key_id:
+            sink = decrypt_sink = StreamingDecryptSink(sink, self._private_key_lookup(key_id))
+        if self.network_callback is not None:
+            # Charged as downloaded, i.e. before decryption and decompression
+            sink = ReportingWriter(sink, callback=self.network_callback)
+        self.storage.get_contents_to_fileobj(key, sink)
+        if decrypt_sink is not None:
+            decrypt_sink.finish()
         return True
 
     def _list_key(self, key):
         return [os.path.basename(o["name"]) for o in self.storage.list_iter(key, with_metadata=False)]
 
+    @rohmu_error_wrapper
+    def _list_sharded_key(self, key):
+        """List key, and all (shard) prefixes within it, in parallel
+
+        Object names are returned without the prefixes; if an object
+        exists in more than one place, it is returned only once.
+        """
+        names = set()
+        if self.storage_config.storage_type == RohmuStorageType.local:
+            # Local storage cannot list by partial names, so its flat
+            # objects are listed at once, and then the shard directories
+            prefixes = []
+            for item in self.storage.iter_key(key, with_metadata=False):
+                if item.type == KEY_TYPE_PREFIX:
+                    prefixes.append(item.value)
+                else:
+                    names.add(os.path.basename(item.value["name"]))
+            include_key = False
+        else:
+            prefixes = [
+                os.path.join(key, "".join(chars))
+                for chars in itertools.product(HEXDIGEST_CHARS, repeat=self.config.list_prefix_length)
+            ]
+            include_key = True
+        if prefixes:
+            threadlocal = threading.local()
+
+            def _list_prefix(prefix):
+                # Transfer objects are not necessarily thread-safe
+                transfer = getattr(threadlocal, "transfer", None)
+                if transfer is None:
+                    transfer = threadlocal.transfer = rohmu.get_transfer(self.storage_config.dict())
+                return [
+                    os.path.basename(item.value["name"])
+                    for item in transfer.iter_key(prefix, with_metadata=False, deep=True, include_key=include_key)
+                    if item.type != KEY_TYPE_PREFIX
+                ]
+
+            def _result_cb(*, map_in, map_out):
+                names.update(map_out)
+                return True
+
+            utils.parallel_map_to(
+                fun=_list_prefix, iterable=prefixes, result_callback=_result_cb, n=self.config.list_parallel
+            )
+        return list(names)
+
+    @rohmu_error_wrapper
+    def _list_flat_key(self, key):
+        # Only the objects directly under the key, not the ones within (shard) prefixes
+        return [
+            os.path.basename(item.value["name"])
+            for item in self.storage.iter_key(key, with_metadata=False)
+            if item.type != KEY_TYPE_PREFIX
+        ]
+
+    def _hexdigest_to_key(self, hexdigest, *, sharded=True):
+        shards = []
+        if sharded:
+            shards = hexdigest_shards(
+                hexdigest, depth=self.config.hexdigest_shard_depth, width=self.config.hexdigest_shard_width
+            )
+        return os.path.join(self.hexdigest_key, *shards, hexdigest)
+
+    def _call_with_hexdigest_key(self, fun, hexdigest):
+        """ Call fun with the hexdigest's key; if the key is sharded but the object is not found, with the flat key """
+        key = self._hexdigest_to_key(hexdigest)
+        flat_key = self._hexdigest_to_key(hexdigest, sharded=False)
+        if key == flat_key:
+            return fun(key)
+        try:
+            return fun(key)
+        except exceptions.NotFoundException:
+            pass
+        try:
+            return fun(flat_key)
+        except exceptions.NotFoundException:
+            # Migration (which runs without the cluster lock) may have
+            # moved it to the sharded key in between
+            return fun(key)
+
     def _private_key_lookup(self, key_id: str) -> str:
         return self.config.encryption_keys[key_id].private
 
     def _public_key_lookup(self, key_id: str) -> str:
         return self.config.encryption_keys[key_id].public
 
+    def _sample_compression(self, f, plain_size) -> Tuple[float, float]:
+        """Compress samples of f with the configured compression
+
+        Returns the compression ratio of the samples, and estimate of
+        the CPU seconds compressing all of f would take.
+        """
+        compression = self.config.compression
+        count = max(1, min(compression.sample_count, plain_size // max(1, compression.sample_size)))
+        sample_size = compression.sample_size // count
+        sampled_size = compressed_size = 0
+        start = time.thread_time()
+        for i in range(count):
+            f.seek(plain_size * i // count)
+            data = f.read(sample_size)
+            stream = CompressionStream(io.BytesIO(data), compression.algorithm, compression.level)
+            compressed_size += len(stream.read())
+            sampled_size += len(data)
+        elapsed = time.thread_time() - start
+        f.seek(0)
+        if not sampled_size:
+            return 0.0, 0.0
+        return compressed_size / sampled_size, elapsed * plain_size / sampled_size - elapsed
+
     @rohmu_error_wrapper
     def _upload_key_from_file(self, key, f) -> StorageUploadResult:
         encryption_key_id = self.config.encryption_key_id
@@ -179,26 +488,63 @@ class RohmuStorage(Storage):
         if encryption_key_id:
             metadata.encryption_key_id = encryption_key_id
             rsa_public_key = self._public_key_lookup(encryption_key_id)
-        if compression.algorithm:
-            metadata.compression_algorithm = compression.algorithm
-        rohmu_metadata = metadata.dict(exclude_defaults=True, by_alias=True)
         plain_size = f.seek(0, 2)
         f.seek(0)
-        with tempfile.TemporaryFile(dir=self.config.temporary_directory) as temp_file:
-            rohmufile.write_file(
-                input_obj=f,
-                output_obj=temp_file,
-                compression_algorithm=compression.algorithm,
-                compression_level=compression.level,
-                rsa_public_key=rsa_public_key,
-                log_func=logger.debug
-            )
-            # compression_threads=compression.threads, # I wish
-            # currently not supported by write_file API
-            compressed_size = temp_file.tell()
-            temp_file.seek(0)
-            self.storage.store_file_object(key, temp_file, metadata=rohmu_metadata)
-        return StorageUploadResult(size=plain_size, stored_size=compressed_size)
+        compression_algorithm = compression.algorithm
+        compression_skipped_seconds = 0.0
+        if compression_algorithm and compression.incompressible_ratio and rsa_public_key:
+            ratio, seconds = self._sample_compression(f, plain_size)
+            if ratio > compression.incompressible_ratio:
+                # Lack of compression-algorithm in the metadata tells
+                # the readers that the object is not compressed
+                compression_algorithm = None
+                compression_skipped_seconds = max(seconds, 0.0)
+        if compression_algorithm:
+            metadata.compression_algorithm = compression_algorithm
+        rohmu_metadata = metadata.dict(exclude_defaults=True, by_alias=True)
+        result_kw = {
+            "size": plain_size,
+            "compression_skipped": bool(compression.algorithm and not compression_algorithm),
+            "compression_skipped_seconds": compression_skipped_seconds,
+        }
+        staged = bool(self.config.pipeline_min_size) and plain_size >= self.config.pipeline_min_size
+        with contextlib.ExitStack() as stack:
+
+            def _stage(stream, name):
+                if not staged:
+                    return stream
+                return stack.enter_context(
+                    StagedReader(
+                        stream,
+                        chunk_size=self.config.pipeline_chunk_size,
+                        queue_size=self.config.pipeline_queue_size,
+                        name=f"upload-{name}"
+                    )
+                )
+
+            stream = _stage(f, "read")
+            if compression_algorithm:
+                stream = _stage(
+                    ThreadedCompressionStream(stream, compression_algorithm, compression.level, compression.threads),
+                    "compress"
+                )
+            if rsa_public_key:
+                stream = _stage(EncryptorStream(stream, rsa_public_key), "encrypt")
+            if self.config.streaming_uploads:
+                # The backends read the file object in bounded chunks (and
+                # e.g. s3 uploads it as multipart upload), so the memory
+                # usage is bounded too
+                counting_stream = CountingReader(stream, callback=self.network_callback)
+                self.storage.store_file_object(key, counting_stream, metadata=rohmu_metadata)
+                stored_size = counting_stream.size
+            else:
+                with tempfile.TemporaryFile(dir=self.config.temporary_directory) as temp_file:
+                    shutil.copyfileobj(stream, temp_file, self.config.pipeline_chunk_size)
+                    stored_size = temp_file.tell()
+                    temp_file.seek(0)
+                    self._network_transferred(stored_size)
+                    self.storage.store_file_object(key, temp_file, metadata=rohmu_metadata)
+        return StorageUploadResult(stored_size=stored_size, **result_kw)
 
     storage_name: str = ""
 
@@ -210,24 +556,75 @@ class RohmuStorage(Storage):
         self.storage = rohmu.get_transfer(self.storage_config.dict())
 
     def copy(self):
-        return RohmuStorage(config=self.config, storage=self.storage_name)
+        storage = RohmuStorage(config=self.config, storage=self.storage_name)
+        storage.network_callback = self.network_callback
+        return storage
 
     # HexDigestStorage implementation
 
     @rohmu_error_wrapper
-    def delete_hexdigest(self, hexdigest):
-        key = os.path.join(self.hexdigest_key, hexdigest)
+    def _delete_key(self, key):
         self.storage.delete_key(key)
 
+    def delete_hexdigest(self, hexdigest):
+        self._call_with_hexdigest_key(self._delete_key, hexdigest)
+
+    def delete_hexdigests(self, hexdigests):
+        if getattr(self.storage, "s3_client", None) is None:
+            # Other backends have no batch delete (that rohmu would expose)
+            super().delete_hexdigests(hexdigests)
+            return
+        # Deleting nonexistent keys is not an error, so also the flat
+        # keys are deleted, instead of checking where the objects are
+        keys = set()
+        for hexdigest in hexdigests:
+            keys.add(self._hexdigest_to_key(hexdigest))
+            keys.add(self._hexdigest_to_key(hexdigest, sharded=False))
+        self._delete_s3_keys(sorted(keys))
+
+    @rohmu_error_wrapper
+    def _delete_s3_objects(self, objects):
+        return self.storage.s3_client.delete_objects(
+            Bucket=self.storage.bucket_name, Delete={
+                "Objects": objects,
+                "Quiet": True
+            }
+        )
+
+    def _delete_s3_keys(self, keys):
+        for i in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            objects = [{
+                "Key": self.storage.format_key_for_backend(key, remove_slash_prefix=True)
+            } for key in keys[i:i + S3_DELETE_BATCH_SIZE]]
+            failed = self._delete_s3_objects(objects).get("Errors")
+            if failed:
+                message = f"Deleting {len(failed)} keys failed, e.g. {failed[0]!r}"
+                if all(error.get("Code") in _TRANSIENT_ERROR_CODES for error in failed):
+                    raise exceptions.TransientRohmuException(message)
+                raise exceptions.RohmuException(message)
+
     def list_hexdigests(self):
-        return self._list_key(self.hexdigest_key)
+        return self._list_sharded_key(self.hexdigest_key)
+
+    def list_unsharded_hexdigests(self):
+        return [
+            hexdigest for hexdigest in self._list_flat_key(self.hexdigest_key)
+            if self._hexdigest_to_key(hexdigest) != self._hexdigest_to_key(hexdigest, sharded=False)
+        ]
+
+    @rohmu_error_wrapper
+    def migrate_hexdigest(self, hexdigest):
+        # The stored (compressed and encrypted) object and its metadata
+        # are copied as-is within the object storage
+        flat_key = self._hexdigest_to_key(hexdigest, sharded=False)
+        self.storage.copy_file(source_key=flat_key, destination_key=self._hexdigest_to_key(hexdigest))
+        self.storage.delete_key(flat_key)
 
     def download_hexdigest_to_file(self, hexdigest, f) -> bool:
-        key = os.path.join(self.hexdigest_key, hexdigest)
-        return self._download_key_to_file(key, f)
+        return self._call_with_hexdigest_key(lambda key: self._download_key_to_file(key, f), hexdigest)
 
     def upload_hexdigest_from_file(self, hexdigest, f) -> StorageUploadResult:
-        key = os.path.join(self.hexdigest_key, hexdigest)
+        key = self._hexdigest_to_key(hexdigest)
         return self._upload_key_from_file(key, f)
 
     # JsonStorage implementation
@@ -240,8 +637,7 @@ class RohmuStorage(Storage):
         key = os.path.join(self.json_key, name)
         f = io.BytesIO()
         self._download_key_to_file(key, f)
-        f.seek(0)
-        return json.load(f)
+        return json.loads(f.getvalue())
 
     def list_jsons(self):
         return self._list_key(self.json_key)
@@ -8,6 +8,7 @@ See LICENSE for details
 from .exceptions import NotFoundException
 from .utils import AstacusModel
 from pathlib import Path
+from typing import Callable, List, Optional
 
 import io
 import json
@@ -22,14 +23,51 @@ class StorageUploadResult(AstacusModel):
     size: int
     stored_size: int
 
+    # Set if the data was stored uncompressed as it was not
+    # compressible; then, the estimated CPU time saved by doing so
+    compression_skipped: bool = False
+    compression_skipped_seconds: float = 0
+
+
+def hexdigest_shards(hexdigest: str, *, depth: int, width: int) -> List[str]:
+    """Return the shard prefixes of hexdigest in sharded layout
+
+    For example with depth 2 and width 2, abcdef is stored as ab/cd/abcdef.
+    Hexdigests that are too short to be sharded are stored flat.
+    """
+    if len(hexdigest) <= depth * width:
+        return []
+    return [hexdigest[i * width:(i + 1) * width] for i in range(depth)]
+
 
 class HexDigestStorage:
+    # If set, called with the number of bytes of hexdigest data
+    # transferred to or from the storage, as stored (i.e. after
+    # compression and encryption); copies share it
+    network_callback: Optional[Callable[[int], None]] = None
+
     def copy(self):
         raise NotImplementedError
 
+    def _network_transferred(self, size: int):
+        if self.network_callback is not None:
+            self.network_callback(size)
+
     def delete_hexdigest(self, hexdigest):
         raise NotImplementedError
 
+    def delete_hexdigests(self, hexdigests: List[str]):
+        """Delete the hexdigests, with as few requests as the storage allows
+
+        Hexdigests which do not exist (e.g. deleted already by an earlier
+        attempt) are ignored.
+        """
+        for hexdigest in hexdigests:
+            try:
+                self.delete_hexdigest(hexdigest)
+            except NotFoundException:
+                pass
+
     def download_hexdigest_bytes(self, hexdigest):
         b = io.BytesIO()
         self.download_hexdigest_to_file(hexdigest, b)
@@ -48,6 +86,26 @@ class HexDigestStorage:
     def list_hexdigests(self):
         raise NotImplementedError
 
+    def list_unsharded_hexdigests(self):
+        """ List hexdigests which are not (yet) stored in the configured sharded layout """
+        raise NotImplementedError
+
+    def migrate_hexdigest(self, hexdigest):
+        """ Move hexdigest from the flat layout to the sharded one """
+        raise NotImplementedError
+
+    def migrate_hexdigests(self, hexdigests: List[str]):
+        """Move the hexdigests from the flat layout to the sharded one
+
+        Hexdigests which are no longer in the flat layout (e.g. moved
+        already by an earlier attempt, or deleted) are ignored.
+        """
+        for hexdigest in hexdigests:
+            try:
+                self.migrate_hexdigest(hexdigest)
+            except NotFoundException:
+                pass
+
     def upload_hexdigest_bytes(self, hexdigest, data) -> StorageUploadResult:
         return self.upload_hexdigest_from_file(hexdigest, io.BytesIO(data))
 
@@ -100,17 +158,43 @@ def file_error_wrapper(fun):
 
 class FileStorage(Storage):
     """ Implementation of the storage API, which just handles files - primarily useful for testing """
-    def __init__(self, path, *, hexdigest_suffix=".dat", json_suffix=".json"):
+    def __init__(
+        self, path, *, hexdigest_suffix=".dat", json_suffix=".json", hexdigest_shard_depth=0, hexdigest_shard_width=2
+    ):
         self.path = Path(path)
         self.path.mkdir(parents=True, exist_ok=True)
         self.hexdigest_suffix = hexdigest_suffix
         self.json_suffix = json_suffix
+        self.hexdigest_shard_depth = hexdigest_shard_depth
+        self.hexdigest_shard_width = hexdigest_shard_width
 
     def copy(self):
-        return FileStorage(path=self.path, hexdigest_suffix=self.hexdigest_suffix, json_suffix=self.json_suffix)
-
-    def _hexdigest_to_path(self, hexdigest):
-        return self.path / f"{hexdigest}{self.hexdigest_suffix}"
+        storage = FileStorage(
+            path=self.path,
+            hexdigest_suffix=self.hexdigest_suffix,
+            json_suffix=self.json_suffix,
+            hexdigest_shard_depth=self.hexdigest_shard_depth,
+            hexdigest_shard_width=self.hexdigest_shard_width
+        )
+        storage.network_callback = self.network_callback
+        return storage
+
+    def _hexdigest_to_path(self, hexdigest, *, sharded=True):
+        path = self.path
+        if sharded:
+            path = path.joinpath(
+                *hexdigest_shards(hexdigest, depth=self.hexdigest_shard_depth, width=self.hexdigest_shard_width)
+            )
+        return path / f"{hexdigest}{self.hexdigest_suffix}"
+
+    def _existing_hexdigest_path(self, hexdigest):
+        # Hexdigests stored before sharding was configured are still in the flat layout
+        path = self._hexdigest_to_path(hexdigest)
+        if not path.exists():
+            flat_path = self._hexdigest_to_path(hexdigest, sharded=False)
+            if flat_path.exists():
+                return flat_path
+        return path
 
     def _json_to_path(self, name):
         return self.path / f"{name}{self.json_suffix}"
@@ -118,7 +202,7 @@ class FileStorage(Storage):
     @file_error_wrapper
     def delete_hexdigest(self, hexdigest):
         logger.debug("delete_hexdigest %r", hexdigest)
-        self._hexdigest_to_path(hexdigest).unlink()
+        self._existing_hexdigest_path(hexdigest).unlink()
 
     def _list(self, suffix):
         results = [p.stem for p in self.path.iterdir() if p.suffix == suffix]
@@ -126,19 +210,41 @@ class FileStorage(Storage):
         return results
 
     def list_hexdigests(self):
-        return self._list(self.hexdigest_suffix)
+        # Both flat and sharded layout
+        results = set()
+        for _, _, filenames in os.walk(self.path):
+            results.update(p.stem for p in map(Path, filenames) if p.suffix == self.hexdigest_suffix)
+        logger.debug("list_hexdigests => %d", len(results))
+        return list(results)
+
+    def list_unsharded_hexdigests(self):
+        return [
+            hexdigest for hexdigest in self._list(self.hexdigest_suffix)
+            if self._hexdigest_to_path(hexdigest) != self._hexdigest_to_path(hexdigest, sharded=False)
+        ]
+
+    @file_error_wrapper
+    def migrate_hexdigest(self, hexdigest):
+        logger.debug("migrate_hexdigest %r", hexdigest)
+        path = self._hexdigest_to_path(hexdigest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(self._hexdigest_to_path(hexdigest, sharded=False), path)
 
     @file_error_wrapper
     def download_hexdigest_to_file(self, hexdigest, f) -> bool:
         logger.debug("download_hexdigest_to_file %r", hexdigest)
-        path = self._hexdigest_to_path(hexdigest)
-        f.write(path.read_bytes())
+        path = self._existing_hexdigest_path(hexdigest)
+        data = path.read_bytes()
+        self._network_transferred(len(data))
+        f.write(data)
         return True
 
     def upload_hexdigest_from_file(self, hexdigest, f) -> StorageUploadResult:
         logger.debug("upload_hexdigest_from_file %r", hexdigest)
         path = self._hexdigest_to_path(hexdigest)
+        path.parent.mkdir(parents=True, exist_ok=True)
         data = f.read()
+        self._network_transferred(len(data))
         path.write_bytes(data)
         return StorageUploadResult(size=len(data), stored_size=len(data))
 
@@ -0,0 +1,53 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Token bucket rate limiting, used e.g. for the node I/O budgets and the
+coordinator's object deletions and migrations.
+
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket; rate of 0 means unlimited.
+
+    At most one second worth of tokens is accumulated. Consumers may
+    go into debt (e.g. when consuming more than rate at once), in which
+    case they wait until the debt would be paid off at current rate.
+    """
+    def __init__(self, rate: int = 0, *, time_fun=time.monotonic, sleep_fun=time.sleep):
+        self.lock = threading.Lock()
+        self.time_fun = time_fun
+        self.sleep_fun = sleep_fun
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time_fun()
+
+    def _refill(self):
+        now = self.time_fun()
+        if self.rate:
+            self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: int):
+        with self.lock:
+            self._refill()
+            # Unlimited bucket is considered full
+            self.tokens = min(self.tokens, float(rate)) if self.rate else float(rate)
+            self.rate = rate
+
+    def consume(self, amount: int) -> float:
+        """ Consume amount tokens, waiting if necessary; returns the time waited """
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep_fun(wait)
+        return wait
@@ -20,6 +20,7 @@ import httpx
 import json as _json
 import logging
 import os
+import random
 import requests
 import time
 
@@ -120,12 +121,16 @@ async def httpx_request(url, *, caller, method="get", timeout=10, json: bool = T
         return None
 
 
-def exponential_backoff(*, initial, retries=None, multiplier=2, maximum=None, duration=None, event_awaitable_factory=None):
+def exponential_backoff(
+    *, initial, retries=None, multiplier=2, maximum=None, duration=None, event_awaitable_factory=None, jitter=0.0
+):
     """Exponential backoff iterator which works with both 'for' and 'async for'
 
     First attempt is never delayed. The delays are only for retries.
     'initial' is the first retry's delay. After that, each retry is
-    multiplier times larger.
+    multiplier times larger. If jitter is set, up to that fraction of
+    each delay is randomly omitted, so that concurrent retriers spread
+    out.
 
     The iteration stops if:
     - retries is exceeded (retries=0 = try only once, although not very useful)
@@ -150,6 +155,8 @@ def exponential_backoff(*, initial, retries=None, multiplier=2, maximum=None, du
             delay = initial * multiplier ** (self.retry - 1)
             if maximum is not None:
                 delay = min(delay, maximum)
+            if jitter:
+                delay *= 1 - jitter * random.random()
             if duration is not None:
                 time_left_after_sleep = (self.initial + duration) - time_now - delay
                 if time_left_after_sleep < 0:
@@ -194,10 +201,13 @@ def exponential_backoff(*, initial, retries=None, multiplier=2, maximum=None, du
 
 
 class SizeLimitedFile:
-    def __init__(self, *, path, file_size):
+    """ Read-only view of file_size bytes starting at offset of the file at path """
+    def __init__(self, *, path, file_size, offset=0):
         self._f = open(path, "rb")
         self._file_size = file_size
-        self.tell = self._f.tell
+        self._offset = offset
+        if offset:
+            self._f.seek(offset)
 
     def __enter__(self):
         return self
@@ -205,8 +215,11 @@ class SizeLimitedFile:
     def __exit__(self, t, v, tb):
         self._f.close()
 
+    def tell(self):
+        return self._f.tell() - self._offset
+
     def read(self, n=None):
-        can_read = max(0, self._file_size - self._f.tell())
+        can_read = max(0, self._file_size - self.tell())
         if n is None:
             n = can_read
         n = min(can_read, n)
@@ -216,7 +229,9 @@ class SizeLimitedFile:
         if whence == os.SEEK_END:
             ofs += self._file_size
             whence = os.SEEK_SET
-        return self._f.seek(ofs, whence)
+        if whence == os.SEEK_SET:
+            ofs += self._offset
+        return self._f.seek(ofs, whence) - self._offset
 
 
 def timedelta_as_short_str(delta):
@@ -7,6 +7,7 @@ from .cleanup import CleanupOp
 from .coordinator import Coordinator
 from .list import list_backups
 from .lockops import LockOps
+from .migrate import MigrateOp
 from .plugins import get_plugin_backup_class, get_plugin_restore_class
 from .state import CachedListResponse
 from astacus.common import ipc
@@ -30,12 +31,16 @@ class OpName(str, Enum):
     restore = "restore"
     unlock = "unlock"
     cleanup = "cleanup"
+    migrate = "migrate"
 
 
 @router.get("/{op_name}/{op_id}")
 def op_status(*, op_name: OpName, op_id: int, c: Coordinator = Depends()):
-    _, op_info = c.get_op_and_op_info(op_id=op_id, op_name=op_name)
-    return {"state": op_info.op_status}
+    op, op_info = c.get_op_and_op_info(op_id=op_id, op_name=op_name)
+    result = {"state": op_info.op_status}
+    if op.progress is not None:
+        result["progress"] = op.progress
+    return result
 
 
 class LockStartResult(Op.StartResult):
@@ -75,22 +80,34 @@ async def restore(*, req: ipc.RestoreRequest = ipc.RestoreRequest(), c: Coordina
     return await c.start_op_async(op_name=OpName.restore, op=op, fun=op.run)
 
 
+def _refresh_list_backups(*, req: ipc.ListRequest, c: Coordinator) -> ipc.ListResponse:
+    try:
+        list_response = list_backups(req=req, json_mstorage=c.json_mstorage, list_index=c.state.list_index)
+        with c.sync_lock:
+            c.state.cached_list_response = CachedListResponse(list_request=req, list_response=list_response)
+        return list_response
+    finally:
+        with c.sync_lock:
+            c.state.cached_list_running = False
+
+
 @router.get("/list")
 def _list_backups(*, req: ipc.ListRequest = ipc.ListRequest(), c: Coordinator = Depends()):
     with c.sync_lock:
         cached_list_response = c.state.cached_list_response
-        if cached_list_response is not None:
+        if cached_list_response is not None and cached_list_response.list_request == req:
             age = time.monotonic() - cached_list_response.timestamp
-            if age < c.config.list_ttl and cached_list_response.list_request == req:
+            if age < c.config.list_ttl:
                 return cached_list_response.list_response
+            # Stale result is returned as is, and refreshed in the background
+            if not c.state.cached_list_running:
+                c.state.cached_list_running = True
+                c.background_tasks.add_task(_refresh_list_backups, req=req, c=c)
+            return cached_list_response.list_response
         if c.state.cached_list_running:
             raise HTTPException(status_code=429, detail="Already caching list result")
         c.state.cached_list_running = True
-    list_response = list_backups(req=req, json_mstorage=c.json_mstorage)
-    with c.sync_lock:
-        c.state.cached_list_response = CachedListResponse(list_request=req, list_response=list_response)
-        c.state.cached_list_running = False
-    return list_response
+    return _refresh_list_backups(req=req, c=c)
 
 
 @router.post("/cleanup")
@@ -99,6 +116,12 @@ async def cleanup(*, req: ipc.CleanupRequest = ipc.CleanupRequest(), c: Coordina
     return await c.start_op_async(op_name=OpName.cleanup, op=op, fun=op.run)
 
 
+@router.post("/migrate")
+async def migrate(*, req: ipc.MigrateRequest = ipc.MigrateRequest(), c: Coordinator = Depends()):
+    op = MigrateOp(c=c, req=req)
+    return await c.start_op_async(op_name=OpName.migrate, op=op, fun=op.run)
+
+
 @router.put("/{op_name}/{op_id}/sub-result")
 async def op_sub_result(*, op_name: OpName, op_id: int, c: Coordinator = Depends()):
     op, _ = c.get_op_and_op_info(op_id=op_id, op_name=op_name)
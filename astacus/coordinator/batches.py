@@ -0,0 +1,97 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Handling of (large numbers of) hexdigests in the object storage in
+parallel batches.
+
+Handling the hexdigests one at a time takes a round trip to the object
+storage each, which adds up to hours with millions of hexdigests.
+Instead they are handled in batches, several batches at a time,
+optionally rate limited to stay within the request rate limits of the
+storage.
+
+The on_handled callback is called after each batch, so that the caller
+can record the progress (or stop by raising an exception).
+
+"""
+
+from .config import HexDigestBatchConfig
+from astacus.common import statsd
+from astacus.common.asyncstorage import AsyncHexDigestStorage
+from astacus.common.progress import increase_worth_reporting, Progress
+from astacus.common.storage import HexDigestStorage
+from astacus.common.tokenbucket import TokenBucket
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+OnHandled = Callable[[List[str]], Awaitable[None]]
+
+
+class HexDigestBatchProcessor:
+    # Subclass responsibility: what is done to the hexdigests (for logging), and statsd metric names
+    action = ""
+    handled_metric = ""
+    remaining_metric = ""
+
+    def __init__(
+        self,
+        *,
+        storage: HexDigestStorage,
+        config: HexDigestBatchConfig,
+        stats: Optional[statsd.StatsClient] = None,
+        time_fun=time.monotonic
+    ):
+        self.storage = storage
+        self.config = config
+        self.stats = stats
+        # The bucket only tells how long to wait; waiting is done asynchronously
+        self.bucket = TokenBucket(config.hexdigests_per_second, time_fun=time_fun, sleep_fun=lambda _: None)
+        self.progress = Progress()
+
+    async def handle_batch(self, storage: AsyncHexDigestStorage, batch: List[str]):
+        raise NotImplementedError
+
+    async def run(self, hexdigests: Iterable[str], *, on_handled: Optional[OnHandled] = None):
+        batch_size = max(self.config.batch_size, 1)
+        ordered = sorted(hexdigests)
+        batches = iter([ordered[i:i + batch_size] for i in range(0, len(ordered), batch_size)])
+        self.progress.start(len(ordered))
+        logger.info("%s %d hexdigests", self.action, len(ordered))
+
+        async def _handle_batches():
+            # Transfers of the storage are not necessarily thread-safe, so each worker has its own
+            storage = AsyncHexDigestStorage(self.storage.copy())
+            for batch in batches:
+                wait = self.bucket.consume(len(batch))
+                if wait:
+                    await asyncio.sleep(wait)
+                await self.handle_batch(storage, batch)
+                if on_handled is not None:
+                    await on_handled(batch)
+                self._batch_handled(len(batch))
+
+        workers = min(max(self.config.parallel, 1), (len(ordered) + batch_size - 1) // batch_size)
+        tasks = [asyncio.ensure_future(_handle_batches()) for _ in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Failure of one worker stops the rest too
+            for task in tasks:
+                task.cancel()
+        self.progress.done()
+
+    def _batch_handled(self, count: int):
+        old_handled = self.progress.handled
+        self.progress.add_success(count, info=f"{self.action}_success")
+        if increase_worth_reporting(old_handled, self.progress.handled, total=self.progress.total):
+            logger.info("%s %d/%d hexdigests", self.action, self.progress.handled, self.progress.total)
+        if self.stats is not None:
+            self.stats.increase(self.handled_metric, count)
+            self.stats.gauge(self.remaining_metric, self.progress.total - self.progress.handled)
@@ -7,9 +7,16 @@ Database cleanup operation
 """
 
 from .coordinator import Coordinator, CoordinatorOpWithClusterLock
+from .deleter import HexDigestDeleter
+from .list import backup_summary_name
+from .refcounts import backup_manifest_hexdigests
 from astacus.common import ipc, magic, utils
+from astacus.common.packs import get_pack_entry_data, pack_json_name, PackBuilder
+from starlette.concurrency import run_in_threadpool
+from typing import List, Set
 
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -40,34 +47,163 @@ class CleanupOp(CoordinatorOpWithClusterLock):
         return [await self.download_backup_manifest(backup) for backup in backups]
 
     async def delete_backups(self, backups):
-        if not backups:
+        if not backups and not self.req.verify:
             logger.debug("delete_backups: nothing to delete")
             return
-        for backup in backups:
+        names = set(await self.json_storage.list_jsons())
+        counted_backups = set()
+        if self.hexdigest_refcounts is not None:
+            counted_backups = await run_in_threadpool(self.hexdigest_refcounts.get_backups)
+        for backup in sorted(backups):
             logger.info("deleting backup %r", backup)
+            hexdigests = None
+            if backup in counted_backups:
+                hexdigests = backup_manifest_hexdigests(await self.download_backup_manifest(backup))
+            # Summary goes first, as backups without one are listed using the manifest
+            summary_name = backup_summary_name(backup)
+            if summary_name in names:
+                await self.json_storage.delete_json(summary_name)
             await self.json_storage.delete_json(backup)
+            self.manifest_cache.invalidate((self.storage_name, backup))
+            self.state.list_index.remove_backup(self.storage_name, backup)
             self.state.cached_list_response = None
+            if hexdigests is not None:
+                assert self.hexdigest_refcounts is not None
+                await run_in_threadpool(self.hexdigest_refcounts.remove_backup, backup, hexdigests)
         await self.delete_dangling_hexdigests()
 
     async def delete_dangling_hexdigests(self):
-        logger.debug("delete_dangling_hexdigests - downloading backup list")
+        refcounts = self.hexdigest_refcounts
+        if refcounts is not None and not self.req.verify and await run_in_threadpool(
+            refcounts.is_verified_since,
+            time.time() - self.config.refcount_verify_interval
+        ) and await self._update_refcounts():
+            await self.delete_unreferenced_hexdigests()
+        else:
+            await self.mark_and_sweep_hexdigests()
+
+    async def _update_refcounts(self) -> bool:
+        """Count the references of the backups missing from the reference counts
+
+        Returns False if the counts cannot be trusted, as backups have been deleted behind our back.
+        """
+        assert self.hexdigest_refcounts is not None
+        backups = await self._list_backups()
+        counted_backups = await run_in_threadpool(self.hexdigest_refcounts.get_backups)
+        if not counted_backups.issubset(backups):
+            logger.info("%d counted backups no longer exist", len(counted_backups.difference(backups)))
+            return False
+        for backup in sorted(backups.difference(counted_backups)):
+            logger.info("counting references of backup %r", backup)
+            hexdigests = backup_manifest_hexdigests(await self.download_backup_manifest(backup))
+            await run_in_threadpool(self.hexdigest_refcounts.add_backup, backup, hexdigests)
+        return True
+
+    async def _get_checkpoint_hexdigests(self) -> Set[str]:
+        # Unfinished backup may be resumed later; keep what it has uploaded so far
+        checkpoint = await self.download_backup_checkpoint()
+        return set(checkpoint.hexdigests) if checkpoint is not None else set()
+
+    async def delete_unreferenced_hexdigests(self):
+        """ Delete the hexdigests, which the reference counts say are no longer used by any backup """
+        refcounts = self.hexdigest_refcounts
+        assert refcounts is not None
+        kept_hexdigests = await self._get_checkpoint_hexdigests()
+        packs = await self.download_packs()
+        packed_hexdigests = set()
+        for pack in packs.values():
+            packed_hexdigests.update(entry.hexdigest for entry in pack.entries)
+        kept_hexdigests.update(await run_in_threadpool(refcounts.filter_referenced, packed_hexdigests))
+        kept_packs = await self.clean_packs(kept_hexdigests=kept_hexdigests, packs=packs)
+        kept_hexdigests.update(kept_packs)
+        unreferenced_hexdigests = await run_in_threadpool(refcounts.get_unreferenced)
+        # Packed hexdigests are not objects of their own; they are gone along with their packs
+        await run_in_threadpool(refcounts.forget, unreferenced_hexdigests.intersection(packed_hexdigests))
+        # .. and packs are not referenced by the backups (and counted) at all
+        dropped_packs = set(packs).difference(kept_packs)
+        await self.delete_hexdigests(
+            unreferenced_hexdigests.difference(packed_hexdigests, kept_hexdigests).union(dropped_packs)
+        )
+
+    async def mark_and_sweep_hexdigests(self):
+        """ Delete the hexdigests not used by any backup, by reading all manifests and listing the object storage """
+        logger.debug("mark_and_sweep_hexdigests - downloading backup list")
         backups = await self._list_backups()
         logger.debug("downloading backup manifests")
         manifests = await self._download_backup_manifests(backups)
-        kept_hexdigests = set()
-        for manifest in manifests:
-            for result in manifest.snapshot_results:
-                assert result.hashes is not None
-                kept_hexdigests = kept_hexdigests | set(h.hexdigest for h in result.hashes if h.hexdigest)
-
-        all_hexdigests = await self.hexdigest_storage.list_hexdigests()
-        extra_hexdigests = set(all_hexdigests).difference(kept_hexdigests)
-        if not extra_hexdigests:
+        backup_hexdigests = {manifest.filename: backup_manifest_hexdigests(manifest) for manifest in manifests}
+        kept_hexdigests = (await self._get_checkpoint_hexdigests()).union(*backup_hexdigests.values())
+        # Packs are kept as long as any of their content is
+        kept_hexdigests.update(await self.clean_packs(kept_hexdigests=kept_hexdigests, packs=await self.download_packs()))
+
+        all_hexdigests = set(await self.hexdigest_storage.list_hexdigests())
+        # As we have the full listing anyway, reconcile the inventory with it
+        await self.reconcile_hexdigest_inventory(all_hexdigests)
+        extra_hexdigests = all_hexdigests.difference(kept_hexdigests)
+        if self.hexdigest_refcounts is not None:
+            # Hexdigests to be deleted are recorded as unreferenced, so that interrupted deletion is resumed
+            drift = await run_in_threadpool(self.hexdigest_refcounts.rebuild, backup_hexdigests, extra_hexdigests)
+            if self.stats is not None:
+                self.stats.gauge("astacus_refcount_drift", drift)
+        await self.delete_hexdigests(extra_hexdigests)
+
+    async def delete_hexdigests(self, hexdigests: Set[str]):
+        assert self.hexdigest_storage
+        if not hexdigests:
             return
-        logger.debug("deleting %d hexdigests from object storage", len(extra_hexdigests))
-        for hexdigest in extra_hexdigests:
-            # Due to rate limiting, it might be better to not do this in parallel
-            await self.hexdigest_storage.delete_hexdigest(hexdigest)
+        if self.hexdigest_inventory is not None:
+            # Removed before deleting, as the inventory must never claim deleted hexdigests exist
+            await run_in_threadpool(self.hexdigest_inventory.remove, hexdigests)
+        # Deleted hexdigests are forgotten from the reference counts batch by batch, so interrupted deletion resumes
+        on_deleted = self._forget_deleted_hexdigests if self.hexdigest_refcounts is not None else None
+        deleter = HexDigestDeleter(storage=self.hexdigest_storage.storage, config=self.config.deletion, stats=self.stats)
+        await deleter.delete(hexdigests, on_deleted=on_deleted)
+
+    async def _forget_deleted_hexdigests(self, hexdigests: List[str]):
+        assert self.hexdigest_refcounts is not None
+        await run_in_threadpool(self.hexdigest_refcounts.forget, hexdigests)
+
+    async def clean_packs(self, *, kept_hexdigests, packs) -> Set[str]:
+        """Delete the indexes of packs with no kept hexdigests, and repack mostly unused ones
+
+        Returns the hexdigests of the packs that are to be kept; the rest are deleted with other dangling hexdigests.
+        """
+        assert self.json_storage
+        kept_packs = set()
+        for pack in packs.values():
+            kept_entries = [entry for entry in pack.entries if entry.hexdigest in kept_hexdigests]
+            if not kept_entries:
+                logger.debug("deleting pack %r", pack.hexdigest)
+                await self.json_storage.delete_json(pack_json_name(pack.hexdigest))
+                continue
+            dead_size = pack.size - sum(entry.size for entry in kept_entries)
+            if self.config.repack_dead_ratio and dead_size >= pack.size * self.config.repack_dead_ratio:
+                pack = await self.repack(pack=pack, entries=kept_entries)
+            kept_packs.add(pack.hexdigest)
+        return kept_packs
+
+    async def repack(self, *, pack, entries) -> ipc.SnapshotPack:
+        """Replace the pack with new one containing only the given entries
+
+        Backup manifests are not modified; restore finds the packed
+        hexdigests using the pack indexes. The new pack (and its index)
+        are stored before the old index is removed, so the packed
+        hexdigests are always in some pack even if this is interrupted;
+        a later cleanup then just repacks again.
+        """
+        assert self.hexdigest_storage and self.json_storage
+        logger.info("repacking %d/%d entries of pack %r", len(entries), len(pack.entries), pack.hexdigest)
+        data = await self.hexdigest_storage.download_hexdigest_bytes(pack.hexdigest)
+        builder = PackBuilder()
+        for entry in entries:
+            builder.add(entry.hexdigest, get_pack_entry_data(data, entry))
+        new_pack, new_data = builder.build()
+        await self.hexdigest_storage.upload_hexdigest_bytes(new_pack.hexdigest, new_data)
+        if self.hexdigest_inventory is not None:
+            await run_in_threadpool(self.hexdigest_inventory.add, {new_pack.hexdigest: new_pack.size})
+        await self.json_storage.upload_json(pack_json_name(new_pack.hexdigest), new_pack)
+        await self.json_storage.delete_json(pack_json_name(pack.hexdigest))
+        return new_pack
 
     async def determine_kept_backups(self, *, retention, backups):
         if retention.minimum_backups is not None and retention.minimum_backups >= len(backups):
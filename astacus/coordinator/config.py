@@ -27,9 +27,38 @@ class PollConfig(AstacusModel):
     maximum_failures: int = 5
 
     # Sometimes Astacus blobs can be .. big.
-    # (TBD: This should be paged somehow)
     result_timeout: int = 300
 
+    # Snapshot results are polled as summaries, and once done, their
+    # files and hashes are fetched in pages of this many entries;
+    # 0 disables paging (and whole results are polled instead)
+    result_page_size: int = 10000
+
+
+class HexDigestBatchConfig(AstacusModel):
+    # Hexdigests are handled in batches of this many, with at most
+    # parallel batches in progress at once
+    batch_size: int = 1000
+    parallel: int = 4
+
+    # Upper bound for the number of hexdigests handled per second;
+    # 0 means unlimited
+    hexdigests_per_second: int = 0
+
+
+class DeletionConfig(HexDigestBatchConfig):
+    # Cleanup deletes unused hexdigests in batches. Object storages
+    # with batch delete support (s3) delete each batch with single
+    # request; with others, objects are deleted one by one.
+    pass
+
+
+class MigrationConfig(HexDigestBatchConfig):
+    # The migrate operation moves hexdigests to the sharded layout in
+    # batches, each move being server-side copy and delete (i.e. two
+    # requests per hexdigest)
+    pass
+
 
 class CoordinatorNode(AstacusModel):
     # What is the Astacus url of the node
@@ -47,6 +76,10 @@ class CoordinatorConfig(AstacusModel):
 
     poll: PollConfig = PollConfig()
 
+    deletion: DeletionConfig = DeletionConfig()
+
+    migration: MigrationConfig = MigrationConfig()
+
     plugin: ipc.Plugin
     plugin_config: dict = {}
 
@@ -70,11 +103,53 @@ class CoordinatorConfig(AstacusModel):
     # already downloaded files are not downloaded again.
     restore_attempts: int = 5
 
+    # If set, backup progress is checkpointed to the json storage
+    # after listing the hexdigests, and after each upload batch of
+    # (at most) backup_checkpoint_upload_size bytes. Interrupted backup
+    # (e.g. due to coordinator or node restart) is then resumed by the
+    # next backup attempt or operation, without uploading the confirmed
+    # hexdigests again. Checkpoints older than backup_checkpoint_max_age
+    # seconds are discarded instead of resumed.
+    backup_checkpoints: bool = False
+    backup_checkpoint_upload_size: int = 10 * 2 ** 30
+    backup_checkpoint_max_age: int = 86400
+
     # Optional object storage cache directory used for caching json
     # manifest fetching
     # Directory is created if it does not exist
     object_storage_cache: Optional[Path]
 
+    # If object_storage_cache is set, the coordinator also keeps there
+    # an inventory of the hexdigests in the object storage, and uses
+    # it instead of listing the object storage on every backup. The
+    # inventory is reconciled with the real listing if it has not been
+    # in this many seconds (cleanup operations reconcile it too).
+    inventory_reconcile_interval: int = 86400
+
+    # If object_storage_cache is set, the coordinator also keeps there
+    # reference counts of the hexdigests (see refcounts), and cleanup
+    # deletes the hexdigests no longer used by the deleted backups,
+    # instead of reading all manifests and listing the object storage.
+    # The counts are verified with such full scan if they have not been
+    # in this many seconds (or if requested in the cleanup request).
+    refcount_verify_interval: int = 7 * 86400
+
+    # Cleanup repacks packs (see NodePacking), in which at least this
+    # fraction of the data is no longer used by any backup; 0 disables
+    # repacking (packs are still deleted when none of their data is used)
+    repack_dead_ratio: float = 0.5
+
+    # If set, backup manifests are stored in compact format (see
+    # astacus.common.manifest), which is much smaller and faster to
+    # parse than plain json, but not readable by older versions
+    compact_manifests: bool = False
+
+    # If set, nodes store their snapshot states as separate shard
+    # objects, which are only referred to from the backup manifests.
+    # Restoring nodes then download only their own state, and the
+    # coordinator does not handle the states at all.
+    manifest_shards: bool = False
+
     # These can be either globally or locally set
     object_storage: Optional[RohmuConfig] = None
     statsd: Optional[StatsdConfig] = None
@@ -83,6 +158,10 @@ class CoordinatorConfig(AstacusModel):
     # backup? Probably even one hour (default) is sensible enough
     list_ttl: int = 3600
 
+    # Upper bound for the (estimated) memory used by the in-memory cache
+    # of parsed backup manifests; 0 disables the cache
+    manifest_cache_size: int = 256 * 2 ** 20
+
 
 def coordinator_config(request: Request) -> CoordinatorConfig:
     return getattr(request.app.state, APP_KEY)
@@ -4,16 +4,24 @@ See LICENSE for details
 """
 
 from .config import coordinator_config, CoordinatorConfig
+from .inventory import HexDigestInventory
+from .manifestcache import ManifestCache
+from .refcounts import HexDigestRefCounts
 from .state import coordinator_state, CoordinatorState
 from astacus.common import asyncstorage, exceptions, ipc, magic, op, statsd, utils
 from astacus.common.cachingjsonstorage import MultiCachingJsonStorage
 from astacus.common.magic import LockCall
+from astacus.common.manifest import parse_backup_manifest
+from astacus.common.progress import Progress
 from astacus.common.rohmustorage import MultiRohmuStorage
-from astacus.common.storage import HexDigestStorage, JsonStorage, MultiFileStorage, MultiStorage
+from astacus.common.storage import JsonStorage, MultiFileStorage, MultiStorage
 from datetime import datetime
 from enum import Enum
 from fastapi import BackgroundTasks, Depends, HTTPException, Request
-from typing import List, Optional
+from pathlib import Path
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, List, Optional, Set, Tuple
 from urllib.parse import urlunsplit
 
 import asyncio
@@ -25,6 +33,10 @@ import time
 
 logger = logging.getLogger(__name__)
 
+INVENTORIES_KEY = "coordinator_hexdigest_inventories"
+REFCOUNTS_KEY = "coordinator_hexdigest_refcounts"
+MANIFEST_CACHE_KEY = "coordinator_manifest_cache"
+
 
 class LockResult(Enum):
     ok = "ok"
@@ -35,6 +47,7 @@ class LockResult(Enum):
 class CoordinatorOp(op.Op):
     attempt = -1  # try_run iteration number
     attempt_start: Optional[datetime] = None  # try_run iteration start time
+    progress: Optional[Progress] = None  # set by operations which report their progress
 
     def __init__(self, *, c: "Coordinator"):
         super().__init__(info=c.state.op_info)
@@ -44,6 +57,9 @@ class CoordinatorOp(op.Op):
         self.state = c.state
         self.hexdigest_mstorage = c.hexdigest_mstorage
         self.json_mstorage = c.json_mstorage
+        self.get_hexdigest_inventory = c.get_hexdigest_inventory
+        self.get_hexdigest_refcounts = c.get_hexdigest_refcounts
+        self.manifest_cache = c.manifest_cache
         self.set_storage_name(self.default_storage_name)
         self.subresult_received_event = asyncio.Event()
 
@@ -53,13 +69,42 @@ class CoordinatorOp(op.Op):
         parts = [url.scheme, url.netloc, f"{url.path}/{self.op_id}/sub-result", "", ""]
         return urlunsplit(parts)
 
-    hexdigest_storage: Optional[HexDigestStorage] = None
+    hexdigest_storage: Optional[asyncstorage.AsyncHexDigestStorage] = None
+    hexdigest_inventory: Optional[HexDigestInventory] = None
+    hexdigest_refcounts: Optional[HexDigestRefCounts] = None
     json_storage: Optional[JsonStorage] = None
 
+    storage_name = ""
+
     def set_storage_name(self, storage_name):
+        self.storage_name = storage_name
         self.hexdigest_storage = asyncstorage.AsyncHexDigestStorage(self.hexdigest_mstorage.get_storage(storage_name))
+        self.hexdigest_inventory = self.get_hexdigest_inventory(storage_name)
+        self.hexdigest_refcounts = self.get_hexdigest_refcounts(storage_name)
         self.json_storage = asyncstorage.AsyncJsonStorage(self.json_mstorage.get_storage(storage_name))
 
+    async def list_stored_hexdigests(self) -> Set[str]:
+        """ Return the hexdigests in the storage; from the local inventory, unless it is due to be reconciled """
+        assert self.hexdigest_storage
+        inventory = self.hexdigest_inventory
+        if inventory is not None:
+            if await run_in_threadpool(
+                inventory.is_reconciled_since,
+                time.time() - self.config.inventory_reconcile_interval
+            ):
+                return await run_in_threadpool(inventory.get_hexdigests)
+        hexdigests = set(await self.hexdigest_storage.list_hexdigests())
+        if inventory is not None:
+            await self.reconcile_hexdigest_inventory(hexdigests)
+        return hexdigests
+
+    async def reconcile_hexdigest_inventory(self, hexdigests: Set[str]):
+        if self.hexdigest_inventory is None:
+            return
+        drift = await run_in_threadpool(self.hexdigest_inventory.reconcile, hexdigests)
+        if self.stats is not None:
+            self.stats.gauge("astacus_inventory_drift", drift)
+
     @property
     def default_storage_name(self):
         return self.json_mstorage.get_default_storage_name()
@@ -164,6 +209,8 @@ class CoordinatorOp(op.Op):
         # however, if re-locking times out, we will bail out. TBD if
         # we need timeout mechanism here anyway.
         failures = {}
+        # Snapshot results may be huge, so they are fetched in pages
+        paged = result_class is ipc.SnapshotResult and self.config.poll.result_page_size > 0
 
         def _event_awaitable_factory():
             return self.subresult_received_event.wait()
@@ -181,15 +228,20 @@ class CoordinatorOp(op.Op):
                 if result is not None and result.progress.final:
                     continue
                 r = await utils.httpx_request(
-                    url, caller="CoordinatorOp.wait_successful_results", timeout=self.config.poll.result_timeout
+                    f"{url}?summary=true" if paged else url,
+                    caller="CoordinatorOp.wait_successful_results",
+                    timeout=self.config.poll.result_timeout
                 )
-                if r is None:
+                # We got something -> decode the result
+                result = None if r is None else result_class.parse_obj(r)
+                if paged and result is not None and result.paged and result.progress.final:
+                    if not result.progress.finished_failed:
+                        result = await self.download_result_pages(url, result)
+                if result is None:
                     failures[i] = failures.get(i, 0) + 1
                     if failures[i] >= self.config.poll.maximum_failures:
                         return []
                     continue
-                # We got something -> decode the result
-                result = result_class.parse_obj(r)
                 results[i] = result
                 failures[i] = 0
                 if result.progress.finished_failed:
@@ -201,14 +253,70 @@ class CoordinatorOp(op.Op):
             return []
         return results
 
+    async def download_result_pages(self, url: str, result: ipc.SnapshotResult) -> Optional[ipc.SnapshotResult]:
+        """Fill in the files and hashes of summary snapshot result from the node's paged results
+
+        Only one page at a time is held in serialized form. Returns None on failure.
+        """
+        assert result.state is not None and result.hashes is not None
+        parts: List[Tuple[str, list]] = [("hashes", result.hashes)]
+        if not result.shard:
+            parts.append(("files", result.state.files))
+        for part, items in parts:
+            cursor: Optional[int] = 0
+            while cursor is not None:
+                r = await utils.httpx_request(
+                    f"{url}/{part}?cursor={cursor}&limit={self.config.poll.result_page_size}",
+                    caller="CoordinatorOp.download_result_pages",
+                    timeout=self.config.poll.result_timeout
+                )
+                if r is None:
+                    return None
+                page = ipc.SnapshotResultPage.parse_obj(r)
+                items.extend(getattr(page, part))
+                cursor = page.next_cursor
+        if not result.shard and len(result.state.files) != result.files:
+            logger.warning("Paged result from %s had %d files instead of %d", url, len(result.state.files), result.files)
+            return None
+        result.paged = False
+        return result
+
     async def download_backup_manifest(self, backup_name: str) -> ipc.BackupManifest:
         assert self.json_storage
+        key = (self.storage_name, backup_name)
+        manifest = self.manifest_cache.get(key, stats=self.stats)
+        if manifest is not None:
+            return manifest
         d = await self.json_storage.download_json(backup_name)
-        manifest = ipc.BackupManifest.parse_obj(d)
+        manifest = parse_backup_manifest(d)
         assert not manifest.filename or manifest.filename == backup_name
         manifest.filename = backup_name
+        self.manifest_cache.put(key, manifest, stats=self.stats)
         return manifest
 
+    async def download_packs(self) -> Dict[str, ipc.SnapshotPack]:
+        """ Return the packs in the storage, by their hexdigest """
+        assert self.json_storage
+        packs = {}
+        for name in await self.json_storage.list_jsons():
+            if name.startswith(magic.JSON_PACK_PREFIX):
+                pack = ipc.SnapshotPack.parse_obj(await self.json_storage.download_json(name))
+                packs[pack.hexdigest] = pack
+        return packs
+
+    async def download_backup_checkpoint(self) -> Optional[ipc.BackupCheckpoint]:
+        assert self.json_storage
+        try:
+            d = await self.json_storage.download_json(magic.JSON_BACKUP_CHECKPOINT)
+        except exceptions.NotFoundException:
+            return None
+        try:
+            return ipc.BackupCheckpoint.parse_obj(d)
+        except ValidationError:
+            # E.g. written by an older version; cannot be resumed
+            logger.info("Ignoring unparseable backup checkpoint")
+            return None
+
 
 class CoordinatorOpWithClusterLock(CoordinatorOp):
     op_started: Optional[float]  # set when op_info.status is set to starting
@@ -326,6 +434,31 @@ class Coordinator(op.OpMixin):
             json_mstorage = MultiCachingJsonStorage(backend_mstorage=mstorage, cache_mstorage=file_mstorage)
         self.json_mstorage = json_mstorage
         self.sync_lock = utils.get_or_create_state(app=request.app, key="sync_lock", factory=threading.RLock)
+        self.manifest_cache = utils.get_or_create_state(
+            app=request.app, key=MANIFEST_CACHE_KEY, factory=lambda: ManifestCache(max_size=config.manifest_cache_size)
+        )
+
+    def get_hexdigest_inventory(self, storage_name: str) -> Optional[HexDigestInventory]:
+        if not self.config.object_storage_cache:
+            return None
+        inventories: Dict[
+            str, HexDigestInventory] = utils.get_or_create_state(app=self.request.app, key=INVENTORIES_KEY, factory=dict)
+        inventory = inventories.get(storage_name)
+        if inventory is None:
+            path = Path(self.config.object_storage_cache) / magic.INVENTORY_DIRNAME / f"{storage_name}.jsonl"
+            inventory = inventories.setdefault(storage_name, HexDigestInventory(path))
+        return inventory
+
+    def get_hexdigest_refcounts(self, storage_name: str) -> Optional[HexDigestRefCounts]:
+        if not self.config.object_storage_cache:
+            return None
+        refcounts: Dict[
+            str, HexDigestRefCounts] = utils.get_or_create_state(app=self.request.app, key=REFCOUNTS_KEY, factory=dict)
+        storage_refcounts = refcounts.get(storage_name)
+        if storage_refcounts is None:
+            path = Path(self.config.object_storage_cache) / magic.REFCOUNTS_DIRNAME / f"{storage_name}.jsonl"
+            storage_refcounts = refcounts.setdefault(storage_name, HexDigestRefCounts(path))
+        return storage_refcounts
 
     async def start_op_async(self, *, op, op_name, fun):  # pylint: disable=redefined-outer-name
         if isinstance(op, CoordinatorOpWithClusterLock):
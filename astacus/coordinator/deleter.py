@@ -0,0 +1,34 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Deletion of (large numbers of) hexdigests from the object storage.
+
+Deleting the hexdigests one at a time adds up to hours after e.g. a
+large retention change, all while holding the cluster lock. Instead the
+hexdigests are deleted in parallel batches (see batches), with single
+request each, if the storage supports it.
+
+Hexdigests that are already gone are ignored, so interrupted deletion
+can be simply retried; the on_deleted callback is called after each
+batch, so that the caller can record the progress.
+
+"""
+
+from .batches import HexDigestBatchProcessor, OnHandled
+from astacus.common.asyncstorage import AsyncHexDigestStorage
+from typing import Iterable, List, Optional
+
+
+class HexDigestDeleter(HexDigestBatchProcessor):
+    action = "deleting"
+    handled_metric = "astacus_deleted_hexdigests"
+    remaining_metric = "astacus_delete_hexdigests_remaining"
+
+    async def handle_batch(self, storage: AsyncHexDigestStorage, batch: List[str]):
+        await storage.delete_hexdigests(batch)
+
+    async def delete(self, hexdigests: Iterable[str], *, on_deleted: Optional[OnHandled] = None):
+        """ Delete the hexdigests; on_deleted is called with each batch of deleted hexdigests """
+        await self.run(hexdigests, on_handled=on_deleted)
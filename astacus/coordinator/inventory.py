@@ -0,0 +1,101 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Local inventory of the hexdigests stored in an object storage.
+
+Listing all hexdigests of a large object storage is slow and costs API
+calls, so instead the coordinator keeps track of the hexdigests it has
+seen uploaded (and deleted). As the object storage might be changed by
+someone else too, the inventory is periodically reconciled with the
+real listing.
+
+Note that an inventory that claims a hexdigest exists when it does not
+leads to broken backups, while the reverse only leads to redundant
+uploads. Therefore hexdigests are added only after the upload has been
+confirmed, and removed before they are deleted.
+
+"""
+
+from astacus.common.journal import JsonJournal
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Journal key under which the time of the last reconciliation is stored
+# (hexdigests are never empty)
+RECONCILED_KEY = ""
+
+
+class HexDigestInventory:
+    def __init__(self, path: Path):
+        self.journal = JsonJournal(path)
+        self.lock = threading.Lock()
+        self.hexdigests: Optional[Dict[str, int]] = None
+        self.reconciled = 0.0
+
+    def _load(self) -> Dict[str, int]:
+        if self.hexdigests is None:
+            data = self.journal.load()
+            self.reconciled = data.pop(RECONCILED_KEY, 0.0)
+            self.hexdigests = data
+        return self.hexdigests
+
+    def is_reconciled_since(self, t: float) -> bool:
+        with self.lock:
+            self._load()
+            return bool(self.reconciled) and self.reconciled >= t
+
+    def get_hexdigests(self) -> Set[str]:
+        with self.lock:
+            return set(self._load())
+
+    def get_size(self, hexdigest: str) -> Optional[int]:
+        """ Return the (uncompressed) size of the hexdigest; 0 if unknown and None if not stored """
+        with self.lock:
+            return self._load().get(hexdigest)
+
+    def add(self, sizes: Dict[str, int]):
+        """ Add confirmed to be stored hexdigest -> size entries """
+        with self.lock:
+            hexdigests = self._load()
+            changes = {hexdigest: size for hexdigest, size in sizes.items() if hexdigests.get(hexdigest) != size}
+            hexdigests.update(changes)
+            self.journal.append(changes)
+            self.journal.compact_if_needed(len(hexdigests) + 1)
+
+    def remove(self, hexdigests_to_remove: Iterable[str]):
+        """ Remove (to be) deleted hexdigests """
+        with self.lock:
+            hexdigests = self._load()
+            changes = {hexdigest: None for hexdigest in hexdigests_to_remove if hexdigest in hexdigests}
+            for hexdigest in changes:
+                del hexdigests[hexdigest]
+            self.journal.append(changes)
+            self.journal.compact_if_needed(len(hexdigests) + 1)
+
+    def reconcile(self, listed_hexdigests: Iterable[str]) -> int:
+        """Replace the content with the (complete) listing of the storage
+
+        Sizes of the hexdigests not uploaded via us are not known, and
+        they are recorded as 0. Returns the number of hexdigests that
+        were missing from, or extra in, the inventory.
+        """
+        with self.lock:
+            hexdigests = self._load()
+            listed = set(listed_hexdigests)
+            drift = len(listed.symmetric_difference(hexdigests))
+            self.hexdigests = {hexdigest: hexdigests.get(hexdigest, 0) for hexdigest in listed}
+            self.reconciled = time.time()
+            data: Dict[str, float] = dict(self.hexdigests)
+            data[RECONCILED_KEY] = self.reconciled
+            self.journal.rewrite(data)
+        if drift:
+            logger.info("Reconciled inventory %s: %d hexdigests differed", self.journal.path, drift)
+        return drift
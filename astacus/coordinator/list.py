@@ -2,44 +2,131 @@
 Copyright (c) 2020 Aiven Ltd
 See LICENSE for details
 
+Listing of backups.
+
+Instead of parsing the (potentially huge) backup manifests, listing
+uses small summary objects stored next to them. The summaries are kept
+in an in-memory index, which the backup and cleanup operations update
+when they add or remove backups, so listing downloads only the
+summaries of backups added by someone else.
+
+The index is also stored in each storage as single JSON object, which
+is rewritten whenever listing finds that the set of backups has
+changed. After restart, the index is loaded from there, instead of
+downloading the summaries of every backup again. It is only used as a
+cache: the backups are still listed from the storage, so entries of
+backups deleted by someone else are dropped, and missing ones are
+downloaded.
+
 """
 
 from astacus.common import ipc, magic
-from astacus.common.storage import MultiStorage
-
-
-def _iter_backups(storage):
-    for name in sorted(storage.list_jsons()):
-        if not name.startswith(magic.JSON_BACKUP_PREFIX):
-            continue
-        pname = name[len(magic.JSON_BACKUP_PREFIX):]
-        manifest = ipc.BackupManifest.parse_obj(storage.download_json(name))
-        files = sum(x.files for x in manifest.snapshot_results)
-        total_size = sum(x.total_size for x in manifest.snapshot_results)
-        upload_size = sum(x.total_size for x in manifest.upload_results)
-        upload_stored_size = sum(x.total_stored_size for x in manifest.upload_results)
-        yield ipc.ListSingleBackup(
-            name=pname,
-            start=manifest.start,
-            end=manifest.end,
-            plugin=manifest.plugin,
-            attempt=manifest.attempt,
-            nodes=len(manifest.snapshot_results),
-            files=files,
-            total_size=total_size,
-            upload_size=upload_size,
-            upload_stored_size=upload_stored_size,
-        )
-
-
-def _iter_storages(req, json_mstorage):
+from astacus.common.manifest import parse_backup_manifest
+from astacus.common.storage import JsonStorage, MultiStorage
+from pydantic import ValidationError
+from typing import Dict, FrozenSet, List, Optional
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def backup_summary_name(backup_name: str) -> str:
+    return f"{magic.JSON_BACKUP_SUMMARY_PREFIX}{backup_name}"
+
+
+def manifest_to_list_single_backup(backup_name: str, manifest: ipc.BackupManifest) -> ipc.ListSingleBackup:
+    assert backup_name.startswith(magic.JSON_BACKUP_PREFIX)
+    return ipc.ListSingleBackup(
+        name=backup_name[len(magic.JSON_BACKUP_PREFIX):],
+        start=manifest.start,
+        end=manifest.end,
+        plugin=manifest.plugin,
+        attempt=manifest.attempt,
+        nodes=len(manifest.snapshot_results),
+        files=sum(x.files for x in manifest.snapshot_results),
+        total_size=sum(x.total_size for x in manifest.snapshot_results),
+        upload_size=sum(x.total_size for x in manifest.upload_results),
+        upload_stored_size=sum(x.total_stored_size for x in manifest.upload_results),
+    )
+
+
+def _download_backup(storage: JsonStorage, backup_name: str, names) -> ipc.ListSingleBackup:
+    summary_name = backup_summary_name(backup_name)
+    if summary_name in names:
+        return ipc.ListSingleBackup.parse_obj(storage.download_json(summary_name))
+    # Backups made before the summaries were introduced
+    return manifest_to_list_single_backup(backup_name, parse_backup_manifest(storage.download_json(backup_name)))
+
+
+class BackupListIndex:
+    """Summaries of the backups in each storage, by backup manifest name
+
+    Storage contents are replaced, never mutated, so that listing
+    threads can use them without holding the lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.storages: Dict[str, Dict[str, ipc.ListSingleBackup]] = {}
+        # Backup names of the index stored in each storage
+        self.stored: Dict[str, FrozenSet[str]] = {}
+
+    def add_backup(self, storage_name: str, backup_name: str, backup: ipc.ListSingleBackup):
+        with self.lock:
+            # Storages not listed yet are loaded in full when they are
+            if storage_name in self.storages:
+                self.storages[storage_name] = {**self.storages[storage_name], backup_name: backup}
+
+    def remove_backup(self, storage_name: str, backup_name: str):
+        with self.lock:
+            if storage_name in self.storages:
+                backups = dict(self.storages[storage_name])
+                backups.pop(backup_name, None)
+                self.storages[storage_name] = backups
+
+    def list_backups(self, storage_name: str, storage: JsonStorage) -> List[ipc.ListSingleBackup]:
+        names = set(storage.list_jsons())
+        backup_names = sorted(name for name in names if name.startswith(magic.JSON_BACKUP_PREFIX))
+        with self.lock:
+            known = self.storages.get(storage_name)
+            stored = self.stored.get(storage_name, frozenset())
+        if known is None:
+            known = _download_list_index(storage, names)
+            stored = frozenset(known)
+        backups = {name: known.get(name) or _download_backup(storage, name, names) for name in backup_names}
+        if stored != set(backups):
+            storage.upload_json(magic.JSON_BACKUP_LIST_INDEX, ipc.BackupListIndex(backups=backups))
+            stored = frozenset(backups)
+        with self.lock:
+            self.storages[storage_name] = backups
+            self.stored[storage_name] = stored
+        return [backups[name] for name in backup_names]
+
+
+def _download_list_index(storage: JsonStorage, names) -> Dict[str, ipc.ListSingleBackup]:
+    if magic.JSON_BACKUP_LIST_INDEX not in names:
+        return {}
+    try:
+        return ipc.BackupListIndex.parse_obj(storage.download_json(magic.JSON_BACKUP_LIST_INDEX)).backups
+    except ValidationError:
+        # E.g. written by a newer version; rebuilt from the summaries
+        logger.info("Ignoring unparseable backup list index")
+        return {}
+
+
+def _iter_storages(req, json_mstorage, list_index):
     # req.storage is optional, used to constrain listing just to the
     # given storage. by default, we list all storages.
     for storage_name in sorted(json_mstorage.list_storages()):
         if not req.storage or req.storage == storage_name:
-            backups = list(_iter_backups(json_mstorage.get_storage(storage_name)))
+            backups = list_index.list_backups(storage_name, json_mstorage.get_storage(storage_name))
             yield ipc.ListForStorage(storage_name=storage_name, backups=backups)
 
 
-def list_backups(*, req: ipc.ListRequest, json_mstorage: MultiStorage) -> ipc.ListResponse:
-    return ipc.ListResponse(storages=list(_iter_storages(req, json_mstorage)))
+def list_backups(
+    *, req: ipc.ListRequest, json_mstorage: MultiStorage, list_index: Optional[BackupListIndex] = None
+) -> ipc.ListResponse:
+    if list_index is None:
+        list_index = BackupListIndex()
+    return ipc.ListResponse(storages=list(_iter_storages(req, json_mstorage, list_index)))
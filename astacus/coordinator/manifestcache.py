@@ -0,0 +1,91 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+In-memory LRU cache of parsed backup manifests.
+
+Json storage caching avoids downloading the manifests again, but
+reading and parsing large manifests is still slow, and e.g. cleanup
+needs every manifest more than once. Backups are immutable, so cached
+manifests need to be invalidated only when the coordinator itself
+deletes or rewrites them.
+
+The size of the cache is bounded by the (estimated) memory used by the
+parsed manifests, which is dominated by their files and hashes.
+
+"""
+
+from astacus.common import ipc, statsd
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import threading
+
+# Estimated memory usage of parsed models (measured with tracemalloc)
+MANIFEST_BASE_SIZE = 10_000
+SNAPSHOT_FILE_SIZE = 1_500
+SNAPSHOT_HASH_SIZE = 400
+
+Key = Tuple[str, str]  # storage name, backup name
+
+
+def estimate_manifest_size(manifest: ipc.BackupManifest) -> int:
+    size = MANIFEST_BASE_SIZE
+    for result in manifest.snapshot_results:
+        if result.state is not None:
+            size += len(result.state.files) * SNAPSHOT_FILE_SIZE
+        size += len(result.hashes or []) * SNAPSHOT_HASH_SIZE
+    return size
+
+
+class ManifestCache:
+    def __init__(self, *, max_size: int):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.manifests: "OrderedDict[Key, Tuple[ipc.BackupManifest, int]]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Key, *, stats: Optional[statsd.StatsClient] = None) -> Optional[ipc.BackupManifest]:
+        """ Return (a shallow copy of) the cached manifest, or None """
+        with self.lock:
+            entry = self.manifests.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.manifests.move_to_end(key)
+            hit_ratio = self.hits / (self.hits + self.misses)
+        if stats is not None:
+            stats.increase("astacus_manifest_cache_hit" if entry is not None else "astacus_manifest_cache_miss")
+            stats.gauge("astacus_manifest_cache_hit_ratio", hit_ratio)
+        if entry is None:
+            return None
+        # Callers may replace the attributes (but not mutate their contents)
+        return entry[0].copy()
+
+    def put(self, key: Key, manifest: ipc.BackupManifest, *, stats: Optional[statsd.StatsClient] = None):
+        size = estimate_manifest_size(manifest)
+        with self.lock:
+            self._remove(key)
+            if size <= self.max_size:
+                self.manifests[key] = (manifest.copy(), size)
+                self.size += size
+                while self.size > self.max_size:
+                    _, (_, evicted_size) = self.manifests.popitem(last=False)
+                    self.size -= evicted_size
+            entries, total_size = len(self.manifests), self.size
+        if stats is not None:
+            stats.gauge("astacus_manifest_cache_entries", entries)
+            stats.gauge("astacus_manifest_cache_size", total_size)
+
+    def invalidate(self, key: Key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key: Key):
+        entry = self.manifests.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
@@ -0,0 +1,55 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Migration of hexdigests stored in the flat key layout to the
+configured sharded one (see RohmuConfig.hexdigest_shard_depth)
+
+Migration may take hours with millions of hexdigests, so it runs in
+the background, without the cluster lock: lookups fall back to the
+flat key (and back), so the hexdigests can be accessed while they are
+being moved. Starting any other operation stops the migration after
+the batches in progress; as only the hexdigests still in the flat
+layout are migrated, starting it again resumes where it was left.
+
+"""
+
+from .batches import HexDigestBatchProcessor
+from .coordinator import Coordinator, CoordinatorOp
+from astacus.common import ipc
+from astacus.common.asyncstorage import AsyncHexDigestStorage
+from astacus.common.progress import Progress
+from typing import List
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HexDigestMigrator(HexDigestBatchProcessor):
+    action = "migrating"
+    handled_metric = "astacus_migrated_hexdigests"
+    remaining_metric = "astacus_migrate_hexdigests_remaining"
+
+    async def handle_batch(self, storage: AsyncHexDigestStorage, batch: List[str]):
+        await storage.migrate_hexdigests(batch)
+
+
+class MigrateOp(CoordinatorOp):
+    def __init__(self, *, c: Coordinator, req: ipc.MigrateRequest):
+        super().__init__(c=c)
+        self.req = req
+        self.progress = Progress()
+
+    async def _check_still_running(self, batch: List[str]):
+        # Stops the migration, if some other operation has been started
+        self.check_op_id()
+
+    async def run(self):
+        if self.req.storage:
+            self.set_storage_name(self.req.storage)
+        assert self.hexdigest_storage
+        hexdigests = await self.hexdigest_storage.list_unsharded_hexdigests()
+        migrator = HexDigestMigrator(storage=self.hexdigest_storage.storage, config=self.config.migration, stats=self.stats)
+        self.progress = migrator.progress
+        await migrator.run(hexdigests, on_handled=self._check_still_running)
@@ -6,11 +6,17 @@ Common base classes for the plugins
 
 """
 
-from astacus.common import exceptions, ipc, magic
+from astacus.common import exceptions, ipc, magic, utils
+from astacus.common.manifest import encode_backup_manifest
+from astacus.common.packs import hexdigest_to_pack_entry, pack_json_name
 from astacus.coordinator import plugins
 from astacus.coordinator.coordinator import Coordinator, CoordinatorOpWithClusterLock
+from astacus.coordinator.list import backup_summary_name, manifest_to_list_single_backup
+from astacus.coordinator.refcounts import backup_manifest_hexdigests
 from collections import Counter
-from typing import Dict, List, Optional, Set, Union
+from datetime import datetime
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, Iterator, List, Optional, Set, Union
 
 import logging
 
@@ -27,6 +33,20 @@ class NodeIndexData(ipc.AstacusModel):
         self.sshashes.append(sshash)
 
 
+def split_node_index_datas(node_index_datas: List[NodeIndexData], *, batch_size: int) -> Iterator[List[NodeIndexData]]:
+    """ Split the uploads to batches, in which each node has at most batch_size bytes to upload """
+    node_batches: List[List[NodeIndexData]] = []
+    for data in node_index_datas:
+        batches = [NodeIndexData(node_index=data.node_index)]
+        for sshash in data.sshashes:
+            if batches[-1].sshashes and batches[-1].total_size + sshash.size > batch_size:
+                batches.append(NodeIndexData(node_index=data.node_index))
+            batches[-1].append_sshash(sshash)
+        node_batches.append(batches)
+    for i in range(max((len(batches) for batches in node_batches), default=0)):
+        yield [batches[i] for batches in node_batches if i < len(batches)]
+
+
 class OpBase(CoordinatorOpWithClusterLock):
     steps: List[str] = []
 
@@ -74,7 +94,9 @@ class BackupOpBase(OpBase):
     async def step_snapshot(self) -> List[ipc.SnapshotResult]:
         """ Snapshot step. Has to be parametrized with the root_globs to use """
         logger.debug("BackupOp._snapshot")
-        req = ipc.SnapshotRequest(root_globs=self.snapshot_root_globs)
+        req = ipc.SnapshotRequest(
+            root_globs=self.snapshot_root_globs, storage=self.default_storage_name if self.config.manifest_shards else ""
+        )
         start_results = await self.request_from_nodes(
             "snapshot", method="post", caller="BackupOpBase.step_snapshot", req=req
         )
@@ -86,11 +108,67 @@ class BackupOpBase(OpBase):
 
     async def step_list_hexdigests(self) -> bool:
         assert self.hexdigest_storage
-        self.hexdigests = set(await self.hexdigest_storage.list_hexdigests())
+        self.hexdigests = await self.list_stored_hexdigests()
+        await self._load_packs()
+        if not self.config.backup_checkpoints:
+            return True
+        checkpoint = await self._download_resumable_checkpoint()
+        if checkpoint is not None:
+            logger.info(
+                "Resuming backup started at %s with %d confirmed hexdigests", checkpoint.start, len(checkpoint.hexdigests)
+            )
+            self.checkpoint_start = checkpoint.start
+            self.checkpoint_upload_results = checkpoint.upload_results
+            # The listing (or inventory) may predate the uploads of the checkpointed backup
+            self.hexdigests = self.hexdigests | set(checkpoint.hexdigests)
+        else:
+            self.checkpoint_start = self.attempt_start
+            self.checkpoint_upload_results = []
+        await self._upload_checkpoint()
         return True
 
+    async def _download_resumable_checkpoint(self) -> Optional[ipc.BackupCheckpoint]:
+        assert self.json_storage
+        checkpoint = await self.download_backup_checkpoint()
+        if checkpoint is None or checkpoint.plugin != self.plugin:
+            return None
+        age = utils.now() - checkpoint.start
+        if age.total_seconds() > self.config.backup_checkpoint_max_age:
+            logger.info("Discarding backup checkpoint started at %s, as it is too old", checkpoint.start)
+            await self.json_storage.delete_json(magic.JSON_BACKUP_CHECKPOINT)
+            return None
+        return checkpoint
+
     hexdigests: Set[str] = set()
 
+    # Packs in the storage, by their hexdigest
+    packs: Dict[str, ipc.SnapshotPack] = {}
+
+    async def _load_packs(self):
+        # Pack index is stored only after the pack itself, and deleted
+        # before it, so the packed hexdigests are in the storage too
+        self.packs = await self.download_packs()
+        self.hexdigests = self.hexdigests | set(hexdigest_to_pack_entry(self.packs.values()))
+
+    def _snapshot_hexdigests(self) -> Set[str]:
+        return set(sshash.hexdigest for snapshot_result in self.result_snapshot for sshash in snapshot_result.hashes or [])
+
+    checkpoint_start: Optional[datetime] = None
+    checkpoint_upload_results: List[ipc.SnapshotUploadResult] = []
+
+    async def _upload_checkpoint(self):
+        assert self.checkpoint_start and self.json_storage
+        # Only the hexdigests of this backup are of interest (and kept by cleanup)
+        snapshot_hexdigests = self._snapshot_hexdigests()
+        checkpoint = ipc.BackupCheckpoint(
+            start=self.checkpoint_start,
+            plugin=self.plugin,
+            upload_results=self.checkpoint_upload_results,
+            hexdigests=sorted(snapshot_hexdigests.intersection(self.hexdigests))
+        )
+        logger.debug("Storing backup checkpoint with %d confirmed hexdigests", len(checkpoint.hexdigests))
+        await self.json_storage.upload_json(magic.JSON_BACKUP_CHECKPOINT, checkpoint)
+
     def _snapshot_results_to_upload_node_index_datas(self) -> List[NodeIndexData]:
         assert len(self.result_snapshot) == len(self.nodes)
         sshash_to_node_indexes: Dict[ipc.SnapshotHash, List[int]] = {}
@@ -128,16 +206,44 @@ class BackupOpBase(OpBase):
             if len(start_result) != 1:
                 return []
             start_results.extend(start_result)
-        return await self.wait_successful_results(start_results, result_class=ipc.SnapshotUploadResult, all_nodes=False)
+        results = await self.wait_successful_results(start_results, result_class=ipc.SnapshotUploadResult, all_nodes=False)
+        if not results:
+            return results
+        assert self.json_storage
+        new_packs = {pack.hexdigest: pack for result in results for pack in result.packs}
+        for pack in new_packs.values():
+            await self.json_storage.upload_json(pack_json_name(pack.hexdigest), pack)
+        self.packs = {**self.packs, **new_packs}
+        if self.hexdigest_inventory is not None:
+            # Packed hexdigests are not objects of their own, but the packs are
+            packed_hexdigests = set(hexdigest_to_pack_entry(new_packs.values()))
+            sizes = {
+                sshash.hexdigest: sshash.size
+                for data in node_index_datas for sshash in data.sshashes if sshash.hexdigest not in packed_hexdigests
+            }
+            sizes.update((pack.hexdigest, pack.size) for pack in new_packs.values())
+            await run_in_threadpool(self.hexdigest_inventory.add, sizes)
+        return results
 
     result_upload_blocks: Union[bool, List[ipc.SnapshotUploadResult]]
 
     async def step_upload_blocks(self):
         node_index_datas = self._snapshot_results_to_upload_node_index_datas()
-        if node_index_datas:
-            upload_results = await self._upload(node_index_datas)
-            return upload_results
-        return True
+        if not self.config.backup_checkpoints:
+            if node_index_datas:
+                upload_results = await self._upload(node_index_datas)
+                return upload_results
+            return True
+        # Upload in batches, and checkpoint after each one, so that
+        # interrupted upload can be resumed from the last batch
+        for batch in split_node_index_datas(node_index_datas, batch_size=self.config.backup_checkpoint_upload_size):
+            upload_results = await self._upload(batch)
+            if not upload_results:
+                return []
+            self.checkpoint_upload_results = self.checkpoint_upload_results + upload_results
+            self.hexdigests = self.hexdigests | set(sshash.hexdigest for data in batch for sshash in data.sshashes)
+            await self._upload_checkpoint()
+        return self.checkpoint_upload_results or True
 
     plugin_data: dict = {}
 
@@ -146,17 +252,32 @@ class BackupOpBase(OpBase):
         assert self.attempt_start
         iso = self.attempt_start.isoformat(timespec="seconds")
         filename = f"{magic.JSON_BACKUP_PREFIX}{iso}"
+        packed = hexdigest_to_pack_entry(self.packs.values())
+        pack_hexdigests = set(
+            packed[hexdigest][0].hexdigest for hexdigest in self._snapshot_hexdigests() if hexdigest in packed
+        )
         manifest = ipc.BackupManifest(
             attempt=self.attempt,
             start=self.attempt_start,
             snapshot_results=self.result_snapshot,
             upload_results=[] if self.result_upload_blocks is True else self.result_upload_blocks,
             plugin=self.plugin,
-            plugin_data=self.plugin_data
+            plugin_data=self.plugin_data,
+            packs=[self.packs[pack_hexdigest] for pack_hexdigest in sorted(pack_hexdigests)]
         )
         logger.debug("Storing backup manifest %s", filename)
-        await self.json_storage.upload_json(filename, manifest)
+        await self.json_storage.upload_json(
+            filename, encode_backup_manifest(manifest, compact=self.config.compact_manifests)
+        )
+        self.manifest_cache.invalidate((self.storage_name, filename))
+        if self.hexdigest_refcounts is not None:
+            await run_in_threadpool(self.hexdigest_refcounts.add_backup, filename, backup_manifest_hexdigests(manifest))
+        summary = manifest_to_list_single_backup(filename, manifest)
+        await self.json_storage.upload_json(backup_summary_name(filename), summary)
+        self.state.list_index.add_backup(self.storage_name, filename, summary)
         self.state.cached_list_response = None  # Invalidate cache
+        if self.config.backup_checkpoints:
+            await self.json_storage.delete_json(magic.JSON_BACKUP_CHECKPOINT)
         return True
 
 
@@ -178,7 +299,10 @@ class RestoreOpBase(OpBase):
         assert self.json_storage
         name = self.req.name
         if not name:
-            return sorted(await self.json_storage.list_jsons())[-1]
+            backups = sorted(b for b in await self.json_storage.list_jsons() if b.startswith(magic.JSON_BACKUP_PREFIX))
+            if not backups:
+                raise exceptions.NotFoundException("No backups found")
+            return backups[-1]
         if name.startswith(magic.JSON_BACKUP_PREFIX):
             return name
         return f"{magic.JSON_BACKUP_PREFIX}{name}"
@@ -200,16 +324,21 @@ class RestoreOpBase(OpBase):
 
         node_to_backup_index = self._get_node_to_backup_index()
         start_results = []
+        # Cleanup may have repacked the packs listed in the manifest;
+        # the current pack indexes tell where the hexdigests are now
+        packs = await self.download_packs() if self.result_backup_manifest.packs else {}
 
         for idx, node in zip(node_to_backup_index, self.nodes):
             if idx is not None:
                 # Restore whatever was backed up
-                root_globs = self.result_backup_manifest.snapshot_results[idx].state.root_globs
+                snapshot_result = self.result_backup_manifest.snapshot_results[idx]
                 req = ipc.SnapshotDownloadRequest(
                     storage=self.restore_storage_name,
                     backup_name=self.result_backup_name,
                     snapshot_index=idx,
-                    root_globs=root_globs
+                    root_globs=snapshot_result.state.root_globs,
+                    shard=snapshot_result.shard,
+                    packs=self._get_snapshot_result_packs(snapshot_result, packs)
                 )
                 op = "download"
             elif self.req.partial_restore_nodes:
@@ -228,6 +357,11 @@ class RestoreOpBase(OpBase):
             start_results, result_class=ipc.NodeResult, all_nodes=not self.req.partial_restore_nodes
         )
 
+    def _get_snapshot_result_packs(self, snapshot_result: ipc.SnapshotResult,
+                                   packs: Dict[str, ipc.SnapshotPack]) -> List[ipc.SnapshotPack]:
+        hexdigests = set(sshash.hexdigest for sshash in snapshot_result.hashes or [])
+        return [pack for pack in packs.values() if any(entry.hexdigest in hexdigests for entry in pack.entries)]
+
     def _get_node_to_backup_index_from_azs(self, *, azs_in_backup, azs_in_nodes):
         node_to_backup_index = [None] * len(self.nodes)
         # This is strictly speaking just best-effort assignment
@@ -0,0 +1,172 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Local index of how many backups refer to each hexdigest.
+
+Finding out which hexdigests are no longer used by any backup would
+otherwise require reading every remaining backup manifest (and listing
+the whole object storage) on every cleanup. Instead the coordinator
+counts the references of the backups it has written, and when backups
+are deleted, the hexdigests whose count drops to zero are the ones to
+delete. They are kept in the index (with count 0) until they have been
+deleted, so interrupted cleanups resume where they left off.
+
+The index also records which backups have been counted, so that
+backups it has missed can be detected (and counted) later. As it might
+still drift from the truth, it is periodically verified with full mark
+and sweep of the storage.
+
+Note that too high counts only leave garbage around (until the next
+verification), while too low counts lead to deleting hexdigests that
+are still in use. Therefore references are added before the backup is
+marked counted, and the mark is removed before the references are.
+
+"""
+
+from astacus.common import ipc
+from astacus.common.journal import JsonJournal
+from pathlib import Path
+from typing import Dict, Iterable, Mapping, Optional, Set
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Journal key under which the time of the last verification is stored
+# (hexdigests are never empty)
+VERIFIED_KEY = ""
+
+# Journal keys of counted backups are backup names with this prefix
+# (which hexdigests never start with)
+BACKUP_KEY_PREFIX = "/"
+
+
+def backup_manifest_hexdigests(manifest: ipc.BackupManifest) -> Set[str]:
+    """ Return the hexdigests the backup refers to """
+    hexdigests: Set[str] = set()
+    for result in manifest.snapshot_results:
+        hexdigests.update(sshash.hexdigest for sshash in result.hashes or [] if sshash.hexdigest)
+        if result.shard:
+            hexdigests.add(result.shard)
+    # Packs are not counted; they are kept as long as some of their
+    # (counted) content is, see CleanupOp.clean_packs
+    return hexdigests
+
+
+class HexDigestRefCounts:
+    def __init__(self, path: Path):
+        self.journal = JsonJournal(path)
+        self.lock = threading.Lock()
+        self.counts: Optional[Dict[str, int]] = None
+        self.backups: Set[str] = set()
+        self.verified = 0.0
+
+    def _load(self) -> Dict[str, int]:
+        if self.counts is None:
+            data = self.journal.load()
+            self.verified = data.pop(VERIFIED_KEY, 0.0)
+            self.backups = set(key[len(BACKUP_KEY_PREFIX):] for key in data if key.startswith(BACKUP_KEY_PREFIX))
+            self.counts = {key: count for key, count in data.items() if not key.startswith(BACKUP_KEY_PREFIX)}
+        return self.counts
+
+    def _append(self, changes: Mapping[str, Optional[int]]):
+        assert self.counts is not None
+        self.journal.append(changes)
+        self.journal.compact_if_needed(len(self.counts) + len(self.backups) + 1)
+
+    def _get_data(self) -> Dict[str, float]:
+        assert self.counts is not None
+        data: Dict[str, float] = dict(self.counts)
+        data.update({f"{BACKUP_KEY_PREFIX}{backup}": 1 for backup in self.backups})
+        data[VERIFIED_KEY] = self.verified
+        return data
+
+    def is_verified_since(self, t: float) -> bool:
+        with self.lock:
+            self._load()
+            return bool(self.verified) and self.verified >= t
+
+    def get_backups(self) -> Set[str]:
+        """ Return the names of the backups whose references are counted """
+        with self.lock:
+            self._load()
+            return set(self.backups)
+
+    def get_unreferenced(self) -> Set[str]:
+        """ Return the hexdigests that are no longer referred to by any backup, and have not been deleted yet """
+        with self.lock:
+            return set(hexdigest for hexdigest, count in self._load().items() if not count)
+
+    def filter_referenced(self, hexdigests: Iterable[str]) -> Set[str]:
+        """ Return the hexdigests which are referred to by some backup """
+        with self.lock:
+            counts = self._load()
+            return set(hexdigest for hexdigest in hexdigests if counts.get(hexdigest))
+
+    def add_backup(self, backup: str, hexdigests: Iterable[str]):
+        """ Count the references of the backup; backups which are already counted are ignored """
+        with self.lock:
+            counts = self._load()
+            if backup in self.backups:
+                return
+            changes: Dict[str, Optional[int]] = {}
+            for hexdigest in set(hexdigests):
+                changes[hexdigest] = counts[hexdigest] = counts.get(hexdigest, 0) + 1
+            self._append(changes)
+            self.backups.add(backup)
+            self._append({f"{BACKUP_KEY_PREFIX}{backup}": 1})
+
+    def remove_backup(self, backup: str, hexdigests: Iterable[str]) -> Set[str]:
+        """Remove the references of the (deleted) backup
+
+        Returns the hexdigests which are no longer referred to by any backup.
+        """
+        with self.lock:
+            counts = self._load()
+            if backup not in self.backups:
+                return set()
+            self.backups.remove(backup)
+            self._append({f"{BACKUP_KEY_PREFIX}{backup}": None})
+            changes: Dict[str, Optional[int]] = {}
+            for hexdigest in set(hexdigests):
+                count = counts.get(hexdigest)
+                if count:
+                    changes[hexdigest] = counts[hexdigest] = count - 1
+            self._append(changes)
+            return set(hexdigest for hexdigest, count in changes.items() if not count)
+
+    def forget(self, hexdigests: Iterable[str]):
+        """ Forget the unreferenced hexdigests, once they have been deleted """
+        with self.lock:
+            counts = self._load()
+            changes = {hexdigest: None for hexdigest in hexdigests if counts.get(hexdigest) == 0}
+            for hexdigest in changes:
+                del counts[hexdigest]
+            self._append(changes)
+
+    def rebuild(self, backup_hexdigests: Mapping[str, Iterable[str]], unreferenced: Iterable[str]) -> int:
+        """Replace the content with counts of the (complete) set of backups
+
+        Unreferenced hexdigests are those found in the storage, which
+        are about to be deleted. Returns the number of hexdigests whose
+        count was wrong.
+        """
+        counts: Dict[str, int] = {hexdigest: 0 for hexdigest in unreferenced}
+        for hexdigests in backup_hexdigests.values():
+            for hexdigest in set(hexdigests):
+                counts[hexdigest] = counts.get(hexdigest, 0) + 1
+        with self.lock:
+            old_counts = self._load()
+            drift = sum(1 for hexdigest, count in counts.items() if count and old_counts.get(hexdigest) != count)
+            drift += sum(1 for hexdigest, count in old_counts.items() if count and hexdigest not in counts)
+            self.counts = counts
+            self.backups = set(backup_hexdigests)
+            self.verified = time.time()
+            self.journal.rewrite(self._get_data())
+        if drift:
+            logger.info("Rebuilt reference counts %s: %d hexdigests differed", self.journal.path, drift)
+        return drift
@@ -9,9 +9,10 @@ By design it cannot be persisted to disk, but e.g. op_info can be if necessary.
 
 """
 
+from .list import BackupListIndex
 from astacus.common import ipc, utils
 from astacus.common.op import OpState
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from fastapi import FastAPI, Request
 from pydantic import Field
 from typing import Optional
@@ -37,6 +38,7 @@ class CoordinatorState(OpState):
     mutated.
     """
     cached_list_response: Optional[CachedListResponse] = None
+    list_index: BackupListIndex = field(default_factory=BackupListIndex)
     cached_list_running: bool = False
     shutting_down: bool = False
 
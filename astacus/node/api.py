@@ -4,13 +4,14 @@ See LICENSE for details
 """
 
 from .clear import ClearOp
+from .config import NodeLimits
 from .download import DownloadOp
 from .node import Node
 from .snapshot import SnapshotOp, UploadOp
 from .state import node_state, NodeState
 from astacus.common import ipc
 from enum import Enum
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 
 router = APIRouter()
 
@@ -54,6 +55,18 @@ def unlock(locker: str, state: NodeState = Depends(node_state)):
     return {"locked": False}
 
 
+@router.get("/limits")
+def limits(n: Node = Depends()):
+    return n.get_limiter().limits
+
+
+@router.put("/limits")
+def set_limits(req: NodeLimits, n: Node = Depends()):
+    # Takes effect immediately, also for already running operations
+    n.get_limiter().set_limits(req)
+    return req
+
+
 @router.post("/snapshot")
 def snapshot(req: ipc.SnapshotRequest, n: Node = Depends()):
     if not n.state.is_locked:
@@ -62,9 +75,26 @@ def snapshot(req: ipc.SnapshotRequest, n: Node = Depends()):
 
 
 @router.get("/snapshot/{op_id}")
-def snapshot_result(*, op_id: int, n: Node = Depends()):
+def snapshot_result(*, op_id: int, summary: bool = False, n: Node = Depends()):
+    op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.snapshot)
+    if summary:
+        # Files and hashes are available via the paged endpoints below
+        return op.get_summary_result()
+    return op.get_full_result()
+
+
+@router.get("/snapshot/{op_id}/files")
+def snapshot_result_files(*, op_id: int, cursor: int = Query(0, ge=0), limit: int = Query(10000, gt=0), n: Node = Depends()):
+    op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.snapshot)
+    return op.get_result_page(part="files", cursor=cursor, limit=limit)
+
+
+@router.get("/snapshot/{op_id}/hashes")
+def snapshot_result_hashes(
+    *, op_id: int, cursor: int = Query(0, ge=0), limit: int = Query(10000, gt=0), n: Node = Depends()
+):
     op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.snapshot)
-    return op.result
+    return op.get_result_page(part="hashes", cursor=cursor, limit=limit)
 
 
 @router.post("/upload")
@@ -77,7 +107,7 @@ def upload(req: ipc.SnapshotUploadRequest, n: Node = Depends()):
 @router.get("/upload/{op_id}")
 def upload_result(*, op_id: int, n: Node = Depends()):
     op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.upload)
-    return op.result
+    return op.get_full_result()
 
 
 @router.post("/download")
@@ -90,7 +120,7 @@ def download(req: ipc.SnapshotDownloadRequest, n: Node = Depends()):
 @router.get("/download/{op_id}")
 def download_result(*, op_id: int, n: Node = Depends()):
     op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.download)
-    return op.result
+    return op.get_full_result()
 
 
 @router.post("/clear")
@@ -103,4 +133,4 @@ def clear(req: ipc.SnapshotClearRequest, n: Node = Depends()):
 @router.get("/clear/{op_id}")
 def clear_result(*, op_id: int, n: Node = Depends()):
     op, _ = n.get_op_and_op_info(op_id=op_id, op_name=OpName.clear)
-    return op.result
+    return op.get_full_result()
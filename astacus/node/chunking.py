@@ -0,0 +1,133 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Content-defined chunking (FastCDC style).
+
+Chunk boundaries are determined by a rolling gear hash of the content,
+so inserting or modifying data within a file only affects the chunks
+around the change; the rest of the chunks (and therefore their
+hashes) stay the same, and need not be stored again.
+
+Normalized chunking is used: before avg_size, boundary is accepted
+only with a stricter mask, and after it with a looser one, which
+keeps chunk sizes closer to avg_size.
+
+If numpy is available, the boundary search computes the gear hashes
+of a whole block of positions at a time (hundreds of MB/s); otherwise
+it falls back to a pure Python loop, which is considerably slower than
+hashing (on the order of 10 MB/s). Both produce the same boundaries.
+
+"""
+
+from typing import Iterator
+
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
+_MASK64 = 2 ** 64 - 1
+
+# Fixed (pseudorandom) per-byte-value table; chunk boundaries (and
+# therefore deduplication) depend on it, so it must never change
+_GEAR = tuple(int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), "big") for i in range(256))
+
+# Gear hash depends only on this many latest bytes, as older ones are shifted out
+_WINDOW = 64
+
+# Positions hashed at a time by the vectorized search; larger blocks
+# waste more work past the boundary, and fall out of the CPU caches
+_BLOCK_SIZE = 2 ** 18
+
+_GEAR_ARRAY = numpy.array(_GEAR, dtype=numpy.uint64) if numpy is not None else None
+
+
+def _mask(bits: int) -> int:
+    # Gear hash shifts left, so the high bits depend on most bytes
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+class Chunker:
+    def __init__(self, *, min_size: int, avg_size: int, max_size: int):
+        assert 0 < min_size <= avg_size <= max_size
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = max(avg_size.bit_length() - 1, 3)
+        self.mask_s = _mask(bits + 2)
+        self.mask_l = _mask(bits - 2)
+
+    def find_boundary(self, data, offset: int = 0) -> int:
+        """ Return the length of the first chunk in data[offset:] (which is at most max_size) """
+        n = min(len(data) - offset, self.max_size)
+        if n <= self.min_size:
+            return n
+        normal_size = min(n, self.avg_size)
+        mv = memoryview(data)[offset:offset + n]
+        if numpy is not None:
+            return self._find_boundary_vectorized(mv, normal_size)
+        fp = 0
+        gear = _GEAR
+        mask = self.mask_s
+        for i, b in enumerate(mv[self.min_size:normal_size], self.min_size):
+            fp = ((fp << 1) + gear[b]) & _MASK64
+            if not fp & mask:
+                return i + 1
+        mask = self.mask_l
+        for i, b in enumerate(mv[normal_size:n], normal_size):
+            fp = ((fp << 1) + gear[b]) & _MASK64
+            if not fp & mask:
+                return i + 1
+        return n
+
+    def _find_boundary_vectorized(self, mv: memoryview, normal_size: int) -> int:
+        # Same as the loop in find_boundary, but hashes of the positions
+        # are computed (and checked) a block at a time
+        n = len(mv)
+        start = self.min_size
+        while start < n:
+            end = min(start + _BLOCK_SIZE, n)
+            # Hash at a position depends on the previous _WINDOW bytes,
+            # but never on the ones before min_size (where hashing starts)
+            first = max(start - _WINDOW + 1, self.min_size)
+            fp = _GEAR_ARRAY[numpy.frombuffer(mv[first:end], dtype=numpy.uint8)]
+            # After the step with shift s, fp[i] is the hash of the
+            # (at most) 2 * s bytes ending at i
+            shift = 1
+            while shift < _WINDOW:
+                fp[shift:] += fp[:-shift] << numpy.uint64(shift)
+                shift *= 2
+            fp = fp[start - first:]
+            split = min(max(normal_size - start, 0), len(fp))
+            for part_offset, part, mask in [(0, fp[:split], self.mask_s), (split, fp[split:], self.mask_l)]:
+                hits = numpy.flatnonzero((part & numpy.uint64(mask)) == 0)
+                if len(hits):
+                    return start + part_offset + int(hits[0]) + 1
+            start = end
+        return n
+
+    def iter_chunks(self, f) -> Iterator[bytes]:
+        """ Split the content of readable file object f to chunks """
+        # Chunks are consumed from the buffer by advancing pos; the
+        # consumed part is dropped only when refilling, so each byte
+        # is moved at most once
+        buf = bytearray()
+        pos = 0
+        eof = False
+        while True:
+            if not eof and len(buf) - pos < self.max_size:
+                del buf[:pos]
+                pos = 0
+                more = f.read(self.max_size * 2)
+                eof = not more
+                buf += more
+                continue
+            if pos == len(buf):
+                return
+            size = self.find_boundary(buf, pos)
+            yield bytes(memoryview(buf)[pos:pos + size])
+            pos += size
@@ -33,7 +33,7 @@ class ClearOp(NodeOp):
         with self.snapshotter.lock:
             self.check_op_id()
             self.snapshotter.snapshot()
-            files = set(self.snapshotter.relative_path_to_snapshotfile.keys())
+            files = set(self.snapshotter.relative_path_to_entry)
             progress = self.result.progress
             progress.start(len(files))
             for relative_path in files:
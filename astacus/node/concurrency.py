@@ -0,0 +1,97 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Adaptive concurrency limit for transfers.
+
+The optimal number of concurrent transfers depends on object sizes,
+object storage latency and its throttling, so instead of using static
+number, the limit is adjusted at runtime (AIMD):
+
+- after each window of limit successful transfers, the throughput of
+  the window is compared to the previous one; if it improved, the limit
+  is increased by one, and if it got worse, decreased by one
+
+- transient errors (e.g. throttling by the object storage) halve the
+  limit immediately
+
+The limit always stays within [min_limit, max_limit].
+
+"""
+
+from typing import Optional
+
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveConcurrency:
+    def __init__(self, *, min_limit: int, max_limit: int, threshold: float = 0.05, time_fun=time.monotonic):
+        assert 0 < min_limit <= max_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.threshold = threshold
+        self.time_fun = time_fun
+        self.cond = threading.Condition()
+        self.limit = min_limit
+        self.active = 0
+        # Highest limit reached so far
+        self.peak_limit = min_limit
+        self.throughput: Optional[float] = None
+        self._start_window()
+
+    def _start_window(self):
+        self.window_start = self.time_fun()
+        self.window_count = 0
+        self.window_size = 0
+
+    def _set_limit(self, limit: int):
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit != self.limit:
+            logger.debug("Concurrency limit %d -> %d", self.limit, limit)
+        self.limit = limit
+        self.peak_limit = max(self.peak_limit, limit)
+        self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """ Wait until there are less than limit transfers active, and then run one """
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.cond.notify()
+
+    def add_success(self, size: int):
+        with self.cond:
+            self.window_count += 1
+            self.window_size += size
+            if self.window_count < self.limit:
+                return
+            elapsed = self.time_fun() - self.window_start
+            if elapsed <= 0:
+                return
+            throughput = self.window_size / elapsed
+            if self.throughput is None or throughput > self.throughput * (1 + self.threshold):
+                self._set_limit(self.limit + 1)
+            elif throughput < self.throughput * (1 - self.threshold):
+                self._set_limit(self.limit - 1)
+            self.throughput = throughput
+            self._start_window()
+
+    def add_throttled(self):
+        with self.cond:
+            self._set_limit(self.limit // 2)
+            # Throughput of the new limit is not comparable to the old one
+            self.throughput = None
+            self._start_window()
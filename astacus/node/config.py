@@ -20,6 +20,59 @@ class NodeParallel(AstacusModel):
     hashes: int = 1
     uploads: int = 1
 
+    # If set (to less than uploads), the number of concurrent uploads
+    # is adjusted at runtime between min_uploads and uploads
+    min_uploads: int = 0
+
+    # If set, files larger than this (that are not chunked) are stored
+    # as separate part_size objects, which are uploaded in parallel
+    # like any other objects
+    part_size: int = 0
+
+    # How many parts (or chunks) of single file are downloaded in parallel
+    part_downloads: int = 1
+
+
+class NodeChunking(AstacusModel):
+    # Files at least this large are split to content-defined chunks,
+    # which are stored (and deduplicated) separately, instead of
+    # storing the whole file as single object
+    min_file_size: int = 64 * 2 ** 20
+
+    # Files larger than this are not chunked, but hashed (and stored)
+    # in fixed size parts like other large files. The chunk boundary
+    # search runs at roughly 200 MB/s with numpy, but only at roughly
+    # 10 MB/s without it (i.e. this bounds the time spent chunking a
+    # single file to minutes even then)
+    max_file_size: int = 2 ** 30
+
+    # Chunk size limits; avg_size should be power of two
+    min_size: int = 2 ** 19
+    avg_size: int = 2 ** 21
+    max_size: int = 2 ** 23
+
+
+class NodePacking(AstacusModel):
+    # Hexdigests at most this large are uploaded concatenated in pack
+    # objects of (roughly) pack_size bytes, instead of separately
+    max_file_size: int = 2 ** 16
+    pack_size: int = 2 ** 24
+
+
+class NodeLimits(AstacusModel):
+    # Node-wide budgets for backup and restore I/O; 0 means unlimited.
+    # These can be also adjusted at runtime via the node API.
+
+    # Bytes read from local files (hashing and uploading)
+    read_bytes_per_second: int = 0
+
+    # Bytes transferred to or from object storage (as stored, i.e.
+    # compressed and encrypted)
+    network_bytes_per_second: int = 0
+
+    # Files opened (hashed, uploaded or downloaded)
+    file_ops_per_second: int = 0
+
 
 class NodeConfig(AstacusModel):
     # Where is the root of the file hierarchy we care about
@@ -39,6 +92,21 @@ class NodeConfig(AstacusModel):
 
     parallel: NodeParallel = Field(default_factory=NodeParallel)
 
+    # If set, large files are snapshotted as content-defined chunks
+    chunking: Optional[NodeChunking] = None
+
+    # If set, small files are uploaded in pack objects
+    packing: Optional[NodePacking] = None
+
+    limits: NodeLimits = Field(default_factory=NodeLimits)
+
+    # Uploads failing due to transient object storage errors are
+    # retried this many times (with jittered exponential backoff
+    # starting from upload_retry_delay seconds), before failing the
+    # whole upload step
+    upload_retries: int = 5
+    upload_retry_delay: float = 1.0
+
 
 def node_config(request: Request) -> NodeConfig:
     return getattr(request.app.state, APP_KEY)
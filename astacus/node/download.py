@@ -13,8 +13,10 @@ API of this module with proper parameters.
 from .node import NodeOp
 from .snapshotter import Snapshotter
 from astacus.common import ipc, utils
+from astacus.common.manifest import parse_backup_manifest, parse_snapshot_state
+from astacus.common.packs import get_pack_entry_data, hexdigest_to_pack_entry
 from astacus.common.storage import Storage, ThreadLocalStorage
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence
 
 import base64
 import contextlib
@@ -26,16 +28,40 @@ logger = logging.getLogger(__name__)
 
 
 class Downloader(ThreadLocalStorage):
-    def __init__(self, *, dst, snapshotter, parallel, storage: Storage):
+    def __init__(
+        self,
+        *,
+        dst,
+        snapshotter,
+        parallel,
+        storage: Storage,
+        part_parallel: int = 1,
+        packs: Sequence[ipc.SnapshotPack] = ()
+    ):
         super().__init__(storage=storage)
         self.dst = dst
         self.snapshotter = snapshotter
         self.parallel = parallel
+        self.part_parallel = part_parallel
+        # Node-wide limiter is shared with the snapshotter
+        self.limiter = snapshotter.limiter
+        self.hexdigest_to_pack_entry = hexdigest_to_pack_entry(packs)
+
+    def _download_pack_data(self, pack: ipc.SnapshotPack) -> bytes:
+        return self.local_storage.download_hexdigest_bytes(pack.hexdigest)
+
+    def _download_hexdigest_to_file(self, hexdigest: str, f):
+        pack_entry = self.hexdigest_to_pack_entry.get(hexdigest)
+        if pack_entry is None:
+            self.local_storage.download_hexdigest_to_file(hexdigest, f)
+            return
+        # Whole files in packs are downloaded in bulk instead (see _download_pack)
+        pack, entry = pack_entry
+        f.write(get_pack_entry_data(self._download_pack_data(pack), entry))
 
     def _snapshotfile_already_exists(self, snapshotfile: ipc.SnapshotFile) -> bool:
-        relative_path = snapshotfile.relative_path
-        existing_snapshotfile = self.snapshotter.relative_path_to_snapshotfile.get(relative_path)
-        return existing_snapshotfile and existing_snapshotfile.equals_excluding_mtime(snapshotfile)
+        existing_entry = self.snapshotter.relative_path_to_entry.get(str(snapshotfile.relative_path))
+        return existing_entry is not None and existing_entry.equals_excluding_mtime(snapshotfile)
 
     def _download_snapshotfile(self, snapshotfile: ipc.SnapshotFile):
         if self._snapshotfile_already_exists(snapshotfile):
@@ -43,14 +69,42 @@ class Downloader(ThreadLocalStorage):
         relative_path = snapshotfile.relative_path
         download_path = self.dst / relative_path
         download_path.parent.mkdir(parents=True, exist_ok=True)
+        self.limiter.file_op()
+        if len(snapshotfile.chunks) > 1 and self.part_parallel > 1:
+            self._download_chunks_in_parallel(download_path, snapshotfile)
+            os.utime(download_path, ns=(snapshotfile.mtime_ns, snapshotfile.mtime_ns))
+            return
         with download_path.open("wb") as f:
             if snapshotfile.hexdigest:
-                self.local_storage.download_hexdigest_to_file(snapshotfile.hexdigest, f)
+                self._download_hexdigest_to_file(snapshotfile.hexdigest, f)
+            elif snapshotfile.chunks:
+                for chunk in snapshotfile.chunks:
+                    self._download_hexdigest_to_file(chunk.hexdigest, f)
             else:
                 assert snapshotfile.content_b64 is not None
                 f.write(base64.b64decode(snapshotfile.content_b64))
         os.utime(download_path, ns=(snapshotfile.mtime_ns, snapshotfile.mtime_ns))
 
+    def _download_chunks_in_parallel(self, download_path, snapshotfile: ipc.SnapshotFile):
+        with download_path.open("wb") as f:
+            f.truncate(snapshotfile.file_size)
+        chunk_offsets = []
+        offset = 0
+        for chunk in snapshotfile.chunks:
+            chunk_offsets.append((chunk, offset))
+            offset += chunk.size
+
+        def _download_chunk(chunk_offset):
+            chunk, offset = chunk_offset
+            with download_path.open("r+b") as f:
+                f.seek(offset)
+                self._download_hexdigest_to_file(chunk.hexdigest, f)
+
+        def _cb(*, map_in, map_out):
+            return True
+
+        utils.parallel_map_to(fun=_download_chunk, iterable=chunk_offsets, result_callback=_cb, n=self.part_parallel)
+
     def _download_snapshotfiles_from_storage(self, snapshotfiles):
         self._download_snapshotfile(snapshotfiles[0])
 
@@ -59,6 +113,23 @@ class Downloader(ThreadLocalStorage):
         for snapshotfile in snapshotfiles[1:]:
             self._copy_snapshotfile(snapshotfiles[0], snapshotfile)
 
+    def _download_pack(self, pack_snapshotfiles: List[List[ipc.SnapshotFile]]):
+        # Pack is downloaded once, and all of its files are written from it
+        data = None
+        for snapshotfiles in pack_snapshotfiles:
+            snapshotfile = snapshotfiles[0]
+            if not self._snapshotfile_already_exists(snapshotfile):
+                pack, entry = self.hexdigest_to_pack_entry[snapshotfile.hexdigest]
+                if data is None:
+                    data = self._download_pack_data(pack)
+                download_path = self.dst / snapshotfile.relative_path
+                download_path.parent.mkdir(parents=True, exist_ok=True)
+                self.limiter.file_op()
+                download_path.write_bytes(get_pack_entry_data(data, entry))
+                os.utime(download_path, ns=(snapshotfile.mtime_ns, snapshotfile.mtime_ns))
+            for other_snapshotfile in snapshotfiles[1:]:
+                self._copy_snapshotfile(snapshotfile, other_snapshotfile)
+
     def _copy_snapshotfile(self, snapshotfile_src: ipc.SnapshotFile, snapshotfile: ipc.SnapshotFile):
         if self._snapshotfile_already_exists(snapshotfile):
             return
@@ -70,20 +141,46 @@ class Downloader(ThreadLocalStorage):
 
     def download_from_storage(self, *, progress, snapshotstate: ipc.SnapshotState, still_running_callback=lambda: True):
         hexdigest_to_snapshotfiles: Dict[str, List[ipc.SnapshotFile]] = {}
+        chunked_snapshotfiles = []
         valid_relative_path_set = set()
         for snapshotfile in snapshotstate.files:
-            valid_relative_path_set.add(snapshotfile.relative_path)
+            valid_relative_path_set.add(str(snapshotfile.relative_path))
             if snapshotfile.hexdigest:
                 hexdigest_to_snapshotfiles.setdefault(snapshotfile.hexdigest, []).append(snapshotfile)
+            elif snapshotfile.chunks:
+                chunked_snapshotfiles.append([snapshotfile])
 
         self.snapshotter.snapshot()
         # TBD: Error checking, what to do if we're told to restore to existing directory?
         progress.start(sum(1 + snapshotfile.file_size for snapshotfile in snapshotstate.files))
         for snapshotfile in snapshotstate.files:
-            if not snapshotfile.hexdigest:
+            if not snapshotfile.hexdigest and not snapshotfile.chunks:
                 self._download_snapshotfile(snapshotfile)
                 progress.download_success(snapshotfile.file_size + 1)
-        all_snapshotfiles = hexdigest_to_snapshotfiles.values()
+
+        # Files in packs are downloaded pack at a time
+        pack_to_snapshotfiles: Dict[str, List[List[ipc.SnapshotFile]]] = {}
+        for hexdigest in list(hexdigest_to_snapshotfiles):
+            pack_entry = self.hexdigest_to_pack_entry.get(hexdigest)
+            if pack_entry is not None:
+                pack_to_snapshotfiles.setdefault(pack_entry[0].hexdigest,
+                                                 []).append(hexdigest_to_snapshotfiles.pop(hexdigest))
+
+        def _pack_cb(*, map_in, map_out):
+            pack_snapshotfiles = map_in
+            progress.download_success(
+                sum((snapshotfiles[0].file_size + 1) * len(snapshotfiles) for snapshotfiles in pack_snapshotfiles)
+            )
+            return still_running_callback()
+
+        if not utils.parallel_map_to(
+            fun=self._download_pack, iterable=pack_to_snapshotfiles.values(), result_callback=_pack_cb, n=self.parallel
+        ):
+            progress.add_fail()
+            progress.done()
+            return
+
+        all_snapshotfiles = list(hexdigest_to_snapshotfiles.values()) + chunked_snapshotfiles
 
         def _cb(*, map_in, map_out):
             snapshotfiles = map_in
@@ -103,7 +200,7 @@ class Downloader(ThreadLocalStorage):
             return
 
         # Delete files that were not supposed to exist
-        for relative_path in set(self.snapshotter.relative_path_to_snapshotfile.keys()).difference(valid_relative_path_set):
+        for relative_path in set(self.snapshotter.relative_path_to_entry).difference(valid_relative_path_set):
             absolute_path = self.dst / relative_path
             with contextlib.suppress(FileNotFoundError):
                 absolute_path.unlink()
@@ -124,8 +221,15 @@ class DownloadOp(NodeOp):
     def download(self):
         assert self.snapshotter
         # Actual 'restore from backup'
-        manifest = ipc.BackupManifest.parse_obj(self.storage.download_json(self.req.backup_name))
-        snapshotstate = manifest.snapshot_results[self.req.snapshot_index].state
+        if self.req.shard:
+            # Only the state of this node is needed
+            snapshotstate = parse_snapshot_state(self.storage.download_hexdigest_bytes(self.req.shard))
+            packs = self.req.packs
+        else:
+            manifest = parse_backup_manifest(self.storage.download_json(self.req.backup_name))
+            snapshotstate = manifest.snapshot_results[self.req.snapshot_index].state
+            # Older coordinators send the packs only along with shards
+            packs = self.req.packs or manifest.packs
 
         # 'snapshotter' is global; ensure we have sole access to it
         with self.snapshotter.lock:
@@ -134,7 +238,9 @@ class DownloadOp(NodeOp):
                 dst=self.config.root,
                 snapshotter=self.snapshotter,
                 storage=self.storage,
-                parallel=self.config.parallel.downloads
+                parallel=self.config.parallel.downloads,
+                part_parallel=self.config.parallel.part_downloads,
+                packs=packs
             )
             downloader.download_from_storage(
                 snapshotstate=snapshotstate,
@@ -0,0 +1,69 @@
+"""
+
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Node-wide rate limiting of the backup and restore I/O.
+
+Single Limiter is shared by everything that reads or writes backup
+data on the node (Snapshotter hashing, Uploader and Downloader), so
+that the total impact on the (live) database node stays within the
+configured budgets. The budgets can be changed at runtime.
+
+"""
+
+from .config import NodeLimits
+from astacus.common.tokenbucket import TokenBucket
+
+import threading
+
+
+class Limiter:
+    def __init__(self, limits: NodeLimits, **kw):
+        self.read_bytes = TokenBucket(**kw)
+        self.network_bytes = TokenBucket(**kw)
+        self.file_ops = TokenBucket(**kw)
+        self.lock = threading.Lock()
+        # Total time spent waiting (summed over all threads)
+        self.throttled_seconds = 0.0
+        self.limits = limits
+        self.set_limits(limits)
+
+    def set_limits(self, limits: NodeLimits):
+        self.limits = limits
+        self.read_bytes.set_rate(limits.read_bytes_per_second)
+        self.network_bytes.set_rate(limits.network_bytes_per_second)
+        self.file_ops.set_rate(limits.file_ops_per_second)
+
+    def _consume(self, bucket: TokenBucket, amount: int):
+        waited = bucket.consume(amount)
+        if waited:
+            with self.lock:
+                self.throttled_seconds += waited
+
+    def read(self, size: int):
+        self._consume(self.read_bytes, size)
+
+    def network(self, size: int):
+        self._consume(self.network_bytes, size)
+
+    def file_op(self, count: int = 1):
+        self._consume(self.file_ops, count)
+
+
+class LimitedReader:
+    """ Readable file wrapper which applies the read limit to the data read through it """
+    def __init__(self, f, *, limiter: Limiter):
+        self._f = f
+        self._limiter = limiter
+
+    def read(self, n=None):
+        data = self._f.read(n)
+        self._limiter.read(len(data))
+        return data
+
+    def seek(self, ofs, whence=0):
+        return self._f.seek(ofs, whence)
+
+    def tell(self):
+        return self._f.tell()
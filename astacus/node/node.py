@@ -5,6 +5,7 @@ See LICENSE for details
 """
 
 from .config import node_config, NodeConfig
+from .limiter import Limiter
 from .snapshotter import Snapshotter
 from .state import node_state, NodeState
 from astacus.common import ipc, magic, op, statsd, utils
@@ -16,6 +17,7 @@ import logging
 
 logger = logging.getLogger(__name__)
 SNAPSHOTTER_KEY = "node_snapshotter"
+LIMITER_KEY = "node_limiter"
 
 
 class NodeOp(op.Op):
@@ -31,15 +33,24 @@ class NodeOp(op.Op):
         self.result.az = self.config.az
         self.get_or_create_snapshotter = n.get_or_create_snapshotter
         self.get_snapshotter = n.get_snapshotter
+        self.limiter = n.get_limiter()
+        self._throttled_seconds_at_start = self.limiter.throttled_seconds
         # TBD: Could start some worker thread to send the self.result periodically
         # (or to some local start method )
 
     def create_result(self):
         return ipc.NodeResult()
 
+    def get_summary_result(self) -> ipc.NodeResult:
+        """ Return the result to be sent to the coordinator; subclasses may leave out the bulk """
+        return self.result
+
     @property
     def storage(self):
-        return RohmuStorage(self.config.object_storage, storage=self.req.storage)
+        storage = RohmuStorage(self.config.object_storage, storage=self.req.storage)
+        # Network budget is charged for the data as transferred (i.e. compressed and encrypted)
+        storage.network_callback = self.limiter.network
+        return storage
 
     def still_running_callback(self):
         if self.info.op_id != self.op_id:
@@ -54,7 +65,10 @@ class NodeOp(op.Op):
         if not self.still_running_callback():
             logger.debug("send_result omitted - not running")
             return
-        result_json = self.result.json(exclude_defaults=True)
+        # Limiter is node-wide, so this includes also throttling of
+        # any concurrently running operations (if any)
+        self.result.throttled_seconds = self.limiter.throttled_seconds - self._throttled_seconds_at_start
+        result_json = self.get_summary_result().json(exclude_defaults=True)
         if result_json == self._sent_result_json:
             return
         self._sent_result_json = result_json
@@ -99,9 +113,21 @@ class Node(op.OpMixin):
         root_link.mkdir(exist_ok=True)
 
         def _create_snapshotter():
-            return Snapshotter(src=self.config.root, dst=root_link, globs=root_globs, parallel=self.config.parallel.hashes)
+            return Snapshotter(
+                src=self.config.root,
+                dst=root_link,
+                globs=root_globs,
+                parallel=self.config.parallel.hashes,
+                index_path=root_link / magic.ASTACUS_TMPDIR / magic.SNAPSHOT_INDEX_FILENAME,
+                chunking=self.config.chunking,
+                part_size=self.config.parallel.part_size,
+                limiter=self.get_limiter()
+            )
 
         return utils.get_or_create_state(app=self.request.app, key=SNAPSHOTTER_KEY, factory=_create_snapshotter)
 
     def get_snapshotter(self):
         return getattr(self.request.app.state, SNAPSHOTTER_KEY)
+
+    def get_limiter(self) -> Limiter:
+        return utils.get_or_create_state(app=self.request.app, key=LIMITER_KEY, factory=lambda: Limiter(self.config.limits))
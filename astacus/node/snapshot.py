@@ -11,10 +11,11 @@ this module with proper parameters.
 """
 
 from .node import NodeOp
-from .snapshotter import Snapshotter
+from .snapshotter import SnapshotEntry, Snapshotter
 from .uploader import Uploader
 from astacus.common import ipc, utils
-from typing import Optional
+from astacus.common.manifest import encode_snapshot_files
+from typing import List, Optional, Tuple
 
 import hashlib
 import logging
@@ -26,6 +27,11 @@ logger = logging.getLogger(__name__)
 
 class SnapshotOp(NodeOp):
     snapshotter: Optional[Snapshotter] = None
+    # The files and hashes of the result are kept only as these
+    # (compact) entries, and converted to the (much larger) models
+    # when they are actually requested
+    entries: List[SnapshotEntry] = []
+    digest_sizes: List[Tuple[bytes, int]] = []
 
     def create_result(self):
         return ipc.SnapshotResult()
@@ -41,17 +47,67 @@ class SnapshotOp(NodeOp):
         with self.snapshotter.lock:
             self.check_op_id()
             self.snapshotter.snapshot(progress=self.result.progress)
-            self.result.state = self.snapshotter.get_snapshot_state()
-            self.result.hashes = [
-                ipc.SnapshotHash(hexdigest=ssfile.hexdigest, size=ssfile.file_size)
-                for ssfile in self.result.state.files
-                if ssfile.hexdigest
-            ]
-            self.result.files = len(self.result.state.files)
-            self.result.total_size = sum(ssfile.file_size for ssfile in self.result.state.files)
+            self.entries = self.snapshotter.get_snapshot_entries()
+            # Includes also the chunks of chunked files
+            self.digest_sizes = self.snapshotter.get_snapshot_digest_sizes()
+            self.result.files = len(self.entries)
+            self.result.total_size = sum(entry.file_size for entry in self.entries)
+            self.result.state = ipc.SnapshotState(root_globs=self.snapshotter.globs, files=[])
+            self.result.hashes = []
+            if self.req.storage:
+                self.upload_shard()
             self.result.end = utils.now()
             self.result.progress.done()
 
+    def upload_shard(self):
+        # Shards are named after their content, like other hexdigests,
+        # so unchanged state is not stored again (and cleanup handles them)
+        data = encode_snapshot_files(
+            root_globs=self.result.state.root_globs, files=(entry.to_snapshotfile() for entry in self.entries)
+        )
+        hexdigest = _hash(data).hexdigest()
+        self.storage.upload_hexdigest_bytes(hexdigest, data)
+        self.result.shard = hexdigest
+        self.entries = []
+
+    def _get_hashes(self, digest_sizes: List[Tuple[bytes, int]]) -> List[ipc.SnapshotHash]:
+        return [ipc.SnapshotHash(hexdigest=digest.hex(), size=size) for digest, size in digest_sizes]
+
+    def get_full_result(self) -> ipc.SnapshotResult:
+        """ Return the result including all of the files and hashes """
+        if self.result.state is None:
+            return self.result
+        return self.result.copy(
+            update={
+                "state": self.result.state.copy(update={"files": [entry.to_snapshotfile() for entry in self.entries]}),
+                "hashes": self._get_hashes(self.digest_sizes)
+            }
+        )
+
+    def get_summary_result(self) -> ipc.SnapshotResult:
+        """Return the result without the (potentially huge) list of files and hashes
+
+        This is also what is sent to the coordinator, which then pulls the pages it needs.
+        """
+        if self.result.state is None:
+            return self.result
+        return self.result.copy(update={"paged": True})
+
+    def get_result_page(self, *, part: str, cursor: int, limit: int) -> ipc.SnapshotResultPage:
+        assert part in ("files", "hashes")
+        if self.result.state is None:
+            return ipc.SnapshotResultPage(next_cursor=None)
+        end = cursor + limit
+        if part == "files":
+            return ipc.SnapshotResultPage(
+                files=[entry.to_snapshotfile() for entry in self.entries[cursor:end]],
+                next_cursor=end if end < len(self.entries) else None
+            )
+        return ipc.SnapshotResultPage(
+            hashes=self._get_hashes(self.digest_sizes[cursor:end]),
+            next_cursor=end if end < len(self.digest_sizes) else None
+        )
+
 
 class UploadOp(NodeOp):
     def create_result(self):
@@ -68,11 +124,22 @@ class UploadOp(NodeOp):
         # 'snapshotter' is global; ensure we have sole access to it
         with snapshotter.lock:
             self.check_op_id()
-            self.result.total_size, self.result.total_stored_size = uploader.write_hashes_to_storage(
+            totals = uploader.write_hashes_to_storage(
                 snapshotter=snapshotter,
                 hashes=self.req.hashes,
                 parallel=self.config.parallel.uploads,
+                min_parallel=self.config.parallel.min_uploads,
                 progress=self.result.progress,
-                still_running_callback=self.still_running_callback
+                still_running_callback=self.still_running_callback,
+                retries=self.config.upload_retries,
+                retry_delay=self.config.upload_retry_delay,
+                packing=self.config.packing
             )
+            self.result.total_size = totals.total_size
+            self.result.total_stored_size = totals.total_stored_size
+            self.result.total_read_size = totals.total_read_size
+            self.result.retries = totals.retries
+            self.result.compression_skipped_size = totals.compression_skipped_size
+            self.result.compression_skipped_seconds = totals.compression_skipped_seconds
+            self.result.packs = totals.packs
             self.result.progress.done()
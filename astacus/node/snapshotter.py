@@ -5,16 +5,24 @@ See LICENSE for details
 
 """
 
+from .chunking import Chunker
+from .config import NodeChunking, NodeLimits
+from .limiter import LimitedReader, Limiter
 from astacus.common import magic, utils
 from astacus.common.ipc import SnapshotFile, SnapshotHash, SnapshotState
+from astacus.common.journal import JsonJournal
 from astacus.common.progress import increase_worth_reporting, Progress
+from astacus.common.utils import SizeLimitedFile
+from multiprocessing.dummy import Pool  # fastapi + fork = bad idea
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import base64
+import fnmatch
 import hashlib
 import logging
 import os
+import re
 import threading
 
 logger = logging.getLogger(__name__)
@@ -32,6 +40,181 @@ def hash_hexdigest_readable(f, *, read_buffer=1_000_000):
     return h.hexdigest()
 
 
+def hash_parts_readable(f, *, part_size, read_buffer=1_000_000):
+    """ Yield (digest, size) of each consecutive part_size part of the readable """
+    while True:
+        h = _hash()
+        size = 0
+        while size < part_size:
+            data = f.read(min(read_buffer, part_size - size))
+            if not data:
+                break
+            h.update(data)
+            size += len(data)
+        if not size:
+            return
+        yield h.digest(), size
+        if size < part_size:
+            return
+
+
+# Compiled glob is sequence of per-path-component matchers; None matches
+# any number of directories ('**')
+_CompiledGlob = Tuple[Optional[Callable], ...]
+
+
+def _compile_glob(glob: str) -> _CompiledGlob:
+    return tuple(None if part == "**" else re.compile(fnmatch.translate(part)).match for part in glob.split("/"))
+
+
+def _expand_glob_states(compiled_globs: List[_CompiledGlob], states):
+    # '**' may also match zero directories
+    result = set(states)
+    todo = list(states)
+    while todo:
+        glob_index, part_index = todo.pop()
+        if part_index < len(compiled_globs[glob_index]) - 1 and compiled_globs[glob_index][part_index] is None:
+            state = (glob_index, part_index + 1)
+            if state not in result:
+                result.add(state)
+                todo.append(state)
+    return frozenset(result)
+
+
+def walk_files(basepath: Path, globs: List[str]) -> Iterator[Tuple[str, int]]:
+    """Yield (relative path, inode) of the regular files matching any of the globs.
+
+    This is equivalent to Path.glob for each glob separately, except
+    that all globs are matched during single os.scandir based walk of
+    the tree, symlinks are never followed, and directories named
+    magic.ASTACUS_TMPDIR are skipped altogether.
+    """
+    compiled_globs = [_compile_glob(glob) for glob in globs]
+    todo = [("", _expand_glob_states(compiled_globs, {(i, 0) for i in range(len(compiled_globs))}))]
+    while todo:
+        relative_dir, states = todo.pop()
+        try:
+            it = os.scandir(os.path.join(basepath, relative_dir))
+        except (FileNotFoundError, NotADirectoryError):
+            # Directory disappeared during the walk
+            continue
+        with it:
+            for entry in it:
+                relative_path = os.path.join(relative_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name == magic.ASTACUS_TMPDIR:
+                        continue
+                    subdir_states = set()
+                    for glob_index, part_index in states:
+                        compiled_glob = compiled_globs[glob_index]
+                        matcher = compiled_glob[part_index]
+                        if matcher is None:
+                            subdir_states.add((glob_index, part_index))
+                        elif part_index < len(compiled_glob) - 1 and matcher(entry.name):
+                            subdir_states.add((glob_index, part_index + 1))
+                    if subdir_states:
+                        todo.append((relative_path, _expand_glob_states(compiled_globs, subdir_states)))
+                elif entry.is_file(follow_symlinks=False):
+                    for glob_index, part_index in states:
+                        compiled_glob = compiled_globs[glob_index]
+                        matcher = compiled_glob[part_index]
+                        if part_index == len(compiled_glob) - 1 and matcher is not None and matcher(entry.name):
+                            yield relative_path, entry.inode()
+                            break
+
+
+def _relative_path_sort_key(relative_path: str):
+    # Same order as that of the corresponding Path objects
+    return relative_path.split("/")
+
+
+class SnapshotEntry:
+    """Compact in-memory representation of a snapshotted file.
+
+    Snapshotter may track millions of files, so instead of pydantic
+    ipc.SnapshotFile objects it keeps these around; they are converted
+    to ipc.SnapshotFile only when the state is sent out. The
+    relative_path (str) object is shared with the snapshotter's
+    relative_path_to_entry key, and the digest is stored as bytes
+    instead of hex string.
+
+    Chunked files have no digest; instead, their content is described
+    by chunks, which is sequence of (digest, size) tuples.
+    """
+
+    __slots__ = ("relative_path", "file_size", "mtime_ns", "digest", "content_b64", "chunks")
+
+    def __init__(
+        self,
+        *,
+        relative_path: str,
+        file_size: int,
+        mtime_ns: int,
+        digest: bytes = b"",
+        content_b64: Optional[str] = None,
+        chunks: Tuple[Tuple[bytes, int], ...] = ()
+    ):
+        self.relative_path = relative_path
+        self.file_size = file_size
+        self.mtime_ns = mtime_ns
+        self.digest = digest
+        self.content_b64 = content_b64
+        self.chunks = chunks
+
+    def __repr__(self):
+        return (
+            f"SnapshotEntry(relative_path={self.relative_path!r}, file_size={self.file_size}, "
+            f"mtime_ns={self.mtime_ns}, hexdigest={self.hexdigest!r})"
+        )
+
+    @property
+    def hexdigest(self) -> str:
+        return self.digest.hex()
+
+    def _chunk_hashes(self) -> List[SnapshotHash]:
+        return [SnapshotHash(hexdigest=digest.hex(), size=size) for digest, size in self.chunks]
+
+    def equals_excluding_mtime(self, snapshotfile: SnapshotFile) -> bool:
+        return (self.relative_path, self.file_size, self.hexdigest, self.content_b64, self._chunk_hashes()) == (
+            str(snapshotfile.relative_path), snapshotfile.file_size, snapshotfile.hexdigest, snapshotfile.content_b64,
+            snapshotfile.chunks
+        )
+
+    def iter_digest_ranges(self) -> Iterator[Tuple[bytes, int, int]]:
+        """ Yield (digest, offset, size) of the stored objects the file content consists of """
+        if self.digest:
+            yield self.digest, 0, self.file_size
+        offset = 0
+        for digest, size in self.chunks:
+            yield digest, offset, size
+            offset += size
+
+    def get_digest_size(self, digest: bytes) -> int:
+        for range_digest, _, size in self.iter_digest_ranges():
+            if range_digest == digest:
+                return size
+        raise KeyError(digest)
+
+    def open_for_reading(self, root_path: Path):
+        return SizeLimitedFile(path=root_path / self.relative_path, file_size=self.file_size)
+
+    def open_digest_for_reading(self, root_path: Path, digest: bytes):
+        for range_digest, offset, size in self.iter_digest_ranges():
+            if range_digest == digest:
+                return SizeLimitedFile(path=root_path / self.relative_path, file_size=size, offset=offset)
+        raise KeyError(digest)
+
+    def to_snapshotfile(self) -> SnapshotFile:
+        return SnapshotFile(
+            relative_path=Path(self.relative_path),
+            file_size=self.file_size,
+            mtime_ns=self.mtime_ns,
+            hexdigest=self.hexdigest,
+            content_b64=self.content_b64,
+            chunks=self._chunk_hashes()
+        )
+
+
 class Snapshotter:
     """Snapshotter keeps track of files on disk, and their hashes.
 
@@ -51,86 +234,197 @@ class Snapshotter:
     eventually replace the old). The lock itself might not need to be
     built-in to Snapshotter, but having it there enables asserting its
     state during public API calls.
+
+    If index_path is provided, the known files and their hashes are
+    also persisted there, so that restarted process does not have to
+    hash every file again. The index is loaded lazily on the first
+    snapshot, and each entry is used only if the size, mtime and inode
+    of the snapshotted file still match.
+
+    If chunking is provided, large enough files (up to its
+    max_file_size) are split to content-defined chunks, which are
+    hashed (and stored) separately. Otherwise, if part_size is
+    provided, files larger than that are
+    split to part_size parts, so that they can be transferred in
+    parallel.
     """
-    def __init__(self, *, src, dst, globs, parallel):
+    def __init__(
+        self,
+        *,
+        src,
+        dst,
+        globs,
+        parallel,
+        index_path: Optional[Path] = None,
+        chunking: Optional[NodeChunking] = None,
+        part_size: int = 0,
+        limiter: Optional[Limiter] = None
+    ):
         assert globs  # model has empty; either plugin or configuration must supply them
         self.src = Path(src)
         self.dst = Path(dst)
         self.globs = globs
-        self.relative_path_to_snapshotfile = {}
-        self.hexdigest_to_snapshotfiles = {}
+        self.relative_path_to_entry: Dict[str, SnapshotEntry] = {}
+        self.digest_to_entries: Dict[bytes, List[SnapshotEntry]] = {}
+        # Sorted relative_path_to_entry keys; None if not known
+        self.sorted_relative_paths: Optional[List[str]] = None
         self.parallel = parallel
         self.lock = threading.Lock()
-
-    def _list_files(self, basepath: Path):
-        result_files = set()
-        for glob in self.globs:
-            for path in basepath.glob(glob):
-                if not path.is_file() or path.is_symlink():
-                    continue
-                relpath = path.relative_to(basepath)
-                for parent in relpath.parents:
-                    if parent.name == magic.ASTACUS_TMPDIR:
-                        break
-                else:
-                    result_files.add(relpath)
-        return sorted(result_files)
+        self.index = JsonJournal(index_path) if index_path else None
+        self.index_loaded = False
+        self.index_dirty: Set[str] = set()
+        self.chunking = chunking
+        self.part_size = part_size
+        self.chunker = Chunker(
+            min_size=chunking.min_size, avg_size=chunking.avg_size, max_size=chunking.max_size
+        ) if chunking else None
+        self.limiter = limiter or Limiter(NodeLimits())
+
+    def _list_files(self, basepath: Path) -> Dict[str, int]:
+        """ Return relative path -> inode of the files to be snapshotted """
+        return dict(walk_files(basepath, self.globs))
 
     def _list_dirs_and_files(self, basepath: Path):
         files = self._list_files(basepath)
-        dirs = {p.parent for p in files}
+        dirs = {os.path.dirname(p) for p in files}
         return sorted(dirs), files
 
-    def _add_snapshotfile(self, snapshotfile: SnapshotFile):
-        old_snapshotfile = self.relative_path_to_snapshotfile.get(snapshotfile.relative_path, None)
-        if old_snapshotfile:
-            self._remove_snapshotfile(old_snapshotfile)
-        self.relative_path_to_snapshotfile[snapshotfile.relative_path] = snapshotfile
-        if snapshotfile.hexdigest:
-            self.hexdigest_to_snapshotfiles.setdefault(snapshotfile.hexdigest, []).append(snapshotfile)
-
-    def _remove_snapshotfile(self, snapshotfile: SnapshotFile):
-        assert self.relative_path_to_snapshotfile[snapshotfile.relative_path] == snapshotfile
-        del self.relative_path_to_snapshotfile[snapshotfile.relative_path]
-        if snapshotfile.hexdigest:
-            self.hexdigest_to_snapshotfiles[snapshotfile.hexdigest].remove(snapshotfile)
-
-    def _snapshotfile_from_path(self, relative_path):
+    def _add_entry(self, entry: SnapshotEntry):
+        old_entry = self.relative_path_to_entry.get(entry.relative_path)
+        if old_entry:
+            self._remove_entry_digest(old_entry)
+        else:
+            self.sorted_relative_paths = None
+        self.relative_path_to_entry[entry.relative_path] = entry
+        for digest in {digest for digest, _, _ in entry.iter_digest_ranges()}:
+            self.digest_to_entries.setdefault(digest, []).append(entry)
+        self.index_dirty.add(entry.relative_path)
+
+    def _remove_entry_digest(self, entry: SnapshotEntry):
+        for digest in {digest for digest, _, _ in entry.iter_digest_ranges()}:
+            entries = self.digest_to_entries[digest]
+            entries.remove(entry)
+            if not entries:
+                del self.digest_to_entries[digest]
+
+    def _remove_entry(self, entry: SnapshotEntry):
+        assert self.relative_path_to_entry[entry.relative_path] is entry
+        del self.relative_path_to_entry[entry.relative_path]
+        self._remove_entry_digest(entry)
+        self.sorted_relative_paths = None
+        self.index_dirty.add(entry.relative_path)
+
+    def _load_index(self):
+        if self.index is None or self.index_loaded:
+            return
+        self.index_loaded = True
+        records = self.index.load()
+        for relative_path, record in records.items():
+            if len(record) != 6:
+                # Written by older version
+                self.index_dirty.add(relative_path)
+                continue
+            file_size, mtime_ns, inode, hexdigest, content_b64, chunks = record
+            try:
+                st = (self.dst / relative_path).stat()
+            except FileNotFoundError:
+                self.index_dirty.add(relative_path)
+                continue
+            if (st.st_size, st.st_mtime_ns, st.st_ino) != (file_size, mtime_ns, inode):
+                self.index_dirty.add(relative_path)
+                continue
+            self._add_entry(
+                SnapshotEntry(
+                    relative_path=relative_path,
+                    file_size=file_size,
+                    mtime_ns=mtime_ns,
+                    digest=bytes.fromhex(hexdigest),
+                    content_b64=content_b64,
+                    chunks=tuple((bytes.fromhex(chunk_hexdigest), size) for chunk_hexdigest, size in chunks)
+                )
+            )
+            self.index_dirty.discard(relative_path)
+        logger.info("Loaded %d/%d entries from %s", len(self.relative_path_to_entry), len(records), self.index.path)
+
+    def _save_index(self):
+        if self.index is None or not self.index_dirty:
+            return
+        changes = {}
+        for relative_path in self.index_dirty:
+            changes[relative_path] = None
+            entry = self.relative_path_to_entry.get(relative_path)
+            if entry is None:
+                continue
+            try:
+                st = (self.dst / relative_path).stat()
+            except FileNotFoundError:
+                continue
+            changes[relative_path] = [
+                entry.file_size, entry.mtime_ns, st.st_ino, entry.hexdigest, entry.content_b64,
+                [[digest.hex(), size] for digest, size in entry.chunks]
+            ]
+        self.index.append(changes)
+        self.index.compact_if_needed(len(self.relative_path_to_entry))
+        self.index_dirty.clear()
+
+    def _entry_from_path(self, relative_path: str) -> SnapshotEntry:
         src_path = self.src / relative_path
         st = src_path.stat()
-        return SnapshotFile(relative_path=relative_path, mtime_ns=st.st_mtime_ns, file_size=st.st_size)
+        return SnapshotEntry(relative_path=relative_path, mtime_ns=st.st_mtime_ns, file_size=st.st_size)
 
     def _get_snapshot_hash_list(self, relative_paths):
         same = 0
         lost = 0
         for relative_path in relative_paths:
-            old_snapshotfile = self.relative_path_to_snapshotfile.get(relative_path)
+            old_entry = self.relative_path_to_entry.get(relative_path)
             try:
-                snapshotfile = self._snapshotfile_from_path(relative_path)
+                entry = self._entry_from_path(relative_path)
             except FileNotFoundError:
                 lost += 1
                 if increase_worth_reporting(lost):
                     logger.debug("#%d. lost - %s disappeared before stat, ignoring", lost, self.src / relative_path)
                 continue
-            if old_snapshotfile:
-                snapshotfile.hexdigest = old_snapshotfile.hexdigest
-                snapshotfile.content_b64 = old_snapshotfile.content_b64
-                if old_snapshotfile == snapshotfile:
-                    same += 1
-                    if increase_worth_reporting(same):
-                        logger.debug("#%d. same - %r in %s is same", same, old_snapshotfile, relative_path)
-                    continue
-            yield snapshotfile
+            if old_entry and (old_entry.file_size, old_entry.mtime_ns) == (entry.file_size, entry.mtime_ns):
+                same += 1
+                if increase_worth_reporting(same):
+                    logger.debug("#%d. same - %r in %s is same", same, old_entry, relative_path)
+                continue
+            yield entry
+
+    def get_entries_for_hexdigest(self, hexdigest: str) -> List[SnapshotEntry]:
+        try:
+            digest = bytes.fromhex(hexdigest)
+        except ValueError:
+            return []
+        return self.digest_to_entries.get(digest, [])
+
+    def get_snapshot_digest_sizes(self) -> List[Tuple[bytes, int]]:
+        """ Return (digest, size) of each distinct hash of the current state """
+        assert self.lock.locked()
+        return [(digest, entries[0].get_digest_size(digest)) for digest, entries in self.digest_to_entries.items()]
 
     def get_snapshot_hashes(self):
+        return [SnapshotHash(hexdigest=digest.hex(), size=size) for digest, size in self.get_snapshot_digest_sizes()]
+
+    def get_snapshot_entries(self) -> List[SnapshotEntry]:
+        """Return the entries of the current state, ordered by relative_path
+
+        Entries are replaced, not modified, once they have been added,
+        so the returned list stays valid after subsequent snapshots.
+        """
         assert self.lock.locked()
-        return [
-            SnapshotHash(hexdigest=dig, size=sf[0].file_size) for dig, sf in self.hexdigest_to_snapshotfiles.items() if sf
-        ]
+        if self.sorted_relative_paths is None:
+            self.sorted_relative_paths = sorted(self.relative_path_to_entry, key=_relative_path_sort_key)
+        return [self.relative_path_to_entry[relative_path] for relative_path in self.sorted_relative_paths]
+
+    def iter_snapshot_files(self) -> Iterator[SnapshotFile]:
+        """ Produce SnapshotFile objects of the current state, ordered by relative_path """
+        for entry in self.get_snapshot_entries():
+            yield entry.to_snapshotfile()
 
     def get_snapshot_state(self):
         assert self.lock.locked()
-        return SnapshotState(root_globs=self.globs, files=sorted(self.relative_path_to_snapshotfile.values()))
+        return SnapshotState(root_globs=self.globs, files=list(self.iter_snapshot_files()))
 
     def _snapshot_create_missing_directories(self, *, src_dirs, dst_dirs):
         changes = 0
@@ -144,12 +438,17 @@ class Snapshotter:
 
     def _snapshot_remove_extra_files(self, *, src_files, dst_files):
         changes = 0
-        for i, relative_path in enumerate(set(dst_files).difference(src_files), 1):
+        # Files which have been replaced in src after they were linked
+        # to dst are also extra; they are removed from dst_files, so
+        # that they get linked again.
+        extra_files = [relative_path for relative_path, inode in dst_files.items() if src_files.get(relative_path) != inode]
+        for i, relative_path in enumerate(extra_files, 1):
             dst_path = self.dst / relative_path
-            snapshotfile = self.relative_path_to_snapshotfile.get(relative_path)
-            if snapshotfile:
-                self._remove_snapshotfile(snapshotfile)
+            entry = self.relative_path_to_entry.get(relative_path)
+            if entry:
+                self._remove_entry(entry)
             dst_path.unlink()
+            del dst_files[relative_path]
             if increase_worth_reporting(i):
                 logger.debug("#%d. extra file: %r", i, relative_path)
             changes += 1
@@ -190,8 +489,10 @@ class Snapshotter:
             progress = Progress()
         progress.start(3)
 
-        src_dirs, src_files = self._list_dirs_and_files(self.src)
-        dst_dirs, dst_files = self._list_dirs_and_files(self.dst)
+        self._load_index()
+
+        with Pool(2) as p:
+            (src_dirs, src_files), (dst_dirs, dst_files) = p.map(self._list_dirs_and_files, [self.src, self.dst])
 
         # Create missing directories
         changes = self._snapshot_create_missing_directories(src_dirs=src_dirs, dst_dirs=dst_dirs)
@@ -209,26 +510,42 @@ class Snapshotter:
         # probably really worth it and due to ignored files it
         # actually might not even work.
 
-        # Then, create/update corresponding snapshotfile objects (old
+        # Then, create/update corresponding entry objects (old
         # ones were already removed)
         dst_dirs, dst_files = self._list_dirs_and_files(self.dst)
-        snapshotfiles = list(self._get_snapshot_hash_list(dst_files))
-        progress.add_total(len(snapshotfiles))
 
-        def _cb(snapshotfile):
+        # Forget files which are no longer in the snapshot (e.g. ones
+        # loaded from index, but not matching the current globs)
+        for relative_path in set(self.relative_path_to_entry).difference(dst_files):
+            self._remove_entry(self.relative_path_to_entry[relative_path])
+            changes += 1
+
+        entries = list(self._get_snapshot_hash_list(dst_files))
+        progress.add_total(len(entries))
+
+        def _cb(entry):
             # src may or may not be present; dst is present as it is in snapshot
-            with snapshotfile.open_for_reading(self.dst) as f:
-                if snapshotfile.file_size <= magic.EMBEDDED_FILE_SIZE:
-                    snapshotfile.content_b64 = base64.b64encode(f.read()).decode()
+            self.limiter.file_op()
+            with entry.open_for_reading(self.dst) as raw_f:
+                f = LimitedReader(raw_f, limiter=self.limiter)
+                if entry.file_size <= magic.EMBEDDED_FILE_SIZE:
+                    entry.content_b64 = base64.b64encode(f.read()).decode()
+                elif self.chunker and self.chunking and (
+                    self.chunking.min_file_size <= entry.file_size <= self.chunking.max_file_size
+                ):
+                    entry.chunks = tuple((_hash(chunk).digest(), len(chunk)) for chunk in self.chunker.iter_chunks(f))
+                elif self.part_size and entry.file_size > self.part_size:
+                    entry.chunks = tuple(hash_parts_readable(f, part_size=self.part_size))
                 else:
-                    snapshotfile.hexdigest = hash_hexdigest_readable(f)
-            return snapshotfile
+                    entry.digest = bytes.fromhex(hash_hexdigest_readable(f))
+            return entry
 
         def _result_cb(*, map_in, map_out):
-            self._add_snapshotfile(map_out)
+            self._add_entry(map_out)
             progress.add_success()
             return True
 
-        changes += len(snapshotfiles)
-        utils.parallel_map_to(iterable=snapshotfiles, fun=_cb, result_callback=_result_cb, n=self.parallel)
+        changes += len(entries)
+        utils.parallel_map_to(iterable=entries, fun=_cb, result_callback=_result_cb, n=self.parallel)
+        self._save_index()
         return changes
@@ -5,73 +5,345 @@ See LICENSE for details
 
 """
 
-from .snapshotter import hash_hexdigest_readable, Snapshotter
-from astacus.common import exceptions, utils
+from .concurrency import AdaptiveConcurrency
+from .config import NodePacking
+from .limiter import LimitedReader
+from .snapshotter import hash_hexdigest_readable, SnapshotEntry, Snapshotter
+from astacus.common import exceptions, ipc, utils
+from astacus.common.packs import PackBuilder
 from astacus.common.progress import Progress
-from astacus.common.storage import ThreadLocalStorage
+from astacus.common.storage import StorageUploadResult, ThreadLocalStorage
+from astacus.common.utils import AstacusModel
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 
+import functools
+import hashlib
 import logging
 
+_hash = hashlib.blake2s
+
 logger = logging.getLogger(__name__)
 
 
+class HashingFile:
+    """Readable file wrapper which hashes the data read through it.
+
+    This way the data is hashed as it is being uploaded, and the file
+    need not be read separately for verification. The hash covers
+    data read sequentially from the start of the file; seeking back to
+    the start resets it (rohmu seeks to the end and back to determine
+    the size), and seeking elsewhere invalidates it.
+    """
+    def __init__(self, f):
+        self._f = f
+        self._hash = _hash()
+        self.hashed_size = 0
+        self.sequential = True
+        # How much was read in total through this wrapper
+        self.read_size = 0
+
+    def read(self, n=None):
+        data = self._f.read(n)
+        self.read_size += len(data)
+        if self.sequential:
+            self._hash.update(data)
+            self.hashed_size += len(data)
+        return data
+
+    def seek(self, ofs, whence=0):
+        position = self._f.seek(ofs, whence)
+        if position == 0:
+            self._hash = _hash()
+            self.hashed_size = 0
+            self.sequential = True
+        elif position != self.hashed_size:
+            self.sequential = False
+        return position
+
+    def tell(self):
+        return self._f.tell()
+
+    def hexdigest(self):
+        return self._hash.hexdigest() if self.sequential else None
+
+
+class UploadTotals(AstacusModel):
+    total_size: int = 0
+    total_stored_size: int = 0
+    # How much was read from disk in order to upload total_size
+    total_read_size: int = 0
+    retries: int = 0
+    # Data stored uncompressed as it was not compressible, and the
+    # estimated CPU time saved by that
+    compression_skipped_size: int = 0
+    compression_skipped_seconds: float = 0
+    packs: List[ipc.SnapshotPack] = []
+
+    def add_upload_result(self, upload_result: StorageUploadResult):
+        self.total_size += upload_result.size
+        self.total_stored_size += upload_result.stored_size
+        if upload_result.compression_skipped:
+            self.compression_skipped_size += upload_result.size
+            self.compression_skipped_seconds += upload_result.compression_skipped_seconds
+
+
+# Upload job is either single hexdigest, or tuple of hexdigests to be uploaded as a pack
+UploadJob = Union[str, Tuple[str, ...]]
+
+
+@dataclass
+class UploadJobResult:
+    # (progress callback, hexdigest) to be reported in the main thread
+    outcomes: List[Tuple[Callable[[str], None], str]] = field(default_factory=list)
+    upload_result: Optional[StorageUploadResult] = None
+    pack: Optional[ipc.SnapshotPack] = None
+    read_size: int = 0
+    retries: int = 0
+
+
+class HashUploader:
+    """Uploads the hashes of single write_hashes_to_storage call.
+
+    The methods other than plan_jobs are called from the worker
+    threads, each of which uses its own copy of the storage.
+    """
+    def __init__(
+        self, *, storage: ThreadLocalStorage, snapshotter: Snapshotter, progress: Progress, concurrency: AdaptiveConcurrency,
+        retries: int, retry_delay: float
+    ):
+        self.storage = storage
+        self.snapshotter = snapshotter
+        # Node-wide limiter is shared with the snapshotter
+        self.limiter = snapshotter.limiter
+        self.progress = progress
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def log_concurrency(self):
+        if self.concurrency.min_limit < self.concurrency.max_limit:
+            logger.info("Upload concurrency limit %d (peak %d)", self.concurrency.limit, self.concurrency.peak_limit)
+
+    def get_hexdigest_size(self, hexdigest: str) -> int:
+        entries = self.snapshotter.get_entries_for_hexdigest(hexdigest)
+        return entries[0].get_digest_size(bytes.fromhex(hexdigest)) if entries else 0
+
+    def plan_jobs(self, hexdigests, *, packing: Optional[NodePacking]) -> List[UploadJob]:
+        """ Return the upload jobs, largest hexdigests last and packs (if any) first """
+        sorted_todo = sorted(hexdigests, key=lambda hexdigest: -self.get_hexdigest_size(hexdigest))
+        jobs: List[UploadJob] = []
+        if packing is not None:
+            # Small hexdigests (at the end of sorted_todo) are uploaded in packs (first)
+            pack_hexdigests: List[str] = []
+            pack_size = 0
+            while sorted_todo and self.get_hexdigest_size(sorted_todo[-1]) <= packing.max_file_size:
+                hexdigest = sorted_todo.pop()
+                size = self.get_hexdigest_size(hexdigest)
+                if pack_hexdigests and pack_size + size > packing.pack_size:
+                    jobs.append(tuple(pack_hexdigests))
+                    pack_hexdigests, pack_size = [], 0
+                pack_hexdigests.append(hexdigest)
+                pack_size += size
+            if pack_hexdigests:
+                jobs.append(tuple(pack_hexdigests))
+        jobs.extend(sorted_todo)
+        return jobs
+
+    def run_job(self, job: UploadJob) -> UploadJobResult:
+        with self.concurrency.slot():
+            if isinstance(job, tuple):
+                return self.upload_pack(job)
+            return self.upload_hexdigest(job)
+
+    def iter_present_entries(self, hexdigest: str) -> Iterator[SnapshotEntry]:
+        """ Yield the entries with the hexdigest, skipping ones whose file has disappeared """
+        for entry in self.snapshotter.get_entries_for_hexdigest(hexdigest):
+            path = self.snapshotter.dst / entry.relative_path
+            if not path.is_file():
+                logger.warning("%s disappeared post-snapshot", path)
+                continue
+            yield entry
+
+    def upload_hexdigest(self, hexdigest: str) -> UploadJobResult:
+        assert hexdigest
+        result = UploadJobResult()
+        storage = self.storage.local_storage
+        for entry in self.iter_present_entries(hexdigest):
+            uploaded = self.retry_transient(
+                functools.partial(self.upload_entry, storage, entry, bytes.fromhex(hexdigest), result),
+                self.snapshotter.dst / entry.relative_path, result
+            )
+            if uploaded is None:
+                result.outcomes.append((self.progress.upload_failure, hexdigest))
+                return result
+            upload_result, uploaded_hexdigest = uploaded
+            if uploaded_hexdigest != hexdigest:
+                logger.info("Hash of %s changed before or during upload", entry.relative_path)
+                storage.delete_hexdigest(hexdigest)
+                continue
+            self.concurrency.add_success(upload_result.size)
+            result.upload_result = upload_result
+            result.outcomes.append((self.progress.upload_success, hexdigest))
+            return result
+
+        # We didn't find single file with the matching hexdigest.
+        # Report it as missing but keep uploading other files.
+        result.outcomes.append((self.progress.upload_missing, hexdigest))
+        return result
+
+    def upload_entry(self, storage, entry: SnapshotEntry, digest: bytes,
+                     result: UploadJobResult) -> Tuple[StorageUploadResult, Optional[str]]:
+        """Upload the entry's digest range, and return (upload result, hexdigest of what was uploaded)
+
+        The file is read only once; it is hashed while it is being
+        uploaded, and if the uploaded content does not match the
+        expected hash (e.g. due to the file changing), the caller
+        deletes the object.
+        """
+        size = entry.get_digest_size(digest)
+        self.limiter.file_op()
+        with entry.open_digest_for_reading(self.snapshotter.dst, digest) as f:
+            # Network bytes are charged by the storage, as stored
+            hashing_f = HashingFile(LimitedReader(f, limiter=self.limiter))
+            try:
+                upload_result = storage.upload_hexdigest_from_file(digest.hex(), hashing_f)
+            finally:
+                result.read_size += hashing_f.read_size
+            uploaded_hexdigest = hashing_f.hexdigest()
+            if uploaded_hexdigest is None or hashing_f.hashed_size != size:
+                # Storage did not read it sequentially to the end; hash separately
+                f.seek(0)
+                hashing_f = HashingFile(LimitedReader(f, limiter=self.limiter))
+                hash_hexdigest_readable(hashing_f)
+                result.read_size += hashing_f.read_size
+                uploaded_hexdigest = hashing_f.hexdigest()
+        return upload_result, uploaded_hexdigest
+
+    def retry_transient(self, fun, what, result: UploadJobResult):
+        """Call fun, retrying it on transient errors, and return what it returns
+
+        Transient errors are retried here, instead of failing (and
+        later retrying) the whole step. Returns None if the upload
+        failed.
+        """
+        for retry in utils.exponential_backoff(
+            initial=self.retry_delay, retries=self.retries, maximum=self.retry_delay * 60, jitter=0.5
+        ):
+            if retry:
+                result.retries += 1
+            try:
+                return fun()
+            except exceptions.TransientException as ex:
+                # Do not pollute logs with transient exceptions
+                logger.debug("Transient exception uploading %r (retry %d/%d): %r", what, retry, self.retries, ex)
+                self.concurrency.add_throttled()
+            except exceptions.AstacusException:
+                # Report failure - whole step will be retried later
+                logger.exception("Exception uploading %r", what)
+                return None
+        logger.warning("Uploading %r failed after %d retries", what, self.retries)
+        return None
+
+    def read_entry_data(self, hexdigest: str, result: UploadJobResult) -> Optional[bytes]:
+        """ Return the content of the hexdigest from the first entry that still has it, if any """
+        digest = bytes.fromhex(hexdigest)
+        for entry in self.iter_present_entries(hexdigest):
+            self.limiter.file_op()
+            with entry.open_digest_for_reading(self.snapshotter.dst, digest) as f:
+                data = LimitedReader(f, limiter=self.limiter).read()
+            result.read_size += len(data)
+            if _hash(data).hexdigest() == hexdigest:
+                return data
+            logger.info("Hash of %s changed before upload", entry.relative_path)
+        return None
+
+    def upload_pack(self, hexdigests: Tuple[str, ...]) -> UploadJobResult:
+        result = UploadJobResult()
+        builder = PackBuilder()
+        for hexdigest in hexdigests:
+            data = self.read_entry_data(hexdigest, result)
+            if data is None:
+                result.outcomes.append((self.progress.upload_missing, hexdigest))
+            else:
+                builder.add(hexdigest, data)
+        if not builder.entries:
+            return result
+        pack, data = builder.build()
+        storage = self.storage.local_storage
+        upload_result = self.retry_transient(
+            functools.partial(storage.upload_hexdigest_bytes, pack.hexdigest, data), f"pack {pack.hexdigest}", result
+        )
+        if upload_result is None:
+            result.outcomes.extend((self.progress.upload_failure, entry.hexdigest) for entry in pack.entries)
+            return result
+        self.concurrency.add_success(upload_result.size)
+        result.upload_result = upload_result
+        result.pack = pack
+        result.outcomes.extend((self.progress.upload_success, entry.hexdigest) for entry in pack.entries)
+        return result
+
+
 class Uploader(ThreadLocalStorage):
     def write_hashes_to_storage(
-        self, *, snapshotter: Snapshotter, hashes, parallel: int, progress: Progress, still_running_callback=lambda: True
+        self,
+        *,
+        snapshotter: Snapshotter,
+        hashes,
+        parallel: int,
+        progress: Progress,
+        still_running_callback=lambda: True,
+        min_parallel: int = 0,
+        retries: int = 0,
+        retry_delay: float = 1.0,
+        packing: Optional[NodePacking] = None
     ):
+        """Upload the hashes to the storage.
+
+        If min_parallel is set (to less than parallel), the number of
+        concurrent uploads is adjusted between min_parallel and
+        parallel based on the observed throughput and transient errors.
+
+        Uploads failing due to transient errors are retried up to
+        retries times, with jittered exponential backoff starting
+        from retry_delay seconds.
+
+        If packing is set, small hashes are uploaded in pack objects
+        (which are returned in UploadTotals.packs).
+
+        Returns UploadTotals.
+        """
+        hash_uploader = HashUploader(
+            storage=self,
+            snapshotter=snapshotter,
+            progress=progress,
+            concurrency=AdaptiveConcurrency(min_limit=min(min_parallel or parallel, parallel), max_limit=parallel),
+            retries=retries,
+            retry_delay=retry_delay
+        )
         todo = set(hash.hexdigest for hash in hashes)
         progress.start(len(todo))
-        sizes = {"total": 0, "stored": 0}
-
-        def _upload_hexdigest_in_thread(hexdigest):
-            storage = self.local_storage
-
-            assert hexdigest
-            files = snapshotter.hexdigest_to_snapshotfiles.get(hexdigest, [])
-            for snapshotfile in files:
-                path = snapshotter.dst / snapshotfile.relative_path
-                if not path.is_file():
-                    logger.warning("%s disappeared post-snapshot", path)
-                    continue
-                with snapshotfile.open_for_reading(snapshotter.dst) as f:
-                    current_hexdigest = hash_hexdigest_readable(f)
-                if current_hexdigest != snapshotfile.hexdigest:
-                    logger.info("Hash of %s changed before upload", snapshotfile.relative_path)
-                    continue
-                try:
-                    with snapshotfile.open_for_reading(snapshotter.dst) as f:
-                        upload_result = storage.upload_hexdigest_from_file(hexdigest, f)
-                except exceptions.TransientException as ex:
-                    # Do not pollute logs with transient exceptions
-                    logger.debug("Transient exception uploading %r: %r", path, ex)
-                    return progress.upload_failure, 0, 0
-                except exceptions.AstacusException:
-                    # Report failure - whole step will be retried later
-                    logger.exception("Exception uploading %r", path)
-                    return progress.upload_failure, 0, 0
-                with snapshotfile.open_for_reading(snapshotter.dst) as f:
-                    current_hexdigest = hash_hexdigest_readable(f)
-                if current_hexdigest != snapshotfile.hexdigest:
-                    logger.info("Hash of %s changed after upload", snapshotfile.relative_path)
-                    storage.delete_hexdigest(hexdigest)
-                    continue
-                return progress.upload_success, upload_result.size, upload_result.stored_size
-
-            # We didn't find single file with the matching hexdigest.
-            # Report it as missing but keep uploading other files.
-            return progress.upload_missing, 0, 0
-
-        def _result_cb(*, map_in, map_out):
+        totals = UploadTotals()
+
+        def _result_cb(*, map_in, map_out: UploadJobResult):
             # progress callback in 'main' thread
-            progress_callback, total, stored = map_out
-            sizes["total"] += total
-            sizes["stored"] += stored
-            progress_callback(map_in)  # hexdigest
+            if map_out.upload_result is not None:
+                totals.add_upload_result(map_out.upload_result)
+            if map_out.pack is not None:
+                totals.packs.append(map_out.pack)
+            totals.total_read_size += map_out.read_size
+            totals.retries += map_out.retries
+            for progress_callback, hexdigest in map_out.outcomes:
+                progress_callback(hexdigest)
             return still_running_callback()
 
-        sorted_todo = sorted(todo, key=lambda hexdigest: -snapshotter.hexdigest_to_snapshotfiles[hexdigest][0].file_size)
-        if not utils.parallel_map_to(
-            fun=_upload_hexdigest_in_thread, iterable=sorted_todo, result_callback=_result_cb, n=parallel
-        ):
+        jobs = hash_uploader.plan_jobs(todo, packing=packing)
+        if not utils.parallel_map_to(fun=hash_uploader.run_job, iterable=jobs, result_callback=_result_cb, n=parallel):
             progress.add_fail()
-        return sizes["total"], sizes["stored"]
+        hash_uploader.log_concurrency()
+        if totals.compression_skipped_size:
+            logger.info(
+                "Stored %d bytes uncompressed, saving estimated %.1f CPU seconds", totals.compression_skipped_size,
+                totals.compression_skipped_seconds
+            )
+        return totals
@@ -0,0 +1,37 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+"""
+
+from astacus.common import journal
+from astacus.common.journal import JsonJournal
+from pathlib import Path
+
+
+def test_journal(tmpdir):
+    path = Path(tmpdir) / "sub" / "journal.jsonl"
+    j = JsonJournal(path)
+    assert not j.load()
+    j.append({"a": 1, "b": [2, 3]})
+    j.append({"a": None, "c": {"d": 4}})
+    assert JsonJournal(path).load() == {"b": [2, 3], "c": {"d": 4}}
+    assert j.records == 4
+
+    # Torn trailing record is ignored, and does not break subsequent appends
+    with path.open("a") as f:
+        f.write('["e", 5')
+    j = JsonJournal(path)
+    assert j.load() == {"b": [2, 3], "c": {"d": 4}}
+    j.append({"e": 5})
+    assert JsonJournal(path).load() == {"b": [2, 3], "c": {"d": 4}, "e": 5}
+
+
+def test_journal_compaction(tmpdir, mocker):
+    mocker.patch.object(journal, "COMPACT_MINIMUM", 0)
+    path = Path(tmpdir) / "journal.jsonl"
+    j = JsonJournal(path)
+    for i in range(10):
+        j.append({"x": i})
+        j.compact_if_needed(1)
+    assert j.records <= 2
+    assert JsonJournal(path).load() == {"x": 9}
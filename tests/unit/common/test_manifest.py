@@ -0,0 +1,68 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+"""
+
+from astacus.common import exceptions, ipc
+from astacus.common.manifest import (
+    COMPACT_MANIFEST_KEY, encode_backup_manifest, encode_snapshot_state, parse_backup_manifest, parse_snapshot_state
+)
+from pathlib import Path
+
+import hashlib
+import json
+import pytest
+
+
+def _create_manifest(*, files, hexdigest=lambda i: hashlib.blake2s(str(i).encode()).hexdigest()):
+    ssfiles = [
+        ipc.SnapshotFile(
+            relative_path=Path(f"dir{i % 7}/sub/file{i}"), file_size=i * 1000, mtime_ns=i, hexdigest=hexdigest(i)
+        ) for i in range(files)
+    ]
+    ssfiles.append(ipc.SnapshotFile(relative_path=Path("small"), file_size=3, mtime_ns=-1, content_b64="Zm9v"))
+    chunks = [ipc.SnapshotHash(hexdigest=hexdigest(i), size=1000) for i in range(3)]
+    ssfiles.append(ipc.SnapshotFile(relative_path=Path("chunked"), file_size=3000, mtime_ns=2, chunks=chunks))
+    hashes = [ipc.SnapshotHash(hexdigest=hexdigest(i), size=i * 1000) for i in range(files)]
+    return ipc.BackupManifest(
+        start="2020-01-01 21:43:00Z",
+        attempt=1,
+        snapshot_results=[
+            ipc.SnapshotResult(
+                state=ipc.SnapshotState(root_globs=["*"], files=sorted(ssfiles)),
+                hashes=hashes,
+                files=len(ssfiles),
+                total_size=sum(ssfile.file_size for ssfile in ssfiles)
+            ),
+            ipc.SnapshotResult(),
+        ],
+        upload_results=[ipc.SnapshotUploadResult(total_size=6, total_stored_size=10)],
+        plugin="files",
+        plugin_data={"foo": "bar"},
+    )
+
+
+@pytest.mark.parametrize("hexdigest", [None, lambda i: f"HASH-{i}"])
+def test_compact_manifest(hexdigest):
+    kw = {"hexdigest": hexdigest} if hexdigest else {}
+    manifest = _create_manifest(files=1000, **kw)
+    data = encode_backup_manifest(manifest, compact=True)
+    assert data[COMPACT_MANIFEST_KEY] == 1
+    assert len(json.dumps(data)) < len(manifest.json()) / 2
+    # Compact manifest round-trips through json storage (and plain json is still read)
+    for stored in [data, json.loads(manifest.json())]:
+        parsed = parse_backup_manifest(json.loads(json.dumps(stored)))
+        assert parsed == manifest
+        assert parsed.json() == manifest.json()
+
+
+def test_compact_manifest_unknown_version():
+    data = encode_backup_manifest(_create_manifest(files=1), compact=True)
+    data[COMPACT_MANIFEST_KEY] = 2
+    with pytest.raises(exceptions.PermanentException):
+        parse_backup_manifest(data)
+
+
+def test_snapshot_state_shard():
+    state = _create_manifest(files=100).snapshot_results[0].state
+    assert parse_snapshot_state(encode_snapshot_state(state)) == state
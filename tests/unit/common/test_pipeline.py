@@ -0,0 +1,55 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+"""
+
+from astacus.common.pipeline import StagedReader
+
+import io
+import os
+import pytest
+import threading
+
+
+class ThreadRecordingReader:
+    def __init__(self, f):
+        self.f = f
+        self.threads = set()
+
+    def read(self, n=-1):
+        self.threads.add(threading.current_thread().name)
+        return self.f.read(n)
+
+
+def test_staged_reader():
+    data = os.urandom(100_000)
+    src = ThreadRecordingReader(io.BytesIO(data))
+    with StagedReader(src, chunk_size=1000, queue_size=2, name="test-read") as staged:
+        # Reads are short only at the end
+        parts = [staged.read(3000) for _ in range(34)]
+    assert [len(part) for part in parts] == [3000] * 33 + [1000]
+    assert b"".join(parts) == data
+    assert src.threads == {"test-read"}
+
+    with StagedReader(io.BytesIO(data), chunk_size=1000) as staged:
+        assert staged.read(10) == data[:10]
+        assert staged.read() == data[10:]
+        assert staged.read() == b""
+
+
+def test_staged_reader_failure():
+    class FailingReader:
+        def read(self, n=-1):
+            raise ValueError("fail")
+
+    with StagedReader(FailingReader()) as staged:
+        with pytest.raises(ValueError):
+            staged.read(10)
+
+
+def test_staged_reader_close_early():
+    # Closing before everything is read stops the thread
+    staged = StagedReader(io.BytesIO(bytes(100_000)), chunk_size=10, queue_size=1)
+    assert staged.read(10) == bytes(10)
+    staged.close()
+    assert not staged._thread.is_alive()  # pylint: disable=protected-access
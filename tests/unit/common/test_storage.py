@@ -8,15 +8,23 @@ TBD: Test with something else than local files?
 
 """
 
-from astacus.common import exceptions
+from astacus.common import exceptions, rohmustorage
 from astacus.common.cachingjsonstorage import CachingJsonStorage
-from astacus.common.rohmustorage import RohmuStorage
+from astacus.common.rohmustorage import is_transient_error, RohmuStorage
 from astacus.common.storage import FileStorage, JsonStorage
 from contextlib import nullcontext as does_not_raise
 from pathlib import Path
+from pghoard import rohmu  # type: ignore
+from pghoard.rohmu import errors  # type: ignore
+from pghoard.rohmu.object_storage.base import IterKeyItem, KEY_TYPE_OBJECT  # type: ignore
 from tests.utils import create_rohmu_config
 
+import contextlib
+import io
+import os
 import pytest
+import socket
+import tempfile
 
 TEST_HEXDIGEST = "deadbeef"
 TEXT_HEXDIGEST_DATA = b"data" * 15
@@ -31,7 +39,7 @@ def create_storage(*, tmpdir, engine, **kw):
         return RohmuStorage(config=config)
     if engine == "file":
         path = Path(tmpdir / "test-storage-file")
-        return FileStorage(path)
+        return FileStorage(path, **kw)
     if engine == "cache":
         # FileStorage cache, and then rohmu filestorage underneath
         cache_storage = FileStorage(Path(tmpdir / "test-storage-file"))
@@ -52,6 +60,10 @@ def _test_hexdigeststorage(storage):
     with pytest.raises(exceptions.NotFoundException):
         storage.delete_hexdigest(TEST_HEXDIGEST + "x")
     assert storage.list_hexdigests() == []
+    # Batch deletion ignores the nonexistent hexdigests
+    storage.upload_hexdigest_bytes(TEST_HEXDIGEST, TEXT_HEXDIGEST_DATA)
+    storage.delete_hexdigests([TEST_HEXDIGEST, TEST_HEXDIGEST + "x"])
+    assert storage.list_hexdigests() == []
 
 
 def _test_jsonstorage(storage):
@@ -83,6 +95,20 @@ def _test_jsonstorage(storage):
             "compression": False,
             "encryption": False
         }, pytest.raises(exceptions.CompressionOrEncryptionRequired)),
+        ("rohmu", {
+            "streaming_uploads": True
+        }, None),
+        ("rohmu", {
+            "streaming_uploads": True,
+            "compression": False
+        }, None),
+        ("rohmu", {
+            "streaming_uploads": True,
+            "encryption": False
+        }, None),
+        ("rohmu", {
+            "hexdigest_shard_depth": 2
+        }, None),
     ]
 )
 def test_storage(tmpdir, engine, kw, ex):
@@ -112,3 +138,335 @@ def test_caching_storage(tmpdir, mocker):
     assert storage.list_jsons() == [TEST_JSON]
     assert not mockdown.called
     assert not mocklist.called
+
+
+@pytest.mark.parametrize("streaming_uploads", [False, True])
+def test_rohmu_storage_multipart(tmpdir, mocker, streaming_uploads):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", streaming_uploads=streaming_uploads)
+    data = os.urandom(100_000) + bytes(200_000)
+    part_size = 8192
+    parts = []
+    store_file_object = storage.storage.store_file_object
+
+    def _store_file_object_multipart(key, fd, **kw):
+        # Like s3 multipart upload
+        while True:
+            part = fd.read(part_size)
+            if not part:
+                break
+            assert len(part) <= part_size
+            parts.append(part)
+        return store_file_object(key, io.BytesIO(b"".join(parts)), **kw)
+
+    mocker.patch.object(storage.storage, "store_file_object", new=_store_file_object_multipart)
+    temporary_file = mocker.spy(tempfile, "TemporaryFile")
+    result = storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    assert temporary_file.called != streaming_uploads
+    assert result.size == len(data)
+    assert result.stored_size == sum(len(part) for part in parts)
+    assert 100_000 < result.stored_size < len(data)
+    assert len(parts) > 1
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == data
+
+
+@pytest.mark.parametrize("engine", ["file", "rohmu"])
+def test_storage_sharded(tmpdir, engine):
+    flat_storage = create_storage(tmpdir=tmpdir, engine=engine)
+    flat_hexdigests = ["f12345", "abcdef", "abcd"]
+    for hexdigest in flat_hexdigests:
+        flat_storage.upload_hexdigest_bytes(hexdigest, hexdigest.encode())
+    assert flat_storage.list_unsharded_hexdigests() == []
+
+    storage = create_storage(tmpdir=tmpdir, engine=engine, hexdigest_shard_depth=2)
+    sharded_hexdigests = [f"{i:02x}{i:02x}ab" for i in range(20)] + ["abcdef0"]
+    for hexdigest in sharded_hexdigests:
+        storage.upload_hexdigest_bytes(hexdigest, hexdigest.encode())
+    # Same object in both layouts is listed once
+    storage.upload_hexdigest_bytes("abcdef", b"abcdef")
+
+    # Flat and sharded keys coexist
+    all_hexdigests = sorted(flat_hexdigests + sharded_hexdigests)
+    assert sorted(storage.list_hexdigests()) == all_hexdigests
+    assert sorted(flat_storage.list_hexdigests()) == all_hexdigests
+    # Too short hexdigests are not sharded
+    assert sorted(storage.list_unsharded_hexdigests()) == ["abcdef", "f12345"]
+    for hexdigest in flat_hexdigests + sharded_hexdigests:
+        assert storage.download_hexdigest_bytes(hexdigest) == hexdigest.encode()
+
+    storage.delete_hexdigest("abcdef")
+    assert storage.download_hexdigest_bytes("abcdef") == b"abcdef"
+    storage.delete_hexdigest("abcdef")
+    with pytest.raises(exceptions.NotFoundException):
+        storage.delete_hexdigest("abcdef")
+
+    storage.migrate_hexdigest("f12345")
+    assert storage.list_unsharded_hexdigests() == []
+    assert storage.download_hexdigest_bytes("f12345") == b"f12345"
+    assert sorted(storage.list_hexdigests()) == sorted(["abcd", "f12345"] + sharded_hexdigests)
+
+
+def test_rohmu_storage_migrated_during_lookup(tmpdir, mocker):
+    flat_storage = create_storage(tmpdir=tmpdir, engine="rohmu")
+    flat_storage.upload_hexdigest_bytes("f12345", b"f12345")
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", hexdigest_shard_depth=2)
+    get_metadata_for_key = storage.storage.get_metadata_for_key
+
+    def _migrate_after_first_lookup(key):
+        try:
+            return get_metadata_for_key(key)
+        finally:
+            if "f12345" in storage.list_unsharded_hexdigests():
+                storage.migrate_hexdigest("f12345")
+
+    # The sharded key is not there yet, but neither is the flat one anymore
+    mocker.patch.object(storage.storage, "get_metadata_for_key", new=_migrate_after_first_lookup)
+    assert storage.download_hexdigest_bytes("f12345") == b"f12345"
+
+
+def test_rohmu_storage_sharded_keys(tmpdir, mocker):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", hexdigest_shard_depth=2, hexdigest_shard_width=1)
+    assert storage._hexdigest_to_key("abcdef0") == "data/a/b/abcdef0"  # pylint: disable=protected-access
+    assert storage._hexdigest_to_key("ab") == "data/ab"  # pylint: disable=protected-access
+    for i in range(20):
+        storage.upload_hexdigest_bytes(f"{i:02x}ff", b"x")
+
+    # Shard prefixes are listed in parallel
+    get_transfer = mocker.spy(rohmu, "get_transfer")
+    assert len(storage.list_hexdigests()) == 20
+    assert 1 <= get_transfer.call_count <= storage.config.list_parallel
+
+
+class FakePrefixTransfer:
+    """ Stand-in for object storage transfer, which lists objects by key prefix """
+    def __init__(self, names, listed):
+        self.names = names
+        self.listed = listed
+
+    def iter_key(self, key, *, with_metadata=True, deep=False, include_key=False):
+        assert deep and include_key and not with_metadata
+        self.listed.append(key)
+        for name in self.names:
+            if name.startswith(key):
+                yield IterKeyItem(type=KEY_TYPE_OBJECT, value={"name": name})
+
+
+@pytest.mark.parametrize("shard_depth", [0, 1])
+def test_rohmu_storage_list_by_prefix(tmpdir, mocker, shard_depth):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", hexdigest_shard_depth=shard_depth)
+    storage.config.list_prefix_length = 2
+    hexdigests = [f"{i:02x}{i:04x}" for i in range(0, 256, 7)]
+    names = [storage._hexdigest_to_key(hexdigest) for hexdigest in hexdigests]  # pylint: disable=protected-access
+    # Also the flat keys not migrated yet
+    names.append("data/abcdef")
+    listed = []
+    mocker.patch.object(rohmu, "get_transfer", return_value=FakePrefixTransfer(names, listed))
+    mocker.patch.object(storage, "storage_config", storage.storage_config.copy(update={"storage_type": "s3"}))
+    assert sorted(storage.list_hexdigests()) == sorted(hexdigests + ["abcdef"])
+    # Fanned out by hexdigest prefix, whatever the layout
+    assert len(listed) == 256
+    assert "data/ab" in listed
+
+
+class FakeS3Client:
+    """ Stand-in for S3 client, which deletes the keys of local rohmu storage """
+    def __init__(self, *, failed=None):
+        self.failed = failed or []
+        self.requests = []
+
+    def delete_objects(self, *, Bucket, Delete):  # pylint: disable=invalid-name
+        assert Bucket == "bucket"
+        assert Delete["Quiet"]
+        keys = [o["Key"] for o in Delete["Objects"]]
+        self.requests.append(keys)
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(f"/{key}")
+        return {"Errors": self.failed}
+
+
+@pytest.mark.parametrize("s3", [False, True])
+def test_rohmu_storage_delete_hexdigests(tmpdir, mocker, s3):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", hexdigest_shard_depth=2, hexdigest_shard_width=1)
+    hexdigests = [f"{i:02x}ff" for i in range(5)]
+    for hexdigest in hexdigests:
+        storage.upload_hexdigest_bytes(hexdigest, b"x")
+    if s3:
+        s3_client = FakeS3Client()
+        mocker.patch.object(storage.storage, "s3_client", new=s3_client, create=True)
+        mocker.patch.object(storage.storage, "bucket_name", new="bucket", create=True)
+        mocker.patch.object(rohmustorage, "S3_DELETE_BATCH_SIZE", new=4)
+    storage.delete_hexdigests(hexdigests[:3] + ["missing"])
+    assert sorted(storage.list_hexdigests()) == hexdigests[3:]
+    if s3:
+        # Both sharded and flat keys of each hexdigest, at most 4 per request
+        assert [len(keys) for keys in s3_client.requests] == [4, 4]
+
+        s3_client.failed = [{"Key": "data/0/3/03ff", "Code": "SlowDown"}]
+        with pytest.raises(exceptions.TransientRohmuException):
+            storage.delete_hexdigests(hexdigests[3:4])
+        s3_client.failed = [{"Key": "data/0/3/03ff", "Code": "AccessDenied"}]
+        with pytest.raises(exceptions.RohmuException):
+            storage.delete_hexdigests(hexdigests[3:4])
+
+
+@pytest.mark.parametrize("streaming_uploads", [False, True])
+@pytest.mark.parametrize("encryption", [False, True])
+def test_rohmu_storage_incompressible(tmpdir, streaming_uploads, encryption):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", streaming_uploads=streaming_uploads, encryption=encryption)
+    storage.config.compression.incompressible_ratio = 0.9
+    random_data = os.urandom(300_000)
+    zero_data = bytes(300_000)
+
+    result = storage.upload_hexdigest_bytes("random", random_data)
+    # Without encryption, data is always compressed
+    assert result.compression_skipped == encryption
+    assert (result.compression_skipped_seconds > 0) == encryption
+    metadata = storage.storage.get_metadata_for_key("data/random")
+    assert ("compression-algorithm" in metadata) != encryption
+
+    result = storage.upload_hexdigest_bytes("zero", zero_data)
+    assert not result.compression_skipped
+    assert not result.compression_skipped_seconds
+    assert result.stored_size < 10_000
+
+    assert storage.download_hexdigest_bytes("random") == random_data
+    assert storage.download_hexdigest_bytes("zero") == zero_data
+
+
+@pytest.mark.parametrize("streaming_uploads", [False, True])
+@pytest.mark.parametrize("kw", [{}, {"compression": False}, {"encryption": False}])
+def test_rohmu_storage_pipeline(tmpdir, mocker, streaming_uploads, kw):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", streaming_uploads=streaming_uploads, **kw)
+    storage.config.pipeline_min_size = 200_000
+    storage.config.pipeline_chunk_size = 8192
+    storage.config.compression.threads = 2
+    staged_reader = mocker.spy(rohmustorage, "StagedReader")
+    zstd_compressor = mocker.spy(rohmustorage.zstd, "ZstdCompressor")
+    data = os.urandom(100_000) + bytes(200_000)
+    result = storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    # Read stage, and one stage per compression and encryption
+    stages = 3 - len(kw)
+    assert staged_reader.call_count == stages
+    if "compression" not in kw:
+        assert zstd_compressor.call_args.kwargs["threads"] == 2
+    else:
+        assert not zstd_compressor.called
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == data
+    if "compression" not in kw:
+        assert 100_000 < result.stored_size < len(data)
+
+    # Small objects are not pipelined
+    storage.upload_hexdigest_bytes("small", b"x" * 1000)
+    assert staged_reader.call_count == stages
+    assert storage.download_hexdigest_bytes("small") == b"x" * 1000
+
+
+@pytest.mark.parametrize("engine,kw", [("file", {}), ("rohmu", {}), ("rohmu", {"streaming_uploads": True})])
+def test_storage_network_callback(tmpdir, engine, kw):
+    storage = create_storage(tmpdir=tmpdir, engine=engine, **kw)
+    transferred = []
+    storage.network_callback = transferred.append
+    data = bytes(200_000)
+    result = storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    # Charged as stored, i.e. compressed and encrypted
+    assert sum(transferred) == result.stored_size
+    if engine == "rohmu":
+        assert result.stored_size < len(data)
+    transferred.clear()
+    assert storage.copy().download_hexdigest_bytes(TEST_HEXDIGEST) == data
+    assert sum(transferred) == result.stored_size
+
+
+@pytest.mark.parametrize("kw", [{}, {"compression": False}, {"encryption": False}])
+@pytest.mark.parametrize("write_size", [7, 1000])
+def test_rohmu_storage_streaming_download(tmpdir, mocker, kw, write_size):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu", **kw)
+    data = os.urandom(100_000) + bytes(200_000)
+    storage.upload_hexdigest_bytes(TEST_HEXDIGEST, data)
+    storage.upload_json(TEST_JSON, TEST_JSON_DATA)
+    get_contents_to_fileobj = storage.storage.get_contents_to_fileobj
+
+    def _get_contents_to_fileobj_in_chunks(key, fileobj_to_store_to, **kw):
+        # Like the real object storages, write the data as it arrives
+        f = io.BytesIO()
+        result = get_contents_to_fileobj(key, f, **kw)
+        stored_data = f.getvalue()
+        for i in range(0, len(stored_data), write_size):
+            fileobj_to_store_to.write(stored_data[i:i + write_size])
+        return result
+
+    mocker.patch.object(storage.storage, "get_contents_to_fileobj", new=_get_contents_to_fileobj_in_chunks)
+    temporary_file = mocker.spy(tempfile, "TemporaryFile")
+    # Only the metadata lookup and the download itself; no size lookup
+    get_file_size = mocker.spy(storage.storage, "get_file_size")
+    assert storage.download_hexdigest_bytes(TEST_HEXDIGEST) == data
+    assert storage.download_json(TEST_JSON) == TEST_JSON_DATA
+    assert not temporary_file.called
+    assert not get_file_size.called
+
+
+def test_rohmu_storage_truncated_encrypted_download(tmpdir, mocker):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu")
+    storage.upload_hexdigest_bytes(TEST_HEXDIGEST, os.urandom(10_000))
+    get_contents_to_fileobj = storage.storage.get_contents_to_fileobj
+
+    def _get_truncated_contents_to_fileobj(key, fileobj_to_store_to, **kw):
+        f = io.BytesIO()
+        result = get_contents_to_fileobj(key, f, **kw)
+        fileobj_to_store_to.write(f.getvalue()[:-1])
+        return result
+
+    mocker.patch.object(storage.storage, "get_contents_to_fileobj", new=_get_truncated_contents_to_fileobj)
+    with pytest.raises(exceptions.RohmuException):
+        storage.download_hexdigest_bytes(TEST_HEXDIGEST)
+
+
+class FakeBotoClientError(Exception):
+    def __init__(self, code, status_code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status_code}}
+
+
+class FakeGoogleHttpError(Exception):
+    class Resp:
+        def __init__(self, status):
+            self.status = status
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.resp = self.Resp(status)
+
+
+class ReadTimeoutError(Exception):
+    # Name of the botocore exception
+    pass
+
+
+def _raise_from(ex, cause):
+    try:
+        raise ex from cause
+    except Exception as ex2:  # pylint: disable=broad-except
+        return ex2
+
+
+@pytest.mark.parametrize(
+    "ex,transient", [
+        (ValueError("foo"), False),
+        (ConnectionResetError(), True),
+        (socket.timeout(), True),
+        (ReadTimeoutError(), True),
+        (FakeBotoClientError("SlowDown", 503), True),
+        (FakeBotoClientError("Throttling", 400), True),
+        (FakeBotoClientError("AccessDenied", 403), False),
+        (FakeGoogleHttpError("429"), True),
+        (FakeGoogleHttpError(500), True),
+        (FakeGoogleHttpError(404), False),
+        (_raise_from(errors.StorageError("wrapped"), ConnectionRefusedError()), True),
+    ]
+)
+def test_rohmu_transient_errors(tmpdir, mocker, ex, transient):
+    storage = create_storage(tmpdir=tmpdir, engine="rohmu")
+    assert is_transient_error(ex) == transient
+    mocker.patch.object(storage.storage, "delete_key", side_effect=ex)
+    with pytest.raises(exceptions.TransientException if transient else exceptions.PermanentException):
+        storage.delete_hexdigest(TEST_HEXDIGEST)
@@ -6,12 +6,13 @@ Test that the coordinator backup endpoint works.
 
 """
 
-from astacus.common import ipc, utils
+from astacus.common import ipc, magic, utils
 from astacus.common.ipc import SnapshotHash
 from astacus.common.statsd import StatsClient
 from astacus.coordinator.api import OpName
+from astacus.coordinator.coordinator import INVENTORIES_KEY
 from astacus.coordinator.plugins import get_plugin_backup_class
-from astacus.coordinator.plugins.base import NodeIndexData
+from astacus.coordinator.plugins.base import BackupOpBase, NodeIndexData, split_node_index_datas
 from unittest.mock import patch
 
 import itertools
@@ -42,7 +43,7 @@ def test_backup(fail_at, app, client, storage):
 
             # Failure point 3: snapshot result call fails
             respx.get(
-                f"{node.url}/snapshot/result",
+                f"{node.url}/snapshot/result?summary=true",
                 content={
                     "progress": {
                         "final": True
@@ -87,11 +88,61 @@ def test_backup(fail_at, app, client, storage):
             assert not storage.list_jsons()
         else:
             assert response.json() == {"state": "done"}
-            assert len(storage.list_jsons()) == 1
+            # Manifest, and its summary
+            assert len(storage.list_jsons()) == 2
 
         assert app.state.coordinator_state.op_info.op_id == 1
 
 
+def test_backup_paged_snapshot_results(app, client, storage):
+    app.state.coordinator_config.poll.result_page_size = 1
+    nodes = app.state.coordinator_config.nodes
+    files = [{"relative_path": f"file{i}", "file_size": 42, "mtime_ns": 0, "hexdigest": f"HASH{i}"} for i in range(3)]
+    hashes = [{"hexdigest": f"HASH{i}", "size": 42} for i in range(3)]
+    with respx.mock:
+        for node in nodes:
+            respx.post(f"{node.url}/unlock?locker=x&ttl=0", content={"locked": False})
+            respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
+            respx.post(f"{node.url}/snapshot", content={"op_id": 42, "status_url": f"{node.url}/snapshot/result"})
+            respx.get(
+                f"{node.url}/snapshot/result?summary=true",
+                content={
+                    "progress": {
+                        "final": True
+                    },
+                    "state": {
+                        "root_globs": ["*"],
+                        "files": []
+                    },
+                    "files": 3,
+                    "hashes": [],
+                    "paged": True
+                }
+            )
+            for part, items in [("files", files), ("hashes", hashes)]:
+                for i, item in enumerate(items):
+                    respx.get(
+                        f"{node.url}/snapshot/result/{part}?cursor={i}&limit=1",
+                        content={
+                            part: [item],
+                            "next_cursor": i + 1 if i + 1 < len(items) else None
+                        }
+                    )
+            respx.post(f"{node.url}/upload", content={"op_id": 43, "status_url": f"{node.url}/upload/result"})
+            respx.get(f"{node.url}/upload/result", content={"progress": {"final": True}})
+        response = client.post("/backup")
+        assert response.status_code == 200, response.json()
+        response = client.get(response.json()["status_url"])
+        assert response.json() == {"state": "done"}
+
+    backups = [name for name in storage.list_jsons() if name.startswith(magic.JSON_BACKUP_PREFIX)]
+    manifest = ipc.BackupManifest.parse_obj(storage.download_json(backups[0]))
+    for result in manifest.snapshot_results:
+        assert not result.paged
+        assert [ssfile.hexdigest for ssfile in result.state.files] == ["HASH0", "HASH1", "HASH2"]
+        assert [sshash.hexdigest for sshash in result.hashes] == ["HASH0", "HASH1", "HASH2"]
+
+
 _BackupOp = get_plugin_backup_class("files")
 
 
@@ -184,7 +235,7 @@ def test_backup_stats(mock_time, app, client):
             respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
             respx.post(f"{node.url}/snapshot", content={"op_id": 42, "status_url": f"{node.url}/snapshot/result"})
             respx.get(
-                f"{node.url}/snapshot/result",
+                f"{node.url}/snapshot/result?summary=true",
                 content={
                     "progress": {
                         "final": True
@@ -207,3 +258,111 @@ def test_backup_stats(mock_time, app, client):
         for mock_call in mock_stats_gauge.call_args_list:
             if mock_call.args[0] == "astacus_op_running_for":
                 assert mock_call.args[1] >= 0
+
+
+@pytest.mark.parametrize(
+    "batch_size,batches", [
+        (100, [[(0, ["a", "b", "c"]), (1, ["d"])]]),
+        (2, [[(0, ["a", "b"]), (1, ["d"])], [(0, ["c"])]]),
+        (1, [[(0, ["a"]), (1, ["d"])], [(0, ["b"])], [(0, ["c"])]]),
+    ]
+)
+def test_split_node_index_datas(batch_size, batches):
+    node_index_datas = [NodeIndexData(node_index=0), NodeIndexData(node_index=1)]
+    for hexdigest in ["a", "b", "c"]:
+        node_index_datas[0].append_sshash(SnapshotHash(hexdigest=hexdigest, size=1))
+    node_index_datas[1].append_sshash(SnapshotHash(hexdigest="d", size=2))
+    got_batches = list(split_node_index_datas(node_index_datas, batch_size=batch_size))
+    assert [[(data.node_index, [sshash.hexdigest
+                                for sshash in data.sshashes])
+             for data in batch]
+            for batch in got_batches] == batches
+
+
+def _mock_backup_nodes(nodes, *, upload_status_code=200):
+    routes = []
+    for node in nodes:
+        respx.post(f"{node.url}/unlock?locker=x&ttl=0", content={"locked": False})
+        respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
+        respx.post(f"{node.url}/snapshot", content={"op_id": 42, "status_url": f"{node.url}/snapshot/result"})
+        respx.get(
+            f"{node.url}/snapshot/result?summary=true",
+            content={
+                "progress": {
+                    "final": True
+                },
+                "hashes": [{
+                    "hexdigest": "HASH",
+                    "size": 42
+                }, {
+                    "hexdigest": f"HASH-{node.url}-1",
+                    "size": 42
+                }, {
+                    "hexdigest": f"HASH-{node.url}-2",
+                    "size": 42
+                }]
+            }
+        )
+        routes.append(
+            respx.post(
+                f"{node.url}/upload",
+                content={
+                    "op_id": 43,
+                    "status_url": f"{node.url}/upload/result"
+                },
+                status_code=upload_status_code
+            )
+        )
+        respx.get(f"{node.url}/upload/result", content={"progress": {"final": True}})
+    return routes
+
+
+@pytest.mark.parametrize("stale", [False, True])
+def test_backup_checkpoint_resume(app, client, storage, stale):
+    app.state.coordinator_config.backup_checkpoints = True
+    app.state.coordinator_config.backup_checkpoint_upload_size = 42
+    app.state.coordinator_config.backup_attempts = 1
+    nodes = app.state.coordinator_config.nodes
+    storage.upload_hexdigest_bytes("HASH", b"x")
+
+    # Upload of the first batch (one hexdigest per node) succeeds, but the second fails
+    with respx.mock:
+        upload_routes = _mock_backup_nodes(nodes)
+        _upload = BackupOpBase._upload
+
+        async def _upload_first_batch(self, node_index_datas):
+            if upload_routes[0].call_count:
+                return []
+            return await _upload(self, node_index_datas)
+
+        with patch.object(BackupOpBase, "_upload", new=_upload_first_batch):
+            response = client.post("/backup")
+            assert response.status_code == 200, response.json()
+            response = client.get(response.json()["status_url"])
+            assert response.json() == {"state": "fail"}
+    assert storage.list_jsons() == [magic.JSON_BACKUP_CHECKPOINT]
+    checkpoint = ipc.BackupCheckpoint.parse_obj(storage.download_json(magic.JSON_BACKUP_CHECKPOINT))
+    # HASH was already stored, and the nodes uploaded one of their own ones
+    assert len(checkpoint.hexdigests) == 3 and "HASH" in checkpoint.hexdigests
+    assert len(checkpoint.upload_results) == 2
+
+    # Meanwhile, the remaining hexdigest of the first node has been stored by someone else
+    remaining = {f"HASH-{nodes[0].url}-1", f"HASH-{nodes[0].url}-2"}.difference(checkpoint.hexdigests)
+    (inventory, ) = getattr(app.state, INVENTORIES_KEY).values()
+    inventory.add({remaining.pop(): 42})
+    if stale:
+        app.state.coordinator_config.backup_checkpoint_max_age = -1
+
+    # Resumed backup uploads only what is missing from both the checkpoint and the storage
+    with respx.mock:
+        upload_routes = _mock_backup_nodes(nodes)
+        response = client.post("/backup")
+        assert response.status_code == 200, response.json()
+        response = client.get(response.json()["status_url"])
+        assert response.json() == {"state": "done"}
+    backups = [name for name in storage.list_jsons() if name.startswith(magic.JSON_BACKUP_PREFIX)]
+    assert len(backups) == 1
+    manifest = ipc.BackupManifest.parse_obj(storage.download_json(backups[0]))
+    assert [route.call_count for route in upload_routes] == [0, 1]
+    # Too old checkpoint is discarded, along with the results of its uploads
+    assert len(manifest.upload_results) == (1 if stale else 3)
@@ -5,7 +5,11 @@ See LICENSE for details
 Test that the cleanup endpoint behaves as advertised
 """
 
-from astacus.common import ipc
+from .test_restore import BACKUP_MANIFEST
+from astacus.common import exceptions, ipc, magic
+from astacus.common.asyncstorage import AsyncJsonStorage
+from astacus.common.packs import pack_json_name, PackBuilder
+from astacus.coordinator.list import manifest_to_list_single_backup
 
 import pytest
 import respx
@@ -13,11 +17,13 @@ import respx
 FAILS = [1, None]
 
 
-def _run(*, client, populated_mstorage, app, fail_at=None, retention, exp_jsons, exp_digests):
+def _run(*, client, populated_mstorage, app, fail_at=None, retention, exp_jsons, exp_digests, checkpoint=None):
     app.state.coordinator_config.retention = retention
     assert len(populated_mstorage.get_storage("x").list_jsons()) == 2
     populated_mstorage.get_storage("x").upload_hexdigest_bytes("TOBEDELETED", b"x")
     assert len(populated_mstorage.get_storage("x").list_hexdigests()) == 2
+    if checkpoint is not None:
+        populated_mstorage.get_storage("x").upload_json(magic.JSON_BACKUP_CHECKPOINT, checkpoint)
     nodes = app.state.coordinator_config.nodes
     with respx.mock:
         for node in nodes:
@@ -78,3 +84,138 @@ def test_api_cleanup_retention(data, client, populated_mstorage, app):
         exp_jsons=exp_jsons,
         exp_digests=exp_digests
     )
+
+
+def test_api_cleanup_keeps_checkpoint_hexdigests(client, populated_mstorage, app):
+    checkpoint = ipc.BackupCheckpoint(start="2020-01-01 21:43:00Z", plugin="files", hexdigests=["TOBEDELETED"])
+    _run(
+        client=client,
+        populated_mstorage=populated_mstorage,
+        app=app,
+        retention=ipc.Retention(maximum_backups=1),
+        exp_jsons=2,
+        exp_digests=2,
+        checkpoint=checkpoint
+    )
+
+
+def _create_packs(storage):
+    # Mostly dead pack (with DEADBEEF still in use), and completely dead one
+    builder = PackBuilder()
+    builder.add("DEADBEEF", b"foobar")
+    builder.add("DEAD", b"x" * 100)
+    pack, data = builder.build()
+    builder = PackBuilder()
+    builder.add("GONE", b"gone")
+    dead_pack, dead_data = builder.build()
+    for p, d in [(pack, data), (dead_pack, dead_data)]:
+        storage.upload_hexdigest_bytes(p.hexdigest, d)
+        storage.upload_json(pack_json_name(p.hexdigest), p)
+    manifest = BACKUP_MANIFEST.copy(update={"start": "2020-01-02 21:43:00Z", "packs": [pack]})
+    storage.upload_json("backup-2", manifest)
+    return pack
+
+
+def _cleanup(client, app, req_json=None):
+    nodes = app.state.coordinator_config.nodes
+    with respx.mock:
+        for node in nodes:
+            respx.post(f"{node.url}/unlock?locker=x&ttl=0", content={"locked": False})
+            respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
+        response = client.post("/cleanup", json=req_json)
+        assert response.status_code == 200, response.json()
+        response = client.get(response.json()["status_url"])
+    return response.json()
+
+
+def _assert_repacked(storage, pack):
+    # Manifest is not modified; the new pack is found using its index
+    manifest = ipc.BackupManifest.parse_obj(storage.download_json("backup-2"))
+    assert manifest.packs == [pack]
+    new_pack_name = next(name for name in storage.list_jsons() if name.startswith(magic.JSON_PACK_PREFIX))
+    new_pack = ipc.SnapshotPack.parse_obj(storage.download_json(new_pack_name))
+    assert [entry.hexdigest for entry in new_pack.entries] == ["DEADBEEF"]
+    assert storage.download_hexdigest_bytes(new_pack.hexdigest) == b"foobar"
+    assert sorted(storage.list_jsons()) == ["backup-2", pack_json_name(new_pack.hexdigest)]
+    assert sorted(storage.list_hexdigests()) == sorted(["DEADBEEF", new_pack.hexdigest])
+
+
+def test_api_cleanup_packs(client, populated_mstorage, app):
+    app.state.coordinator_config.retention = ipc.Retention(maximum_backups=1)
+    storage = populated_mstorage.get_storage("x")
+    pack = _create_packs(storage)
+    assert _cleanup(client, app) == {"state": "done"}
+    _assert_repacked(storage, pack)
+
+
+def test_api_cleanup_packs_interrupted(client, populated_mstorage, app, mocker):
+    app.state.coordinator_config.retention = ipc.Retention(maximum_backups=1)
+    storage = populated_mstorage.get_storage("x")
+    pack = _create_packs(storage)
+    delete_json = AsyncJsonStorage.delete_json
+    crash = True
+
+    async def _crash_deleting_old_pack(self, name):
+        # Interrupted after the new pack has been stored, but before the old one is removed
+        if crash and name == pack_json_name(pack.hexdigest):
+            raise exceptions.TransientException("interrupted")
+        return await delete_json(self, name)
+
+    mocker.patch.object(AsyncJsonStorage, "delete_json", new=_crash_deleting_old_pack)
+    with pytest.raises(exceptions.TransientException):
+        _cleanup(client, app)
+    crash = False
+    packs = [
+        ipc.SnapshotPack.parse_obj(storage.download_json(name))
+        for name in storage.list_jsons()
+        if name.startswith(magic.JSON_PACK_PREFIX)
+    ]
+    # Both old and new pack are usable; nothing has been deleted
+    assert len(packs) == 2
+    assert all("DEADBEEF" in {entry.hexdigest for entry in p.entries} for p in packs)
+    assert {p.hexdigest for p in packs}.issubset(storage.list_hexdigests())
+
+    # Next cleanup (which looks for dangling hexdigests) finishes the job
+    assert _cleanup(client, app, {"verify": True}) == {"state": "done"}
+    _assert_repacked(storage, pack)
+
+
+def test_api_cleanup_keeps_shards(client, populated_mstorage, app):
+    app.state.coordinator_config.retention = ipc.Retention(maximum_backups=1)
+    storage = populated_mstorage.get_storage("x")
+    snapshot_result = BACKUP_MANIFEST.snapshot_results[0].copy(update={"shard": "SHARD"})
+    manifest = BACKUP_MANIFEST.copy(update={"start": "2020-01-02 21:43:00Z", "snapshot_results": [snapshot_result]})
+    storage.upload_json("backup-2", manifest)
+    storage.upload_hexdigest_bytes("SHARD", b"x")
+    storage.upload_hexdigest_bytes("OLDSHARD", b"x")
+
+    nodes = app.state.coordinator_config.nodes
+    with respx.mock:
+        for node in nodes:
+            respx.post(f"{node.url}/unlock?locker=x&ttl=0", content={"locked": False})
+            respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
+        response = client.post("/cleanup")
+        assert response.status_code == 200, response.json()
+        response = client.get(response.json()["status_url"])
+    assert response.json() == {"state": "done"}
+    assert sorted(storage.list_hexdigests()) == ["DEADBEEF", "SHARD"]
+
+
+def test_api_cleanup_deletes_summaries(client, populated_mstorage, app):
+    app.state.coordinator_config.retention = ipc.Retention(maximum_backups=1)
+    storage = populated_mstorage.get_storage("x")
+    manifest = BACKUP_MANIFEST.copy(update={"start": "2020-01-02 21:43:00Z"})
+    storage.upload_json("backup-2", manifest)
+    for name in ["backup-1", "backup-2"]:
+        storage.upload_json(f"summary-{name}", manifest_to_list_single_backup(name, manifest))
+
+    nodes = app.state.coordinator_config.nodes
+    with respx.mock:
+        for node in nodes:
+            respx.post(f"{node.url}/unlock?locker=x&ttl=0", content={"locked": False})
+            respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
+        response = client.post("/cleanup")
+        assert response.status_code == 200, response.json()
+        response = client.get(response.json()["status_url"])
+    assert response.json() == {"state": "done"}
+    assert sorted(storage.list_jsons()) == ["backup-2", "summary-backup-2"]
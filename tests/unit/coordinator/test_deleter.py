@@ -0,0 +1,97 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Test that the hexdigest deleter deletes in parallel batches, within
+the rate limits, and that interrupted deletion can be resumed
+
+"""
+
+from astacus.common.storage import FileStorage
+from astacus.coordinator.config import DeletionConfig
+from astacus.coordinator.deleter import HexDigestDeleter
+from pathlib import Path
+
+import asyncio
+import pytest
+
+
+class BatchFileStorage(FileStorage):
+    """ Local stand-in for storage with batch deletes, which records the batches (and may fail) """
+    def __init__(self, *args, batches, fail_at=None, **kw):
+        super().__init__(*args, **kw)
+        self.batches = batches
+        self.fail_at = fail_at
+
+    def copy(self):
+        return BatchFileStorage(self.path, batches=self.batches, fail_at=self.fail_at)
+
+    def delete_hexdigests(self, hexdigests):
+        if self.fail_at is not None and len(self.batches) == self.fail_at:
+            raise ValueError("failure")
+        self.batches.append(hexdigests)
+        super().delete_hexdigests(hexdigests)
+
+
+def _create_storage(tmpdir, count, **kw):
+    storage = BatchFileStorage(Path(tmpdir) / "storage", batches=[], **kw)
+    hexdigests = [f"{i:04x}" for i in range(count)]
+    for hexdigest in hexdigests:
+        storage.upload_hexdigest_bytes(hexdigest, b"x")
+    return storage, hexdigests
+
+
+@pytest.mark.asyncio
+async def test_deleter(tmpdir):
+    storage, hexdigests = _create_storage(tmpdir, 25)
+    deleter = HexDigestDeleter(storage=storage, config=DeletionConfig(batch_size=10, parallel=2))
+    deleted = []
+
+    async def _on_deleted(batch):
+        deleted.extend(batch)
+
+    # Already deleted hexdigests are ignored
+    await deleter.delete(hexdigests + ["missing"], on_deleted=_on_deleted)
+    assert sorted(len(batch) for batch in storage.batches) == [6, 10, 10]
+    assert sorted(deleted) == sorted(hexdigests + ["missing"])
+    assert not storage.list_hexdigests()
+    assert deleter.progress.finished_successfully
+
+
+@pytest.mark.asyncio
+async def test_deleter_resume(tmpdir):
+    storage, hexdigests = _create_storage(tmpdir, 25, fail_at=1)
+    deleter = HexDigestDeleter(storage=storage, config=DeletionConfig(batch_size=10, parallel=1))
+    deleted = []
+
+    async def _on_deleted(batch):
+        deleted.extend(batch)
+
+    with pytest.raises(ValueError):
+        await deleter.delete(hexdigests, on_deleted=_on_deleted)
+    # Only the completed batch was reported
+    assert deleted == hexdigests[:10]
+    assert sorted(storage.list_hexdigests()) == hexdigests[10:]
+
+    # Retrying the rest (or even everything) finishes the job
+    storage.fail_at = None
+    deleter = HexDigestDeleter(storage=storage, config=DeletionConfig(batch_size=10, parallel=1))
+    await deleter.delete(hexdigests, on_deleted=_on_deleted)
+    assert not storage.list_hexdigests()
+
+
+@pytest.mark.asyncio
+async def test_deleter_rate_limit(tmpdir, mocker):
+    storage, hexdigests = _create_storage(tmpdir, 25)
+    waits = []
+
+    async def _sleep(seconds):
+        waits.append(seconds)
+
+    mocker.patch.object(asyncio, "sleep", new=_sleep)
+    config = DeletionConfig(batch_size=10, parallel=2, hexdigests_per_second=10)
+    deleter = HexDigestDeleter(storage=storage, config=config, time_fun=lambda: 0.0)
+    await deleter.delete(hexdigests)
+    # First batch fits in the initial tokens, and the rest wait for their turn
+    assert sorted(waits) == [1.0, 1.5]
+    assert not storage.list_hexdigests()
@@ -0,0 +1,71 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Test that the coordinator's hexdigest inventory is maintained and used
+instead of listing the object storage
+
+"""
+
+from .test_backup import _mock_backup_nodes
+from astacus.common.rohmustorage import RohmuStorage
+from astacus.coordinator.inventory import HexDigestInventory
+from pathlib import Path
+
+import respx
+
+
+def test_inventory(tmpdir):
+    path = Path(tmpdir) / "inventory.jsonl"
+    inventory = HexDigestInventory(path)
+    assert not inventory.is_reconciled_since(0)
+    inventory.add({"a": 1, "b": 2})
+    inventory.remove(["b", "c"])
+    assert inventory.get_hexdigests() == {"a"}
+
+    inventory = HexDigestInventory(path)
+    assert inventory.get_hexdigests() == {"a"}
+    assert inventory.get_size("a") == 1
+    assert inventory.reconcile(["a", "d"]) == 1
+    assert inventory.get_size("d") == 0
+    assert inventory.is_reconciled_since(0)
+
+    inventory = HexDigestInventory(path)
+    assert inventory.get_hexdigests() == {"a", "d"}
+    assert inventory.is_reconciled_since(0)
+
+
+def _backup(client):
+    response = client.post("/backup")
+    assert response.status_code == 200, response.json()
+    response = client.get(response.json()["status_url"])
+    assert response.json() == {"state": "done"}
+
+
+def test_backup_uses_inventory(app, client, storage, mocker):
+    nodes = app.state.coordinator_config.nodes
+    storage.upload_hexdigest_bytes("HASH", b"x")
+    list_hexdigests = mocker.spy(RohmuStorage, "list_hexdigests")
+
+    with respx.mock:
+        upload_routes = _mock_backup_nodes(nodes)
+        _backup(client)
+    # Inventory was empty, so the storage was listed
+    assert list_hexdigests.call_count == 1
+    assert [route.call_count for route in upload_routes] == [1, 1]
+
+    with respx.mock:
+        upload_routes = _mock_backup_nodes(nodes)
+        _backup(client)
+    # Uploads were recorded in the inventory, and nothing is uploaded again
+    assert list_hexdigests.call_count == 1
+    assert [route.call_count for route in upload_routes] == [0, 0]
+
+    # Inventory is reconciled with the storage listing periodically
+    app.state.coordinator_config.inventory_reconcile_interval = -1
+    with respx.mock:
+        upload_routes = _mock_backup_nodes(nodes)
+        _backup(client)
+    assert list_hexdigests.call_count == 2
+    # (Nodes did not really upload anything)
+    assert [route.call_count for route in upload_routes] == [1, 1]
@@ -4,11 +4,21 @@ See LICENSE for details
 
 Test that the list endpoint behaves as advertised
 """
-from astacus.coordinator import api
+from .test_restore import BACKUP_MANIFEST
+from astacus.common import ipc
+from astacus.common.manifest import encode_backup_manifest
+from astacus.coordinator import api, list as list_module
 
+import pytest
 
-def test_api_list(client, populated_mstorage, mocker):
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_api_list(client, populated_mstorage, mocker, compact):
     assert populated_mstorage
+    if compact:
+        # Both manifest formats are readable
+        storage = populated_mstorage.get_storage("x")
+        storage.upload_json("backup-2", encode_backup_manifest(BACKUP_MANIFEST, compact=True))
 
     def _run():
         response = client.get("/list")
@@ -63,3 +73,52 @@ def test_api_list(client, populated_mstorage, mocker):
     m = mocker.patch.object(api, "list_backups")
     _run()
     assert not m.called
+
+
+def test_api_list_index(app, client, populated_mstorage, mocker):
+    download_backup = mocker.spy(list_module, "_download_backup")
+    response = client.get("/list")
+    assert response.status_code == 200, response.json()
+    assert download_backup.call_count == 3
+
+    # Backups added by someone else show up, but only their summaries are downloaded
+    storage = populated_mstorage.get_storage("x")
+    manifest = BACKUP_MANIFEST.copy(update={"attempt": 2})
+    storage.upload_json("backup-4", manifest)
+    storage.upload_json("summary-backup-4", list_module.manifest_to_list_single_backup("backup-4", manifest))
+    parse_backup_manifest = mocker.spy(list_module, "parse_backup_manifest")
+
+    # Stale response is returned immediately, and refreshed in the background
+    app.state.coordinator_config.list_ttl = 0
+    response = client.get("/list")
+    assert len(response.json()["storages"][0]["backups"]) == 2
+    assert download_backup.call_count == 4
+    assert not parse_backup_manifest.called
+    app.state.coordinator_config.list_ttl = 3600
+    response = client.get("/list")
+    backups = response.json()["storages"][0]["backups"]
+    assert [backup["name"] for backup in backups] == ["1", "2", "4"]
+    assert backups[2]["attempt"] == 2
+
+
+def test_list_index_stored(populated_mstorage, mocker):
+    storage = populated_mstorage.get_storage("x")
+    req = ipc.ListRequest(storage="x")
+    list_module.list_backups(req=req, json_mstorage=populated_mstorage, list_index=list_module.BackupListIndex())
+    assert "list-index" in storage.list_jsons()
+
+    # After restart, the summaries come from the stored index
+    download_backup = mocker.spy(list_module, "_download_backup")
+    list_index = list_module.BackupListIndex()
+    response = list_module.list_backups(req=req, json_mstorage=populated_mstorage, list_index=list_index)
+    assert [backup.name for backup in response.storages[0].backups] == ["1", "2"]
+    assert not download_backup.called
+
+    # Changes made by someone else are noticed, and stored
+    storage.delete_json("backup-1")
+    storage.upload_json("backup-4", BACKUP_MANIFEST)
+    response = list_module.list_backups(req=req, json_mstorage=populated_mstorage, list_index=list_module.BackupListIndex())
+    assert [backup.name for backup in response.storages[0].backups] == ["2", "4"]
+    assert download_backup.call_count == 1
+    stored = ipc.BackupListIndex.parse_obj(storage.download_json("list-index"))
+    assert sorted(stored.backups) == ["backup-2", "backup-4"]
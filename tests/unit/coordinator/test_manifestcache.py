@@ -0,0 +1,63 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Test that parsed backup manifests are cached
+
+"""
+
+from .test_restore import BACKUP_MANIFEST
+from astacus.common import ipc
+from astacus.coordinator import coordinator
+from astacus.coordinator.manifestcache import estimate_manifest_size, ManifestCache
+from unittest.mock import Mock
+
+import respx
+
+
+def test_manifest_cache():
+    size = estimate_manifest_size(BACKUP_MANIFEST)
+    cache = ManifestCache(max_size=2 * size)
+    stats = Mock()
+    assert cache.get(("x", "a"), stats=stats) is None
+    stats.increase.assert_called_with("astacus_manifest_cache_miss")
+    for name in ["a", "b"]:
+        cache.put(("x", name), BACKUP_MANIFEST.copy(update={"filename": name}), stats=stats)
+    stats.gauge.assert_called_with("astacus_manifest_cache_size", 2 * size)
+
+    manifest = cache.get(("x", "a"), stats=stats)
+    assert manifest.filename == "a"
+    stats.increase.assert_called_with("astacus_manifest_cache_hit")
+    stats.gauge.assert_called_with("astacus_manifest_cache_hit_ratio", 0.5)
+    # Returned manifests are copies
+    manifest.filename = "changed"
+    assert cache.get(("x", "a")).filename == "a"
+
+    # Least recently used one is evicted
+    cache.put(("x", "c"), BACKUP_MANIFEST)
+    assert cache.get(("x", "b")) is None
+    assert cache.get(("x", "a")) is not None
+    cache.invalidate(("x", "a"))
+    assert cache.get(("x", "a")) is None
+    assert cache.size == size
+
+    # Manifests larger than the cache are not cached
+    cache = ManifestCache(max_size=size - 1)
+    cache.put(("x", "a"), BACKUP_MANIFEST)
+    assert cache.get(("x", "a")) is None and cache.size == 0
+
+
+def test_cleanup_parses_manifests_once(app, client, populated_mstorage, mocker):
+    app.state.coordinator_config.retention = ipc.Retention(maximum_backups=1)
+    parse_backup_manifest = mocker.spy(coordinator, "parse_backup_manifest")
+    nodes = app.state.coordinator_config.nodes
+    with respx.mock:
+        for node in nodes:
+            respx.post(f"{node.url}/unlock?locker=x&ttl=0", content={"locked": False})
+            respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
+        response = client.post("/cleanup")
+        assert response.status_code == 200, response.json()
+        response = client.get(response.json()["status_url"])
+    assert response.json() == {"state": "done"}
+    assert parse_backup_manifest.call_count == 2
+    assert len(populated_mstorage.get_storage("x").list_jsons()) == 1
@@ -0,0 +1,65 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Test that the migrate endpoint moves hexdigests to the sharded layout
+"""
+
+from astacus.common.exceptions import ExpiredOperationException
+from astacus.common.rohmustorage import MultiRohmuStorage
+from astacus.coordinator.migrate import MigrateOp
+
+
+def _migrate(client):
+    # Migration does not lock the cluster, so no node requests are made
+    response = client.post("/migrate")
+    assert response.status_code == 200, response.json()
+    response = client.get(response.json()["status_url"])
+    assert response.status_code == 200, response.json()
+    return response.json()
+
+
+def test_api_migrate(client, populated_mstorage, app):
+    x = populated_mstorage.get_storage("x")
+    x.upload_hexdigest_bytes("ABCDEF01", b"foo")
+    app.state.coordinator_config.object_storage.hexdigest_shard_depth = 2
+    assert _migrate(client) == {"state": "done", "progress": {"handled": 2, "failed": 0, "total": 2, "final": True}}
+
+    # Only the default storage was migrated
+    sharded_mstorage = MultiRohmuStorage(config=app.state.coordinator_config.object_storage)
+    x = sharded_mstorage.get_storage("x")
+    assert x.list_unsharded_hexdigests() == []
+    assert sorted(x.list_hexdigests()) == ["ABCDEF01", "DEADBEEF"]
+    assert x.download_hexdigest_bytes("DEADBEEF") == b"foobar"
+    assert sharded_mstorage.get_storage("y").list_unsharded_hexdigests() == ["DEADBEEF"]
+
+
+def test_api_migrate_resume(client, populated_mstorage, app, mocker):
+    x = populated_mstorage.get_storage("x")
+    for hexdigest in ["ABCDEF01", "ABCDEF02"]:
+        x.upload_hexdigest_bytes(hexdigest, b"foo")
+    config = app.state.coordinator_config
+    config.object_storage.hexdigest_shard_depth = 2
+    config.migration.batch_size = 1
+    config.migration.parallel = 1
+
+    # Some other operation is started during the second batch
+    batches = []
+
+    async def _check_still_running(self, batch):
+        batches.append(batch)
+        if len(batches) == 2:
+            raise ExpiredOperationException("operation id mismatch")
+
+    mocker.patch.object(MigrateOp, "_check_still_running", new=_check_still_running)
+    _migrate(client)
+    assert batches == [["ABCDEF01"], ["ABCDEF02"]]
+    sharded_mstorage = MultiRohmuStorage(config=config.object_storage)
+    x = sharded_mstorage.get_storage("x")
+    assert x.list_unsharded_hexdigests() == ["DEADBEEF"]
+    assert sorted(x.list_hexdigests()) == ["ABCDEF01", "ABCDEF02", "DEADBEEF"]
+
+    # Next migration continues with the rest
+    mocker.stopall()
+    assert _migrate(client)["progress"]["total"] == 1
+    assert x.list_unsharded_hexdigests() == []
@@ -0,0 +1,104 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+
+Test that the coordinator's hexdigest reference counts are maintained,
+and used by cleanup instead of scanning all backups
+
+"""
+
+from .test_backup import _mock_backup_nodes
+from .test_inventory import _backup
+from .test_restore import BACKUP_MANIFEST
+from astacus.common import ipc
+from astacus.coordinator.cleanup import CleanupOp
+from astacus.coordinator.coordinator import REFCOUNTS_KEY
+from astacus.coordinator.refcounts import HexDigestRefCounts
+from pathlib import Path
+
+import respx
+
+
+def test_refcounts(tmpdir):
+    path = Path(tmpdir) / "refcounts.jsonl"
+    refcounts = HexDigestRefCounts(path)
+    assert not refcounts.is_verified_since(0)
+    refcounts.add_backup("backup-1", ["a", "b"])
+    refcounts.add_backup("backup-2", ["b", "c", "c"])
+    refcounts.add_backup("backup-2", ["b", "c"])
+    assert refcounts.remove_backup("backup-1", ["a", "b"]) == {"a"}
+    assert refcounts.remove_backup("backup-1", ["a", "b"]) == set()
+
+    refcounts = HexDigestRefCounts(path)
+    assert refcounts.get_backups() == {"backup-2"}
+    assert refcounts.get_unreferenced() == {"a"}
+    assert refcounts.filter_referenced(["a", "b", "c", "d", "e"]) == {"b", "c"}
+    refcounts.forget(["a", "b"])
+    assert refcounts.get_unreferenced() == set()
+    assert refcounts.filter_referenced(["b"]) == {"b"}
+
+    # b and c are no longer used, and backup-3 (using d and e) was not counted
+    assert refcounts.rebuild({"backup-2": ["d"], "backup-3": ["d", "e"]}, ["f"]) == 4
+    assert refcounts.is_verified_since(0)
+
+    refcounts = HexDigestRefCounts(path)
+    assert refcounts.is_verified_since(0)
+    assert refcounts.get_backups() == {"backup-2", "backup-3"}
+    assert refcounts.get_unreferenced() == {"f"}
+    assert refcounts.remove_backup("backup-2", ["d"]) == set()
+    assert refcounts.remove_backup("backup-3", ["d", "e"]) == {"d", "e"}
+
+
+def test_backup_counts_references(app, client):
+    with respx.mock:
+        _mock_backup_nodes(app.state.coordinator_config.nodes)
+        _backup(client)
+    (refcounts, ) = getattr(app.state, REFCOUNTS_KEY).values()
+    assert len(refcounts.get_backups()) == 1
+    assert refcounts.filter_referenced(["HASH", "OTHER"]) == {"HASH"}
+
+
+def _cleanup(client, app, **kw):
+    with respx.mock:
+        for node in app.state.coordinator_config.nodes:
+            respx.post(f"{node.url}/unlock?locker=x&ttl=0", content={"locked": False})
+            respx.post(f"{node.url}/lock?locker=x&ttl=60", content={"locked": True})
+        response = client.post("/cleanup", json=kw)
+        assert response.status_code == 200, response.json()
+        response = client.get(response.json()["status_url"])
+    assert response.json() == {"state": "done"}
+
+
+def test_cleanup_uses_refcounts(app, client, populated_mstorage, mocker):
+    storage = populated_mstorage.get_storage("x")
+    storage.upload_hexdigest_bytes("TOBEDELETED", b"x")
+    mark_and_sweep = mocker.spy(CleanupOp, "mark_and_sweep_hexdigests")
+
+    # Without (verified) reference counts, cleanup scans the storage, and counts the references
+    _cleanup(client, app, storage="x", retention={"keep_days": 10000}, verify=True)
+    assert mark_and_sweep.call_count == 1
+    assert sorted(storage.list_hexdigests()) == ["DEADBEEF"]
+
+    # Backups not counted (e.g. due to crash) are counted by the next cleanup
+    snapshot_result = BACKUP_MANIFEST.snapshot_results[0].copy(
+        update={"hashes": [ipc.SnapshotHash(hexdigest="CAFE", size=1)]}
+    )
+    storage.upload_json(
+        "backup-3", BACKUP_MANIFEST.copy(update={
+            "start": "2020-01-02 21:43:00Z",
+            "snapshot_results": [snapshot_result]
+        })
+    )
+    storage.upload_hexdigest_bytes("CAFE", b"x")
+    storage.upload_hexdigest_bytes("UNKNOWN", b"x")
+
+    # Only the hexdigests no longer used by the deleted backups are deleted
+    _cleanup(client, app, storage="x", retention={"maximum_backups": 1})
+    assert mark_and_sweep.call_count == 1
+    assert storage.list_jsons() == ["backup-3"]
+    assert sorted(storage.list_hexdigests()) == ["CAFE", "UNKNOWN"]
+
+    # Verification finds the rest
+    _cleanup(client, app, storage="x", verify=True)
+    assert mark_and_sweep.call_count == 2
+    assert sorted(storage.list_hexdigests()) == ["CAFE"]
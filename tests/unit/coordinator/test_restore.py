@@ -7,6 +7,7 @@ Test that the coordinator restore endpoint works.
 """
 
 from astacus.common import exceptions, ipc, utils
+from astacus.common.packs import pack_json_name
 from astacus.coordinator.config import CoordinatorNode
 from astacus.coordinator.plugins import get_plugin_restore_class
 from contextlib import nullcontext as does_not_raise
@@ -19,7 +20,7 @@ import pydantic
 import pytest
 import respx
 
-BACKUP_NAME = "dummybackup"
+BACKUP_NAME = "backup-dummy"
 
 BACKUP_MANIFEST = ipc.BackupManifest(
     start="2020-01-01 21:43:00Z",
@@ -48,6 +49,25 @@ class RestoreTest:
     fail_at: Optional[int] = None
     partial: bool = False
     storage_name: Optional[str] = None
+    shard: bool = False
+    repacked: bool = False
+
+
+def _create_shard_manifest(rt, storage):
+    # Node gets the shard, and the packs it needs, in the download request
+    packs = [
+        ipc.SnapshotPack(
+            hexdigest=f"PACK{i}", size=6, entries=[ipc.SnapshotPackEntry(hexdigest=hexdigest, offset=0, size=6)]
+        ) for i, hexdigest in enumerate(["DEADBEEF", "OTHER"])
+    ]
+    snapshot_result = BACKUP_MANIFEST.snapshot_results[0].copy(update={"shard": "SHARD"})
+    manifest = BACKUP_MANIFEST.copy(update={"snapshot_results": [snapshot_result], "packs": packs})
+    if rt.repacked:
+        # The manifest is not changed; only the pack indexes are
+        packs = [packs[0].copy(update={"hexdigest": "REPACKED"}), packs[1]]
+    for pack in packs:
+        storage.upload_json(pack_json_name(pack.hexdigest), pack)
+    return manifest
 
 
 @pytest.mark.parametrize(
@@ -60,13 +80,18 @@ class RestoreTest:
         RestoreTest(storage_name="x"),
         RestoreTest(storage_name="y"),
         # partial
-        RestoreTest(partial=True)
+        RestoreTest(partial=True),
+        # state stored as shard
+        RestoreTest(shard=True),
+        # packs replaced by cleanup after the backup
+        RestoreTest(shard=True, repacked=True),
     ]
 )
 def test_restore(rt, app, client, mstorage):
     # Create fake backup (not pretty but sufficient?)
     storage = mstorage.get_storage(rt.storage_name)
-    storage.upload_json(BACKUP_NAME, BACKUP_MANIFEST)
+    manifest = _create_shard_manifest(rt, storage) if rt.shard else BACKUP_MANIFEST
+    storage.upload_json(BACKUP_NAME, manifest)
     nodes = app.state.coordinator_config.nodes
     with respx.mock:
         for i, node in enumerate(nodes):
@@ -87,6 +112,11 @@ def test_restore(rt, app, client, mstorage):
                         return None
                     if json.loads(request.read())["root_globs"] != ["*"]:
                         return None
+                    if json.loads(request.read()).get("shard", "") != ("SHARD" if rt.shard else ""):
+                        return None
+                    packs = [pack["hexdigest"] for pack in json.loads(request.read()).get("packs", [])]
+                    if packs != ([("REPACKED" if rt.repacked else "PACK0")] if rt.shard else []):
+                        return None
                     return response
 
                 result_url = f"{node.url}/download/result"
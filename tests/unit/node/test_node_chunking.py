@@ -0,0 +1,101 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+"""
+
+from astacus.common.progress import Progress
+from astacus.node import chunking
+from astacus.node.chunking import Chunker
+from astacus.node.config import NodeChunking
+from astacus.node.snapshotter import Snapshotter
+
+import io
+import pytest
+import random
+
+
+def _random_bytes(n):
+    rng = random.Random(1)
+    return bytes(rng.getrandbits(8) for _ in range(n))
+
+
+def _chunks(chunker, data):
+    return list(chunker.iter_chunks(io.BytesIO(data)))
+
+
+@pytest.fixture(name="boundary_search", params=["vectorized", "python"])
+def fixture_boundary_search(request, mocker):
+    if request.param == "vectorized":
+        pytest.importorskip("numpy")
+    else:
+        mocker.patch.object(chunking, "numpy", None)
+    return request.param
+
+
+def test_chunker_sizes(boundary_search):
+    chunker = Chunker(min_size=256, avg_size=1024, max_size=4096)
+    data = _random_bytes(100_000)
+    chunks = _chunks(chunker, data)
+    assert b"".join(chunks) == data
+    assert all(256 <= len(chunk) <= 4096 for chunk in chunks[:-1])
+    assert 512 < len(data) / len(chunks) < 2048
+    assert _chunks(chunker, data) == chunks
+
+    # Zeros never produce boundary -> max_size chunks
+    assert [len(chunk) for chunk in _chunks(chunker, bytes(10_000))] == [4096, 4096, 1808]
+    assert not _chunks(chunker, b"")
+
+
+class ShortReader(io.BytesIO):
+    """ File object whose reads return less than asked for """
+    def read(self, size=-1):
+        return super().read(min(size, 1000))
+
+
+def test_chunker_short_reads(boundary_search):
+    chunker = Chunker(min_size=256, avg_size=1024, max_size=4096)
+    data = _random_bytes(100_000)
+    assert list(chunker.iter_chunks(ShortReader(data))) == _chunks(chunker, data)
+
+
+def test_chunker_insert(boundary_search):
+    chunker = Chunker(min_size=256, avg_size=1024, max_size=4096)
+    data = _random_bytes(100_000)
+    modified = data[:50_000] + b"inserted" + data[50_000:]
+    chunks = set(_chunks(chunker, data))
+    modified_chunks = _chunks(chunker, modified)
+    changed = [chunk for chunk in modified_chunks if chunk not in chunks]
+    assert 1 <= len(changed) <= 2
+
+
+@pytest.mark.parametrize(
+    "min_size,avg_size,max_size", [
+        (1, 1, 8),
+        (3, 16, 64),
+        (100, 100, 100),
+        (256, 1024, 4096),
+        (1000, 2000, 300_000),
+    ]
+)
+def test_chunker_vectorized_matches_python(mocker, min_size, avg_size, max_size):
+    pytest.importorskip("numpy")
+    chunker = Chunker(min_size=min_size, avg_size=avg_size, max_size=max_size)
+    rng = random.Random(2)
+    low_entropy = bytes(rng.choice(b"ab") for _ in range(50_000))
+    datas = [_random_bytes(400_000), bytes(20_000), low_entropy]
+    vectorized = [_chunks(chunker, data) for data in datas]
+    mocker.patch.object(chunking, "numpy", None)
+    assert [_chunks(chunker, data) for data in datas] == vectorized
+
+
+def test_snapshot_chunking_max_file_size(snapshotter):
+    config = NodeChunking(min_file_size=10_000, max_file_size=20_000, min_size=256, avg_size=1024, max_size=4096)
+    snapshotter = Snapshotter(src=snapshotter.src, dst=snapshotter.dst, globs=["*"], parallel=1, chunking=config)
+    (snapshotter.src / "big").write_bytes(_random_bytes(15_000))
+    (snapshotter.src / "huge").write_bytes(_random_bytes(25_000))
+    with snapshotter.lock:
+        snapshotter.snapshot(progress=Progress())
+        ss = snapshotter.get_snapshot_state()
+    files = {str(ssfile.relative_path): ssfile for ssfile in ss.files}
+    assert files["big"].chunks and not files["big"].hexdigest
+    assert not files["huge"].chunks and files["huge"].hexdigest
@@ -0,0 +1,103 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+"""
+
+from astacus.common import exceptions
+from astacus.common.progress import Progress
+from astacus.common.storage import FileStorage
+from astacus.node.concurrency import AdaptiveConcurrency
+
+import threading
+import time
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+def _run_window(concurrency, clock, rate):
+    # Simulate transfers of single byte objects at rate(limit) objects/second
+    limit = concurrency.limit
+    for _ in range(limit):
+        clock.now += 1 / rate(limit)
+        concurrency.add_success(1)
+
+
+def test_adaptive_concurrency_saturation():
+    clock = FakeClock()
+    concurrency = AdaptiveConcurrency(min_limit=1, max_limit=20, time_fun=clock.time)
+
+    def _rate(limit):
+        # Throughput scales up to 4 concurrent transfers, and then degrades
+        return min(limit, 4) - max(limit - 6, 0) * 0.5
+
+    for _ in range(20):
+        _run_window(concurrency, clock, _rate)
+    assert 4 <= concurrency.limit <= 6
+    assert concurrency.peak_limit <= 7
+
+    # Throttling halves the limit
+    limit = concurrency.limit
+    concurrency.add_throttled()
+    assert concurrency.limit == limit // 2
+
+
+def test_adaptive_concurrency_limits():
+    clock = FakeClock()
+    concurrency = AdaptiveConcurrency(min_limit=2, max_limit=5, time_fun=clock.time)
+    for _ in range(20):
+        _run_window(concurrency, clock, lambda limit: limit)
+    assert concurrency.limit == 5
+    for _ in range(5):
+        concurrency.add_throttled()
+    assert concurrency.limit == 2
+
+
+def test_upload_throttled(snapshotter, uploader, mocker):
+    # Storage with latency, which throttles if there are more than 3
+    # concurrent uploads
+    lock = threading.Lock()
+    active = [0]
+    peak_active = [0]
+    upload_hexdigest_from_file = FileStorage.upload_hexdigest_from_file
+
+    def _upload(self, hexdigest, f):
+        with lock:
+            active[0] += 1
+            peak_active[0] = max(peak_active[0], active[0])
+            throttle = active[0] > 3
+        try:
+            time.sleep(0.01)
+            if throttle:
+                raise exceptions.TransientException("slow down")
+            return upload_hexdigest_from_file(self, hexdigest, f)
+        finally:
+            with lock:
+                active[0] -= 1
+
+    mocker.patch.object(FileStorage, "upload_hexdigest_from_file", new=_upload)
+    add_throttled = mocker.spy(AdaptiveConcurrency, "add_throttled")
+    with snapshotter.lock:
+        for i in range(50):
+            (snapshotter.src / f"file{i}").write_text(f"{i}" * 1000)
+        snapshotter.snapshot(progress=Progress())
+        hashes = snapshotter.get_snapshot_hashes()
+        assert len(hashes) == 50
+        # Like the coordinator, retry until everything is uploaded
+        for _ in range(10):
+            stored = set(uploader.storage.list_hexdigests())
+            missing_hashes = [h for h in hashes if h.hexdigest not in stored]
+            if not missing_hashes:
+                break
+            uploader.write_hashes_to_storage(
+                snapshotter=snapshotter, hashes=missing_hashes, parallel=8, min_parallel=1, progress=Progress()
+            )
+    assert len(uploader.storage.list_hexdigests()) == 50
+    assert peak_active[0] <= 8
+    # Throttling leads to multiplicative decrease
+    assert add_throttled.called == (peak_active[0] > 3)
@@ -3,12 +3,16 @@ Copyright (c) 2020 Aiven Ltd
 See LICENSE for details
 """
 
-from astacus.common import ipc, utils
+from astacus.common import ipc, magic, utils
 from astacus.common.progress import Progress
+from astacus.common.storage import FileStorage
+from astacus.node.config import NodeChunking, NodePacking
 from astacus.node.download import Downloader
 from astacus.node.snapshotter import Snapshotter
 from pathlib import Path
 
+import random
+
 
 def test_download(snapshotter, uploader, storage, tmpdir):
     with snapshotter.lock:
@@ -39,12 +43,96 @@ def test_download(snapshotter, uploader, storage, tmpdir):
         assert ssfile1.equals_excluding_mtime(ssfile2)
 
 
+def test_download_packs(snapshotter, uploader, storage, tmpdir, mocker):
+    with snapshotter.lock:
+        for i in range(10):
+            (snapshotter.src / f"small{i}").write_bytes(bytes([i]) * 1000)
+        (snapshotter.src / "small-copy").write_bytes(bytes(1000))
+        (snapshotter.src / "big").write_bytes(bytes(10_000))
+        snapshotter.snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+        hashes = snapshotter.get_snapshot_hashes()
+        totals = uploader.write_hashes_to_storage(
+            snapshotter=snapshotter,
+            hashes=hashes,
+            progress=Progress(),
+            parallel=2,
+            packing=NodePacking(max_file_size=1000, pack_size=4000)
+        )
+    # 10 small files in packs of 4, and one big file
+    assert [len(pack.entries) for pack in totals.packs] == [4, 4, 2]
+    assert len(storage.list_hexdigests()) == 4
+    assert totals.total_size == 20_000
+
+    dst2 = Path(tmpdir / "dst2")
+    dst2.mkdir()
+    dst3 = Path(tmpdir / "dst3")
+    dst3.mkdir()
+    snapshotter = Snapshotter(src=dst2, dst=dst3, globs=["*"], parallel=1)
+    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=2, packs=totals.packs)
+    download_hexdigest_to_file = mocker.spy(FileStorage, "download_hexdigest_to_file")
+    with snapshotter.lock:
+        progress = Progress()
+        downloader.download_from_storage(progress=progress, snapshotstate=ss1)
+        assert progress.finished_successfully
+        snapshotter.snapshot(progress=Progress())
+        ss2 = snapshotter.get_snapshot_state()
+    # Each pack is downloaded once
+    assert download_hexdigest_to_file.call_count == 4
+    for ssfile1, ssfile2 in zip(ss1.files, ss2.files):
+        assert ssfile1.equals_excluding_mtime(ssfile2)
+
+
 def test_api_download(client, mocker):
     mocker.patch.object(utils, "http_request")
     response = client.post("/node/download")
     assert response.status_code == 422, response.json()
 
 
+def test_api_download_shard(app, client, mocker):
+    url = "http://addr/result"
+    m = mocker.patch.object(utils, "http_request")
+    response = client.post("/node/lock?locker=x&ttl=10")
+    assert response.status_code == 200, response.json()
+
+    # Snapshot state is stored as a shard, instead of being returned
+    response = client.post("/node/snapshot", json={"root_globs": ["*"], "storage": "x", "result_url": url})
+    assert response.status_code == 200, response.json()
+    response = client.get(response.json()["status_url"])
+    assert response.status_code == 200, response.json()
+    result = ipc.SnapshotResult.parse_obj(response.json())
+    assert result.progress.finished_successfully
+    assert result.shard and result.files == 4 and result.state.files == []
+    response = client.post(
+        "/node/upload", json={
+            "storage": "x",
+            "hashes": [x.dict() for x in result.hashes],
+            "result_url": url
+        }
+    )
+    assert response.status_code == 200, response.json()
+
+    # Restore needs only the shard (there is no backup manifest at all)
+    root = app.state.node_config.root
+    (root / "foobig").unlink()
+    (root / "foo").write_text("changed")
+    response = client.post(
+        "/node/download",
+        json={
+            "storage": "x",
+            "backup_name": "backup-nonexistent",
+            "snapshot_index": 0,
+            "root_globs": ["*"],
+            "shard": result.shard,
+            "result_url": url
+        }
+    )
+    assert response.status_code == 200, response.json()
+    assert ipc.NodeResult.parse_raw(m.call_args[1]["data"]).progress.finished_successfully
+    assert (root / "foobig").read_text() == "foobar" * magic.EMBEDDED_FILE_SIZE
+    assert (root / "foo").read_text() == "foobar"
+
+
 def test_api_clear(client, mocker):
     url = "http://addr/result"
     m = mocker.patch.object(utils, "http_request")
@@ -68,3 +156,72 @@ def test_api_clear(client, mocker):
     response = m.call_args[1]["data"]
     result = ipc.NodeResult.parse_raw(response)
     assert result.progress.finished_successfully
+
+
+def test_download_chunked(snapshotter, uploader, storage, tmpdir):
+    chunking = NodeChunking(min_file_size=10_000, min_size=256, avg_size=1024, max_size=4096)
+    snapshotter = Snapshotter(src=snapshotter.src, dst=snapshotter.dst, globs=["*"], parallel=1, chunking=chunking)
+    rng = random.Random(1)
+    data = bytes(rng.getrandbits(8) for _ in range(50_000))
+    (snapshotter.src / "big").write_bytes(data)
+    (snapshotter.src / "big2").write_bytes(data[:25_000] + b"x" + data[25_000:])
+    with snapshotter.lock:
+        snapshotter.snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+        hashes = snapshotter.get_snapshot_hashes()
+        uploader.write_hashes_to_storage(snapshotter=snapshotter, hashes=hashes, progress=Progress(), parallel=1)
+
+    files = {str(ssfile.relative_path): ssfile for ssfile in ss1.files}
+    assert not files["big"].hexdigest
+    assert len(files["big"].chunks) > 10
+    assert sum(chunk.size for chunk in files["big"].chunks) == len(data)
+    # Most of the chunks are shared between the files
+    assert len(hashes) <= len(files["big"].chunks) + 2
+    assert set(storage.list_hexdigests()) == {h.hexdigest for h in hashes}
+
+    dst2 = Path(tmpdir / "dst2")
+    dst2.mkdir()
+    dst3 = Path(tmpdir / "dst3")
+    dst3.mkdir()
+    snapshotter = Snapshotter(src=dst2, dst=dst3, globs=["*"], parallel=1, chunking=chunking)
+    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1)
+    with snapshotter.lock:
+        downloader.download_from_storage(progress=Progress(), snapshotstate=ss1)
+        assert (dst2 / "big").read_bytes() == data
+        snapshotter.snapshot(progress=Progress())
+        ss2 = snapshotter.get_snapshot_state()
+    for ssfile1, ssfile2 in zip(ss1.files, ss2.files):
+        assert ssfile1.equals_excluding_mtime(ssfile2)
+
+
+def test_download_parts(snapshotter, uploader, storage, tmpdir):
+    snapshotter = Snapshotter(src=snapshotter.src, dst=snapshotter.dst, globs=["*"], parallel=1, part_size=1000)
+    rng = random.Random(1)
+    data = bytes(rng.getrandbits(8) for _ in range(3500))
+    (snapshotter.src / "big").write_bytes(data)
+    (snapshotter.src / "small").write_bytes(data[:1000])
+    with snapshotter.lock:
+        snapshotter.snapshot(progress=Progress())
+        ss1 = snapshotter.get_snapshot_state()
+        hashes = snapshotter.get_snapshot_hashes()
+        uploader.write_hashes_to_storage(snapshotter=snapshotter, hashes=hashes, progress=Progress(), parallel=2)
+
+    files = {str(ssfile.relative_path): ssfile for ssfile in ss1.files}
+    assert [chunk.size for chunk in files["big"].chunks] == [1000, 1000, 1000, 500]
+    # Not larger than part_size -> stored as is
+    assert files["small"].hexdigest == files["big"].chunks[0].hexdigest
+    assert len(hashes) == 4
+
+    dst2 = Path(tmpdir / "dst2")
+    dst2.mkdir()
+    dst3 = Path(tmpdir / "dst3")
+    dst3.mkdir()
+    snapshotter = Snapshotter(src=dst2, dst=dst3, globs=["*"], parallel=1, part_size=1000)
+    downloader = Downloader(storage=storage, snapshotter=snapshotter, dst=dst2, parallel=1, part_parallel=3)
+    with snapshotter.lock:
+        downloader.download_from_storage(progress=Progress(), snapshotstate=ss1)
+        assert (dst2 / "big").read_bytes() == data
+        snapshotter.snapshot(progress=Progress())
+        ss2 = snapshotter.get_snapshot_state()
+    for ssfile1, ssfile2 in zip(ss1.files, ss2.files):
+        assert ssfile1.equals_excluding_mtime(ssfile2)
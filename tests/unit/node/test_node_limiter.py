@@ -0,0 +1,88 @@
+"""
+Copyright (c) 2020 Aiven Ltd
+See LICENSE for details
+"""
+
+from astacus.common.progress import Progress
+from astacus.node.config import NodeLimits
+from astacus.node.limiter import Limiter, TokenBucket
+
+import pytest
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(time_fun=clock.time, sleep_fun=clock.sleep)
+    # Unlimited by default
+    assert bucket.consume(10 ** 9) == 0
+    bucket.set_rate(100)
+    # One second worth of burst is available immediately
+    assert bucket.consume(100) == 0
+    assert bucket.consume(50) == pytest.approx(0.5)
+    clock.now += 10
+    # .. but no more than that is accumulated while idle
+    assert bucket.consume(300) == pytest.approx(2)
+    bucket.set_rate(0)
+    assert bucket.consume(10 ** 9) == 0
+    assert clock.sleeps == [pytest.approx(0.5), pytest.approx(2)]
+
+
+def test_limiter_set_limits():
+    clock = FakeClock()
+    limiter = Limiter(NodeLimits(), time_fun=clock.time, sleep_fun=clock.sleep)
+    limiter.read(10 ** 9)
+    limiter.network(10 ** 9)
+    limiter.file_op(10 ** 9)
+    assert limiter.throttled_seconds == 0
+    limiter.set_limits(NodeLimits(read_bytes_per_second=1000, network_bytes_per_second=100, file_ops_per_second=10))
+    limiter.read(2000)
+    limiter.network(200)
+    limiter.file_op(20)
+    assert limiter.throttled_seconds == pytest.approx(3)
+
+
+def test_snapshot_and_upload_limited(snapshotter, uploader):
+    clock = FakeClock()
+    snapshotter.limiter = Limiter(
+        NodeLimits(read_bytes_per_second=1000, network_bytes_per_second=1000, file_ops_per_second=1),
+        time_fun=clock.time,
+        sleep_fun=clock.sleep
+    )
+    uploader.storage.network_callback = snapshotter.limiter.network
+    with snapshotter.lock:
+        snapshotter.create_4foobar()
+        hashing_seconds = snapshotter.limiter.throttled_seconds
+        assert hashing_seconds > 0
+        hashes = snapshotter.get_snapshot_hashes()
+        assert len(hashes) == 1
+        network_bytes = snapshotter.limiter.network_bytes
+        network_tokens = network_bytes.tokens
+        uploader.write_hashes_to_storage(snapshotter=snapshotter, hashes=hashes, parallel=1, progress=Progress())
+        assert snapshotter.limiter.throttled_seconds > hashing_seconds
+        assert network_bytes.tokens < network_tokens
+
+
+def test_api_limits(client):
+    response = client.get("/node/limits")
+    assert response.status_code == 200, response.json()
+    assert response.json() == NodeLimits().dict()
+    limits = NodeLimits(read_bytes_per_second=1_000_000)
+    response = client.put("/node/limits", json=limits.dict())
+    assert response.status_code == 200, response.json()
+    response = client.get("/node/limits")
+    assert response.json() == limits.dict()
+    response = client.put("/node/limits", json={"foo": 42})
+    assert response.status_code == 422, response.json()
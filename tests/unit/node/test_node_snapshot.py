@@ -3,10 +3,21 @@ Copyright (c) 2020 Aiven Ltd
 See LICENSE for details
 """
 
-from astacus.common import ipc, utils
+from .conftest import SnapshotterWithDefaults
+from astacus.common import exceptions, ipc, magic, utils
 from astacus.common.progress import Progress
+from astacus.common.rohmustorage import RohmuStorage
+from astacus.common.storage import FileStorage
+from astacus.node import snapshotter as snapshotter_module
+from astacus.node.concurrency import AdaptiveConcurrency
+from astacus.node.config import NodePacking
 from astacus.node.snapshot import SnapshotOp
+from astacus.node.snapshotter import Snapshotter
+from astacus.node.uploader import HashUploader, Uploader, UploadJobResult
+from pathlib import Path
+from tests.utils import create_rohmu_config
 
+import io
 import os
 import pytest
 
@@ -69,7 +80,7 @@ def test_snapshot(snapshotter, uploader):
         snapshotter.get_snapshot_hashes()
 
 
-@pytest.mark.parametrize("test", [(os, "link", 1, 1), (None, "_snapshotfile_from_path", 3, 0)])
+@pytest.mark.parametrize("test", [(os, "link", 1, 1), (None, "_entry_from_path", 3, 0)])
 def test_snapshot_error_filenotfound(snapshotter, mocker, test):
     (obj, fun, exp_progress_1, exp_progress_2) = test
 
@@ -105,14 +116,41 @@ def test_api_snapshot_and_upload(client, mocker):
     req_json["result_url"] = url
     response = client.post("/node/snapshot", json=req_json)
     assert response.status_code == 200, response.json()
+    response_json = response.json()
+
+    # Only the summary is sent to the result_url
+    sent = ipc.SnapshotResult.parse_raw(m.call_args[1]["data"])
+    assert sent.progress.finished_successfully
+    assert sent.paged and sent.state.files == [] and not sent.hashes
 
     # Decode the (result endpoint) response using the model
-    response = m.call_args[1]["data"]
-    result = ipc.SnapshotResult.parse_raw(response)
+    status_url = response_json["status_url"]
+    response = client.get(status_url)
+    assert response.status_code == 200, response.json()
+    result = ipc.SnapshotResult.parse_obj(response.json())
     assert result.progress.finished_successfully
     assert result.hashes
     assert result.files
     assert result.total_size
+    assert sent.files == result.files and sent.total_size == result.total_size
+
+    # Summary omits the files and hashes, which can be fetched in pages instead
+    response = client.get(f"{status_url}?summary=true")
+    assert response.status_code == 200, response.json()
+    summary = ipc.SnapshotResult.parse_obj(response.json())
+    assert summary.paged and summary.files == result.files
+    assert summary.state.files == [] and summary.hashes == []
+    for part in ["files", "hashes"]:
+        items = []
+        cursor = 0
+        while cursor is not None:
+            response = client.get(f"{status_url}/{part}?cursor={cursor}&limit=1")
+            assert response.status_code == 200, response.json()
+            page = ipc.SnapshotResultPage.parse_obj(response.json())
+            assert len(getattr(page, part)) == 1
+            items.extend(getattr(page, part))
+            cursor = page.next_cursor
+        assert items == (result.state.files if part == "files" else result.hashes)
 
     # Ask it to be uploaded
     response = client.post("/node/upload")
@@ -153,3 +191,245 @@ def test_api_snapshot_error(client, mocker):
     progress = response.json()["progress"]
     assert progress["failed"]
     assert progress["final"]
+
+
+def test_snapshot_index(snapshotter, mocker):
+    index_path = snapshotter.dst / ".astacus" / "snapshot-index.jsonl"
+    snapshotter = SnapshotterWithDefaults(
+        src=snapshotter.src, dst=snapshotter.dst, globs=["*"], parallel=1, index_path=index_path
+    )
+    with snapshotter.lock:
+        snapshotter.create_4foobar()
+        ss1 = snapshotter.get_snapshot_state()
+    assert index_path.is_file()
+
+    # Restarted snapshotter should not hash anything that has not changed
+    snapshotter = Snapshotter(src=snapshotter.src, dst=snapshotter.dst, globs=["*"], parallel=1, index_path=index_path)
+    m = mocker.patch.object(snapshotter_module, "hash_hexdigest_readable", wraps=snapshotter_module.hash_hexdigest_readable)
+    with snapshotter.lock:
+        assert snapshotter.snapshot(progress=Progress()) == 0
+        assert snapshotter.get_snapshot_state() == ss1
+        assert not m.called
+
+        (snapshotter.src / "foobig").write_text("barfoo" * (magic.EMBEDDED_FILE_SIZE + 1))
+        assert snapshotter.snapshot(progress=Progress()) > 0
+        assert m.call_count == 1
+        ss2 = snapshotter.get_snapshot_state()
+
+    # Changed file's new hash is persisted too
+    snapshotter = Snapshotter(src=snapshotter.src, dst=snapshotter.dst, globs=["*"], parallel=1, index_path=index_path)
+    with snapshotter.lock:
+        assert snapshotter.snapshot(progress=Progress()) == 0
+        assert snapshotter.get_snapshot_state() == ss2
+    assert m.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "globs", [["*"], ["**"], ["**/*"], ["**/*.db"], ["*/*"], ["a/**/x*"], ["*.db", "a/**/*", "b/x"], ["nonexistent/**"]]
+)
+def test_walk_files(tmpdir, globs):
+    root = Path(tmpdir)
+    for relative_path in [
+        "x.db", "y", ".hidden", "a/x.db", "a/b/x1", "a/b/c/y.db", "b/x", "b/x.db/z", ".astacus/x.db", "a/.astacus/x"
+    ]:
+        path = root / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("foo")
+    (root / "a" / "symlink").symlink_to(root / "x.db")
+    (root / "symlinkdir").symlink_to(root / "a", target_is_directory=True)
+
+    expected = set()
+    for glob in globs:
+        for path in root.glob(glob):
+            relative_path = path.relative_to(root)
+            if path.is_file() and not path.is_symlink() and magic.ASTACUS_TMPDIR not in relative_path.parts \
+               and "symlinkdir" not in relative_path.parts:
+                expected.add(str(relative_path))
+    walked = dict(snapshotter_module.walk_files(root, globs))
+    assert set(walked) == expected
+    for relative_path, inode in walked.items():
+        assert (root / relative_path).stat().st_ino == inode
+
+
+def test_snapshot_replaced_file(snapshotter):
+    with snapshotter.lock:
+        snapshotter.create_4foobar()
+        (snapshotter.src / "foo").unlink()
+        (snapshotter.src / "foo").write_text("barfoo")  # same length
+        assert snapshotter.snapshot(progress=Progress()) > 0
+        assert (snapshotter.dst / "foo").read_text() == "barfoo"
+        assert snapshotter.relative_path_to_entry["foo"].content_b64 == "YmFyZm9v"
+
+
+def test_snapshot_state_order(snapshotter):
+    for relative_path in ["a.b", "a/b", "a/a", "a-b/c", "b"]:
+        path = snapshotter.src / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(relative_path)
+    snapshotter = Snapshotter(src=snapshotter.src, dst=snapshotter.dst, globs=["**/*"], parallel=1)
+    with snapshotter.lock:
+        snapshotter.snapshot(progress=Progress())
+        files = snapshotter.get_snapshot_state().files
+        assert [file.relative_path for file in files] == sorted(file.relative_path for file in files)
+        assert [str(file.relative_path) for file in files] == ["a/a", "a/b", "a-b/c", "a.b", "b"]
+
+        # Order is maintained also when the set of files changes
+        (snapshotter.src / "a" / "b").unlink()
+        (snapshotter.src / "a" / "0").write_text("0")
+        snapshotter.snapshot(progress=Progress())
+        files = snapshotter.get_snapshot_state().files
+        assert [str(file.relative_path) for file in files] == ["a/0", "a/a", "a-b/c", "a.b", "b"]
+
+
+def test_snapshot_entries_survive_next_snapshot(snapshotter):
+    # Snapshot results refer to the entries; later snapshots must not change them
+    with snapshotter.lock:
+        snapshotter.create_4foobar()
+        entries = snapshotter.get_snapshot_entries()
+        files = [entry.to_snapshotfile() for entry in entries]
+        assert files == snapshotter.get_snapshot_state().files
+        (snapshotter.src / "foo").write_text("barfoo" * 2)
+        (snapshotter.src / "foo2").unlink()
+        snapshotter.snapshot(progress=Progress())
+        assert [entry.to_snapshotfile() for entry in entries] == files
+        assert snapshotter.get_snapshot_state().files != files
+
+
+def test_upload_reads_once(snapshotter, uploader, storage, mocker):
+    with snapshotter.lock:
+        snapshotter.create_4foobar()
+        hashes = snapshotter.get_snapshot_hashes()
+        totals = uploader.write_hashes_to_storage(snapshotter=snapshotter, hashes=hashes, parallel=1, progress=Progress())
+        assert totals.total_size == totals.total_read_size == 600
+        assert set(storage.list_hexdigests()) == {h.hexdigest for h in hashes}
+
+        # File changing during upload is detected, and the object is removed
+        (snapshotter.src / "big").write_bytes(b"foobar" * 100_000)
+        snapshotter.snapshot(progress=Progress())
+        hashes = [h for h in snapshotter.get_snapshot_hashes() if h.size == 600_000]
+        upload_hexdigest_from_file = FileStorage.upload_hexdigest_from_file
+
+        def _upload_and_modify(self, hexdigest, f):
+            data = f.read(100_000)
+            with (snapshotter.dst / "big").open("r+b") as modified_f:
+                modified_f.seek(500_000)
+                modified_f.write(b"x")
+            return upload_hexdigest_from_file(self, hexdigest, io.BytesIO(data + f.read()))
+
+        # Uploader uses (thread-local) copies of the storage
+        mocker.patch.object(FileStorage, "upload_hexdigest_from_file", new=_upload_and_modify)
+        progress = Progress()
+        totals = uploader.write_hashes_to_storage(snapshotter=snapshotter, hashes=hashes, parallel=1, progress=progress)
+        assert not totals.total_size
+        assert progress.failed
+        assert hashes[0].hexdigest not in storage.list_hexdigests()
+
+
+def test_upload_retries_transient_errors(snapshotter, uploader, storage, mocker):
+    upload_hexdigest_from_file = FileStorage.upload_hexdigest_from_file
+    failed = set()
+
+    def _flaky_upload(self, hexdigest, f):
+        # Each object fails (after partial read) once
+        if hexdigest not in failed:
+            failed.add(hexdigest)
+            f.read(10)
+            raise exceptions.TransientException("connection reset")
+        return upload_hexdigest_from_file(self, hexdigest, f)
+
+    mocker.patch.object(FileStorage, "upload_hexdigest_from_file", new=_flaky_upload)
+    with snapshotter.lock:
+        snapshotter.create_4foobar()
+        (snapshotter.src / "big").write_bytes(b"foobar" * 1000)
+        snapshotter.snapshot(progress=Progress())
+        hashes = snapshotter.get_snapshot_hashes()
+        assert len(hashes) == 2
+
+        progress = Progress()
+        totals = uploader.write_hashes_to_storage(
+            snapshotter=snapshotter, hashes=hashes, parallel=2, progress=progress, retries=0, retry_delay=0.01
+        )
+        assert progress.failed == 2
+        assert not totals.retries
+
+        failed.clear()
+        progress = Progress()
+        totals = uploader.write_hashes_to_storage(
+            snapshotter=snapshotter, hashes=hashes, parallel=2, progress=progress, retries=1, retry_delay=0.01
+        )
+        assert not progress.failed
+        assert progress.handled == progress.total == 2
+        assert totals.retries == 2
+        assert totals.total_size == 6600
+        assert totals.total_read_size == totals.total_size + 20
+        assert set(storage.list_hexdigests()) == {h.hexdigest for h in hashes}
+
+
+def test_upload_reports_skipped_compression(snapshotter, tmpdir):
+    config = create_rohmu_config(tmpdir)
+    config.compression.incompressible_ratio = 0.9
+    uploader = Uploader(storage=RohmuStorage(config=config))
+    with snapshotter.lock:
+        (snapshotter.src / "random").write_bytes(os.urandom(100_000))
+        (snapshotter.src / "zero").write_bytes(bytes(100_000))
+        snapshotter.snapshot(progress=Progress())
+        hashes = snapshotter.get_snapshot_hashes()
+        totals = uploader.write_hashes_to_storage(snapshotter=snapshotter, hashes=hashes, parallel=2, progress=Progress())
+    assert totals.total_size == 200_000
+    assert totals.compression_skipped_size == 100_000
+    assert totals.compression_skipped_seconds > 0
+
+
+def _create_hash_uploader(snapshotter, storage, *, retries=0):
+    return HashUploader(
+        storage=Uploader(storage=storage),
+        snapshotter=snapshotter,
+        progress=Progress(),
+        concurrency=AdaptiveConcurrency(min_limit=1, max_limit=1),
+        retries=retries,
+        retry_delay=0
+    )
+
+
+def test_upload_plan_jobs(snapshotter, storage):
+    for i, size in enumerate([200, 210, 300, 400, 5000, 6000]):
+        (snapshotter.src / f"file{i}").write_bytes(bytes([i]) * size)
+    with snapshotter.lock:
+        snapshotter.snapshot(progress=Progress())
+        sizes = {h.hexdigest: h.size for h in snapshotter.get_snapshot_hashes()}
+        hash_uploader = _create_hash_uploader(snapshotter, storage)
+        jobs = hash_uploader.plan_jobs(sizes, packing=None)
+        assert [sizes[job] for job in jobs] == [6000, 5000, 400, 300, 210, 200]
+        # Small ones are packed (smallest first), and uploaded before the others
+        jobs = hash_uploader.plan_jobs(sizes, packing=NodePacking(max_file_size=400, pack_size=750))
+        assert [[sizes[hexdigest] for hexdigest in job] for job in jobs[:2]] == [[200, 210, 300], [400]]
+        assert [sizes[job] for job in jobs[2:]] == [6000, 5000]
+
+
+def test_upload_retry_transient(snapshotter, storage):
+    hash_uploader = _create_hash_uploader(snapshotter, storage, retries=2)
+    calls = []
+
+    def _fail_times(times, ex=exceptions.TransientException):
+        def _fun():
+            calls.append(1)
+            if len(calls) <= times:
+                raise ex("x")
+            return "ok"
+
+        return _fun
+
+    result = UploadJobResult()
+    assert hash_uploader.retry_transient(_fail_times(2), "what", result) == "ok"
+    assert result.retries == 2
+
+    calls.clear()
+    result = UploadJobResult()
+    assert hash_uploader.retry_transient(_fail_times(3), "what", result) is None
+    assert result.retries == 2 and len(calls) == 3
+
+    # Non-transient errors are not retried
+    calls.clear()
+    result = UploadJobResult()
+    assert hash_uploader.retry_transient(_fail_times(1, exceptions.AstacusException), "what", result) is None
+    assert result.retries == 0 and len(calls) == 1
@@ -35,7 +35,9 @@ nkMAHqg9PS372Cs=
 -----END PRIVATE KEY-----"""
 
 
-def create_rohmu_config(tmpdir, *, compression=True, encryption=True):
+def create_rohmu_config(
+    tmpdir, *, compression=True, encryption=True, streaming_uploads=False, hexdigest_shard_depth=0, hexdigest_shard_width=2
+):
     x_path = Path(tmpdir) / "rohmu-x"
     x_path.mkdir(exist_ok=True)
     y_path = Path(tmpdir) / "rohmu-y"
@@ -45,6 +47,9 @@ def create_rohmu_config(tmpdir, *, compression=True, encryption=True):
     config = {
         "temporary_directory": str(tmp_path),
         "default_storage": "x",
+        "streaming_uploads": streaming_uploads,
+        "hexdigest_shard_depth": hexdigest_shard_depth,
+        "hexdigest_shard_width": hexdigest_shard_width,
         "storages": {
             "x": {
                 "storage_type": "local",